@@ -153,4 +153,40 @@ REST_FRAMEWORK = {
 ASGI_APPLICATION = 'geckode.asgi.application'
 
 JWT_ALGORITHM = "HS256"
-JWT_MAX_AGE = timedelta(minutes=30)
\ No newline at end of file
+JWT_MAX_AGE = timedelta(minutes=30)
+# Seconds a cached user permission may outlive a missed invalidation (see utils/permission_cache.py)
+PERMISSION_CACHE_TIMEOUT = 300
+# Cache-Control for the public share endpoints; visits served by a CDN are not counted
+SHARE_LINK_CACHE_MAX_AGE = 60
+SHARE_LINK_CACHE_STALE_WHILE_REVALIDATE = 300
+# Seconds the base64-encoded share payload is kept; entries are keyed by ETag and never go stale
+SHARE_LINK_BODY_CACHE_TIMEOUT = 60 * 60 * 24
+# Seconds a rendered project detail may outlive a missed invalidation (see utils/response_cache.py)
+RESPONSE_CACHE_TIMEOUT = 300
+# Send messages queued with utils.redis_client.publish_on_commit from a background thread
+REDIS_PUBLISH_IN_BACKGROUND = False
+
+# Redis used by utils.redis_client; REDIS_CLIENTS overrides these per logical client
+# ("pubsub", "queue", "cache"), e.g. {"queue": {"URL": "redis://queue-host:6379/0"}}
+REDIS_URL = "redis://localhost:6379/0"
+REDIS_MAX_CONNECTIONS = 50
+REDIS_HEALTH_CHECK_INTERVAL = 30
+REDIS_SOCKET_TIMEOUT = 5
+REDIS_SENTINELS = None
+REDIS_SENTINEL_SERVICE = None
+REDIS_CLUSTER = False
+REDIS_CLIENTS = {}
+# Seconds between autosaves of an open project, plus up to PROJECT_AUTOSAVE_JITTER (see projects/autosave.py)
+PROJECT_AUTOSAVE_INTERVAL = 30
+PROJECT_AUTOSAVE_JITTER = 5
+# Seconds block events from a project room are collected before being sent as one batch (see projects/block_events.py)
+BLOCK_EVENT_BATCH_WINDOW = 0.03
+# 'orjson' encodes websocket frames with orjson when it is installed; 'json' uses the standard library
+WEBSOCKET_JSON_BACKEND = 'json'
+# Per-connection websocket flow control (see utils/flow_control.py); a rate or queue size of 0 disables it.
+# Policies are 'drop' (discard the message or frame) or 'close' (close the connection)
+WEBSOCKET_RATE_LIMIT_RATE = 30
+WEBSOCKET_RATE_LIMIT_BURST = 60
+WEBSOCKET_RATE_LIMIT_POLICY = 'drop'
+WEBSOCKET_SEND_QUEUE_SIZE = 256
+WEBSOCKET_SEND_QUEUE_POLICY = 'close'
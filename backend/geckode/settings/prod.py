@@ -20,11 +20,17 @@ SECURE_SSL_REDIRECT = True
 SESSION_COOKIE_SECURE = True
 CSRF_COOKIE_SECURE = True
 
+# Redis can live off-box: point these at the shared instance (or Sentinel, see base.py)
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+REDIS_CHANNEL_LAYER_URL = os.environ.get('REDIS_CHANNEL_LAYER_URL', REDIS_URL)
+REDIS_CACHE_URL = os.environ.get('REDIS_CACHE_URL', 'redis://127.0.0.1:6379/1')
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": [REDIS_CHANNEL_LAYER_URL],
         },
     },
 }
@@ -32,7 +38,7 @@ CHANNEL_LAYERS = {
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": "redis://127.0.0.1:6379/1",  # or your redis config
+        "LOCATION": REDIS_CACHE_URL,
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
@@ -40,4 +46,5 @@ CACHES = {
 }
 
 REDIS_SOCKET_CONNECT_TIMEOUT = 2
-REDIS_SOCKET_RETRIES = 3
\ No newline at end of file
+REDIS_SOCKET_RETRIES = 3
+REDIS_PUBLISH_IN_BACKGROUND = True
\ No newline at end of file
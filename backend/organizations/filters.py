@@ -10,6 +10,7 @@ class OrganizationFilter(PrefixedFilterSet):
     ordering_fields = [
         'id',
         'created_at',
+        'members_count',
         ('owner__username', 'owner'),
         *search_fields,
     ]
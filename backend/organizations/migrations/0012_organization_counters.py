@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:31
+
+from django.db import migrations, models
+from django.db.models import OuterRef
+from utils.aggregates import SubqueryCount
+
+
+def backfill_counters(apps, schema_editor):
+    Organization = apps.get_model('organizations', 'Organization')
+    OrganizationMember = apps.get_model('organizations', 'OrganizationMember')
+    OrganizationProject = apps.get_model('projects', 'OrganizationProject')
+
+    Organization.objects.update(
+        members_count=SubqueryCount(OrganizationMember.objects.filter(organization=OuterRef('pk'))),
+        projects_count=SubqueryCount(OrganizationProject.objects.filter(organization=OuterRef('pk'))),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organizations', '0011_organization_thumbnail'),
+        ('projects', '0024_share_link_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='members_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='projects_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,10 @@
 from __future__ import annotations
-from django.db.models import Model, ImageField, DateTimeField, ForeignKey, PROTECT, SlugField, CharField, TextField, ManyToManyField, BooleanField, CASCADE, SET_NULL
+from django.db.models import Model, PositiveIntegerField, OuterRef, ImageField, DateTimeField, ForeignKey, PROTECT, SlugField, CharField, TextField, ManyToManyField, BooleanField, CASCADE, SET_NULL
 from accounts.models import User
 from rest_framework.exceptions import ValidationError
+from utils import permission_cache
+from utils.aggregates import SubqueryCount
+from utils.mixins import CounterFieldsMixin
 from utils.permissions import create_permissions_allowed_hierarchy
 import string
 import random
@@ -12,7 +15,7 @@ def org_thumbnail_path(_instance, filename : str):
     file_ext = filename.split('.')[-1]
     return f"org-thumbnails/{random_string}.{file_ext}"
 
-class Organization(Model):
+class Organization(CounterFieldsMixin, Model):
     PERMISSION_CHOICES = [
         ('view', 'Can view projects'),
         ('contribute', 'Can contribute projects'),
@@ -21,6 +24,9 @@ class Organization(Model):
         ('admin', 'Can modify details'),
     ]
     SEARCH_FIELDS = ['name', 'slug']
+    # Denormalized counts, only ever changed with F() expressions (see CounterFieldsMixin)
+    # members_count does not include the owner
+    COUNTER_FIELDS = ['members_count', 'projects_count']
 
     created_at = DateTimeField(auto_now_add=True)
     owner = ForeignKey(User, on_delete=PROTECT)
@@ -32,27 +38,43 @@ class Organization(Model):
     default_member_permission = CharField(max_length=10, choices=PERMISSION_CHOICES, default=PERMISSION_CHOICES[0][0])
     project_containment = BooleanField(blank=True, default=False)
     thumbnail = ImageField(upload_to=org_thumbnail_path, blank=True, null=True)
+    members_count = PositiveIntegerField(default=0, db_index=True)
+    projects_count = PositiveIntegerField(default=0)
 
     def has_permission(self, user : User, required_permission : str) -> bool:
-        if user == self.owner:
+        if user.pk is not None and user.pk == self.owner_id:
             return True
-        if self.is_user_banned(user):
+
+        member_permission = self.get_member_permission(user)
+        if member_permission['banned']:
             return False
 
-        return OrganizationMember.objects.filter(
-            organization=self,
-            member=user,
-            permission__in=create_permissions_allowed_hierarchy(self.PERMISSION_CHOICES).get(required_permission, [])
-        ).exists()
+        return member_permission['permission'] in create_permissions_allowed_hierarchy(self.PERMISSION_CHOICES).get(required_permission, [])
 
     def get_permission(self, user : User) -> str | None:
-        if user == self.owner:
+        if user.pk is not None and user.pk == self.owner_id:
             return 'owner'
 
-        return OrganizationMember.objects.filter(
-            organization=self,
-            member=user,
-        ).values_list('permission', flat=True).first()
+        return self.get_member_permission(user)['permission']
+
+    def get_member_permission(self, user : User) -> dict:
+        '''
+        The user's membership permission and ban status, read through the shared
+        permission cache (invalidated by the member and ban signals)
+        '''
+        if user.pk is None:
+            return {'permission': None, 'banned': False}
+
+        return permission_cache.get_or_compute(
+            permission_cache.organization_permission_key(self.pk, user.pk),
+            lambda: {
+                'permission': OrganizationMember.objects.filter(
+                    organization=self,
+                    member=user,
+                ).values_list('permission', flat=True).first(),
+                'banned': self.is_user_banned(user),
+            },
+        )
 
     def has_member(self, user : User, include_owner=True) -> bool:
         if include_owner and user == self.owner:
@@ -94,6 +116,16 @@ class Organization(Model):
             user=user
         ).exists()
 
+def organization_count_expressions() -> dict:
+    '''
+    The true values of Organization's counter columns as correlated subqueries, used
+    to repair drift (see the recount command)
+    '''
+    return {
+        'members_count': SubqueryCount(OrganizationMember.objects.filter(organization=OuterRef('pk'))),
+        'projects_count': SubqueryCount(Organization.projects.through.objects.filter(organization=OuterRef('pk'))),
+    }
+
 class OrganizationMember(Model):
     organization = ForeignKey(Organization, related_name='organization_members', on_delete=CASCADE)
     member = ForeignKey(User, related_name='organization_members', on_delete=CASCADE)
@@ -2,6 +2,7 @@ from rest_framework.serializers import ModelSerializer, SerializerMethodField, P
 from accounts.models import User
 from accounts.serializers import PublicUserSerializer
 from utils.image_processing import process_uploaded_image
+from utils.permissions import get_permission_object
 from .models import Organization, OrganizationInvitation, OrganizationMember, OrganizationBannedMember
 
 class PublicOrganizationSerializer(ModelSerializer):
@@ -14,20 +15,16 @@ class PublicOrganizationSerializer(ModelSerializer):
 class OrganizationSerializer(ModelSerializer):
     owner = PublicUserSerializer(read_only=True)
     members_count = SerializerMethodField()
-    projects_count = SerializerMethodField()
     permission = SerializerMethodField()
 
     class Meta:
         model = Organization
         fields = ['id', 'created_at', 'owner', 'name', 'slug', 'description', 'is_public',
                   'default_member_permission', 'members_count', 'projects_count', 'thumbnail', 'permission']
-        read_only_fields = ['created_at']
+        read_only_fields = ['created_at', 'projects_count']
 
     def get_members_count(self, instance : Organization) -> int:
-        return instance.members.count() + 1 # plus one to count the owner
-
-    def get_projects_count(self, instance : Organization) -> int:
-        return instance.projects.count()
+        return instance.members_count + 1 # plus one to count the owner
 
     def get_permission(self, instance : Organization) -> str | None:
         return instance.get_permission(self.context['request'].user)
@@ -75,9 +72,14 @@ class OrganizationInvitationSerializer(ModelSerializer):
     def validate(self, attrs : dict[str, any]) -> dict[str, any]:
         try:
             if 'view' in self.context and hasattr(self.context['view'], 'kwargs'):
-                organization = Organization.objects.get(id=self.context['view'].kwargs.get('organization_pk'))
+                organization_pk = self.context['view'].kwargs.get('organization_pk')
+                if 'request' in self.context:
+                    # Already loaded by the permission check, and shared by every item of a bulk create
+                    organization = get_permission_object(self.context['request'], Organization, organization_pk)
+                else:
+                    organization = Organization.objects.get(id=organization_pk)
 
-                if organization.has_member(attrs['invitee']):
+                if attrs['invitee'].pk in self.get_member_ids(organization):
                     raise ValidationError('Cannot invite an already-existing member to the organization.')
 
                 if 'request' in self.context:
@@ -90,6 +92,16 @@ class OrganizationInvitationSerializer(ModelSerializer):
 
         return attrs
 
+    def get_member_ids(self, organization : Organization) -> set[int]:
+        # Loaded once and shared through the context by every item of a bulk create; banned users are not members
+        if '_member_ids' not in self.context:
+            self.context['_member_ids'] = {
+                organization.owner_id,
+                *organization.members.exclude(banned_from__organization=organization).values_list('pk', flat=True),
+            }
+
+        return self.context['_member_ids']
+
 class OrganizationMemberSerializer(ModelSerializer):
     member = PublicUserSerializer(read_only=True)
     invited_by = PublicUserSerializer(read_only=True)
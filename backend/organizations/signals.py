@@ -1,6 +1,7 @@
 from django.db.models.signals import pre_save, post_delete, post_save
 from django.dispatch import receiver
-from .models import Organization, OrganizationMember, OrganizationInvitation
+from utils import permission_cache
+from .models import Organization, OrganizationMember, OrganizationInvitation, OrganizationBannedMember
 
 @receiver(pre_save, sender=Organization)
 def delete_old_thumbnail_on_organization_change(sender, instance: Organization, **kwargs) -> None:
@@ -69,4 +70,37 @@ def delete_thumbnail_on_organization_delete(sender, instance: Organization, **kw
     """
     thumbnail = instance.thumbnail
     if thumbnail:
-        thumbnail.delete(save=False)
\ No newline at end of file
+        thumbnail.delete(save=False)
+
+
+@receiver(post_save, sender=OrganizationMember)
+def increment_members_count(sender, instance: OrganizationMember, created: bool, **kwargs) -> None:
+    if created:
+        Organization.increment_counters([instance.organization_id], members_count=1)
+
+
+@receiver(post_delete, sender=OrganizationMember)
+def decrement_members_count(sender, instance: OrganizationMember, **kwargs) -> None:
+    Organization.increment_counters([instance.organization_id], members_count=-1)
+
+
+@receiver(post_save, sender=OrganizationMember)
+@receiver(post_delete, sender=OrganizationMember)
+def invalidate_member_permission(sender, instance: OrganizationMember, **kwargs) -> None:
+    """
+    Drop the cached organization permission of a member that was added, changed or removed.
+    """
+    permission_cache.invalidate([
+        permission_cache.organization_permission_key(instance.organization_id, instance.member_id),
+    ])
+
+
+@receiver(post_save, sender=OrganizationBannedMember)
+@receiver(post_delete, sender=OrganizationBannedMember)
+def invalidate_banned_member_permission(sender, instance: OrganizationBannedMember, **kwargs) -> None:
+    """
+    Drop the cached organization permission of a user that was banned or unbanned.
+    """
+    permission_cache.invalidate([
+        permission_cache.organization_permission_key(instance.organization_id, instance.user_id),
+    ])
@@ -3,7 +3,8 @@ from .models import Organization, OrganizationInvitation, OrganizationMember, Or
 from .serializers import OrganizationSerializer, OrganizationInvitationSerializer, OrganizationMemberSerializer, OrganizationBannedMemberSerializer
 from django_filters.rest_framework import DjangoFilterBackend
 from .filters import OrganizationFilter, OrganizationInvitationFilter, OrganizationMemberFilter, OrganizationBannedMemberFilter
-from utils.permissions import create_user_permission_class
+from utils.mixins import BulkCreateMixin
+from utils.permissions import create_user_permission_class, get_permission_object
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
 from rest_framework.decorators import action
@@ -21,12 +22,17 @@ class OrganizationViewSet(ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete']
 
     def get_queryset(self):
-        return super().get_queryset().filter(
+        queryset = super().get_queryset().filter(
             Q(is_public=True) |
             Q(owner=self.request.user) |
             Q(members=self.request.user)
         ).distinct().order_by("id")
 
+        if self.action == 'list':
+            queryset = queryset.select_related('owner')
+
+        return queryset
+
     def perform_create(self, serializer : OrganizationSerializer) -> None:
         serializer.save(owner=self.request.user)
 
@@ -63,7 +69,7 @@ class OrganizationViewSet(ModelViewSet):
 
         return Response({"status": "joined"}, status=HTTP_200_OK)
 
-class OrganizationInvitationViewSet(ModelViewSet):
+class OrganizationInvitationViewSet(BulkCreateMixin, ModelViewSet):
     queryset = OrganizationInvitation.objects.all()
     serializer_class = OrganizationInvitationSerializer
     filter_backends = [DjangoFilterBackend]
@@ -79,7 +85,7 @@ class OrganizationInvitationViewSet(ModelViewSet):
         '''
         return super().get_permissions() + [
             create_user_permission_class(
-                'invite' if self.action == 'create' else 'manage',
+                'invite' if self.action in ['create', 'bulk'] else 'manage',
                 user_override_fields=['inviter', 'invitee'],
                 primary_pk_class=Organization,
                 lookup='organization_pk',
@@ -99,6 +105,18 @@ class OrganizationInvitationViewSet(ModelViewSet):
 
         serializer.save(organization=organization, inviter=self.request.user)
 
+    def get_bulk_create_kwargs(self) -> dict:
+        return {'organization': get_permission_object(self.request, Organization, self.kwargs.get('organization_pk')), 'inviter': self.request.user}
+
+    def perform_bulk_create(self, serializer : OrganizationInvitationSerializer) -> list[OrganizationInvitation]:
+        organization = get_permission_object(self.request, Organization, self.kwargs.get('organization_pk'))
+        invitee_ids = [item['invitee'].pk for item in serializer.validated_data]
+
+        if organization.banned_users.filter(user__in=invitee_ids).exists():
+            raise ValidationError("Invited user is banned from organization.")
+
+        return super().perform_bulk_create(serializer)
+
     @action(detail=True, methods=['post'])
     def accept(self, request : Request, organization_pk : str|None = None, pk=None) :
         organization = get_object_or_404(Organization, pk=organization_pk)
@@ -0,0 +1,158 @@
+"""
+Per-process autosave scheduler for open projects.
+
+Hocuspocus buffers document states in Redis (yjs:buffer:<id>) and queues the
+project for the sync_yjs workers. Instead of a timer task per socket telling
+clients to save, each process keeps one heap of due times for the projects whose
+autosave lease it holds (see utils.group_users). One task wakes for the earliest
+entry and publishes the due project ids on STORE_REQUESTS_CHANNEL, where
+Hocuspocus stores each one it has open; its store hook skips documents without
+changes. Due projects whose state is already buffered but not queued (e.g.
+Hocuspocus went down in between) are queued directly, through the same
+pending-set guard Hocuspocus uses, so a project is never queued twice.
+"""
+
+import json
+
+import asyncio
+import heapq
+import logging
+import random
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from projects.management.commands.sync_yjs import UPDATES_PENDING_SET_KEY, UPDATES_QUEUE_KEY, get_buffer_key
+from utils.redis_client import get_redis_client, safe_publish
+
+
+logger = logging.getLogger(__name__)
+redis_client = get_redis_client("queue")
+
+DEFAULT_AUTOSAVE_INTERVAL = 30
+DEFAULT_AUTOSAVE_JITTER = 5
+
+# Must match STORE_REQUESTS_CHANNEL in websocket/server.ts
+STORE_REQUESTS_CHANNEL = "yjs:store_requests"
+
+# Queue a project that has a buffered state and is not queued yet.
+# KEYS: buffer, pending set, queue. ARGV: project id.
+QUEUE_IF_BUFFERED_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 and redis.call('sadd', KEYS[2], ARGV[1]) == 1 then
+    redis.call('lpush', KEYS[3], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+_queue_if_buffered = redis_client.register_script(QUEUE_IF_BUFFERED_SCRIPT)
+
+
+def queue_buffered_projects(project_ids: list[int]) -> int:
+    """
+    Queue every project that has unsaved (buffered) changes with one pipelined
+    round trip. Returns how many were queued.
+    """
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in project_ids:
+            _queue_if_buffered(
+                keys=[get_buffer_key(str(project_id)), UPDATES_PENDING_SET_KEY, UPDATES_QUEUE_KEY],
+                args=[str(project_id)],
+                client=pipe,
+            )
+        return sum(pipe.execute())
+    except Exception as exc:
+        logger.warning("Autosave failed to queue %d project(s): %s", len(project_ids), exc)
+        return 0
+
+
+def autosave_projects(project_ids: list[int]) -> None:
+    """
+    Ask Hocuspocus to store the given projects, and queue the ones it already
+    buffered that are not queued yet.
+    """
+    safe_publish(STORE_REQUESTS_CHANNEL, json.dumps({"project_ids": project_ids}))
+    queue_buffered_projects(project_ids)
+
+
+class AutosaveScheduler:
+    def __init__(self):
+        # project id -> channel names of the local connections scheduling it
+        self.owners: dict[int, set[str]] = {}
+        # project id -> its current due time; heap entries that no longer match are skipped
+        self.due: dict[int, float] = {}
+        self.heap: list[tuple[float, int]] = []
+        self.task: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()
+
+    @property
+    def interval(self) -> float:
+        return getattr(settings, "PROJECT_AUTOSAVE_INTERVAL", DEFAULT_AUTOSAVE_INTERVAL)
+
+    @property
+    def jitter(self) -> float:
+        return getattr(settings, "PROJECT_AUTOSAVE_JITTER", DEFAULT_AUTOSAVE_JITTER)
+
+    def schedule(self, project_id: int, now: float) -> None:
+        # Jitter spreads projects opened at the same moment over the interval
+        due = self.due[project_id] = now + self.interval + random.uniform(0, self.jitter)
+        heapq.heappush(self.heap, (due, project_id))
+
+    def add(self, project_id: int, channel_name: str) -> None:
+        self.owners.setdefault(project_id, set()).add(channel_name)
+
+        if project_id not in self.due:
+            self.schedule(project_id, asyncio.get_running_loop().time())
+            self.wakeup.set()
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def discard(self, project_id: int, channel_name: str) -> None:
+        owners = self.owners.get(project_id)
+        if owners is None:
+            return
+
+        owners.discard(channel_name)
+        if not owners:
+            del self.owners[project_id]
+            self.due.pop(project_id, None)
+
+    def pop_due(self, now: float) -> list[int]:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due_at, project_id = heapq.heappop(self.heap)
+            if self.due.get(project_id) == due_at:
+                del self.due[project_id]
+                due.append(project_id)
+        return due
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while self.owners:
+            self.wakeup.clear()
+            delay = self.heap[0][0] - loop.time() if self.heap else self.interval
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = loop.time()
+            due = self.pop_due(now)
+            if not due:
+                continue
+
+            await sync_to_async(autosave_projects, thread_sensitive=False)(due)
+
+            for project_id in due:
+                # Only projects still open here after the await get their next save
+                if project_id in self.owners and project_id not in self.due:
+                    self.schedule(project_id, now)
+
+
+autosave_scheduler = AutosaveScheduler()
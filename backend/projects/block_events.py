@@ -0,0 +1,88 @@
+"""
+Per-room batching of block events sent through ProjectConsumer.
+
+Block events received by this process for a room are collected for a short
+window (BLOCK_EVENT_BATCH_WINDOW seconds) and then sent to the room as one
+group message. A newer event that supersedes an older one for the same block
+and user (e.g. successive moves while dragging) replaces it in the batch. The
+batch is serialized once, and receivers forward that text as a single
+'block_batch' frame. Only a receiver whose own events are in the batch, which it
+must not get back, serializes its own filtered copy.
+"""
+
+import asyncio
+
+from django.conf import settings
+
+from utils.consumers import encode_json
+
+
+DEFAULT_BLOCK_EVENT_BATCH_WINDOW = 0.03
+
+# Event types where only the latest event per block and user matters
+COALESCED_BLOCK_EVENTS = {'block_move'}
+
+
+def get_block_id(message):
+    data = message.get('data') or {}
+    return data.get('block_id', data.get('id'))
+
+
+class BlockEventBatch:
+    def __init__(self, room_group_name, channel_layer):
+        self.room_group_name = room_group_name
+        self.channel_layer = channel_layer
+        # Insertion-ordered; superseded events are removed and re-added at the end
+        self.events = {}
+        self.counter = 0
+        self.task = None
+
+    def add(self, user_id, message):
+        block_id = get_block_id(message)
+
+        if message['type'] in COALESCED_BLOCK_EVENTS and block_id is not None:
+            key = (user_id, message['type'], block_id)
+            self.events.pop(key, None)
+        else:
+            self.counter += 1
+            key = self.counter
+
+        self.events[key] = {'user_id': user_id, 'data': message}
+
+    async def flush(self):
+        events = list(self.events.values())
+
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'handle_block_batch',
+            'user_ids': sorted({event['user_id'] for event in events}),
+            'events': events,
+            'text': encode_json({
+                'type': 'block_batch',
+                'data': [event['data'] for event in events],
+            }),
+        })
+
+
+# room group name -> the batch collecting events for it in this process
+_batches = {}
+
+
+def add_block_event(room_group_name, channel_layer, user_id, message):
+    batch = _batches.get(room_group_name)
+
+    if batch is None:
+        batch = _batches[room_group_name] = BlockEventBatch(room_group_name, channel_layer)
+        # Keep a reference so the pending flush is not garbage-collected
+        batch.task = asyncio.create_task(_flush_later(batch))
+
+    batch.add(user_id, message)
+
+
+async def _flush_later(batch):
+    await asyncio.sleep(getattr(settings, 'BLOCK_EVENT_BATCH_WINDOW', DEFAULT_BLOCK_EVENT_BATCH_WINDOW))
+
+    # Events arriving from now on start the next batch
+    if _batches.get(batch.room_group_name) is batch:
+        del _batches[batch.room_group_name]
+
+    await batch.flush()
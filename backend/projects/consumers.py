@@ -1,9 +1,12 @@
 from utils.consumers import CustomAsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from utils.group_users import add_user_to_group, get_group_users, remove_user_from_group
+from asgiref.sync import sync_to_async
+from utils.group_users import PRESENCE_HEARTBEAT_INTERVAL, add_user_to_group, claim_group_leader, get_group_users, remove_user_from_group
 import asyncio
 from accounts.serializers import PublicUserSerializer
 from accounts.models import User
+from .autosave import autosave_scheduler
+from .block_events import add_block_event
 from .models import Project
 
 class ProjectConsumer(CustomAsyncWebsocketConsumer):
@@ -14,39 +17,50 @@ class ProjectConsumer(CustomAsyncWebsocketConsumer):
         except Project.DoesNotExist:
             return False
 
-    def setup_autosave(self):
-        group_users = get_group_users(self.room_group_name)
+    async def setup_autosave(self, is_leader=None):
+        '''
+        Only the connection holding the group's leader lease schedules the project with
+        this process's autosave scheduler. The lease is claimed on connect, when someone
+        leaves, and renewed by the presence heartbeat
+        '''
+        if is_leader is None:
+            is_leader = await sync_to_async(claim_group_leader, thread_sensitive=False)(self.room_group_name, self.channel_name)
 
-        if not hasattr(self, 'autosave_task') and group_users[0] == self.user.id:
-            self.autosave_interval = 30
-            self.autosave_task = asyncio.create_task(self.autosave_watchdog())
+        if is_leader:
+            autosave_scheduler.add(int(self.id), self.channel_name)
+        else:
+            self.clean_autosave()
 
-    async def autosave_watchdog(self):
+    def clean_autosave(self):
+        autosave_scheduler.discard(int(self.id), self.channel_name)
+
+    async def touch_presence(self):
+        return await sync_to_async(add_user_to_group, thread_sensitive=False)(self.room_group_name, self.user.id, self.channel_name)
+
+    async def presence_heartbeat(self):
+        # Keeps this connection's presence alive and takes over autosave if the leader went away without leaving
         try:
             while True:
-                await asyncio.sleep(self.autosave_interval)
-                await self.send_json({
-                    'type': 'project_autosave',
-                })
+                await asyncio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+                await self.setup_autosave(await self.touch_presence())
         except asyncio.CancelledError:
             pass
 
-    async def clean_autosave(self):
-        if hasattr(self, "autosave_task"):
-            self.autosave_task.cancel()
+    async def clean_presence(self):
+        if hasattr(self, "presence_task"):
+            self.presence_task.cancel()
 
             try:
-                await self.autosave_task
+                await self.presence_task
             except asyncio.CancelledError:
                 pass
 
+        await sync_to_async(remove_user_from_group, thread_sensitive=False)(self.room_group_name, self.user.id, self.channel_name)
+
     @database_sync_to_async
     def get_serialized_users(self):
         return PublicUserSerializer(User.objects.filter(id__in=get_group_users(self.room_group_name)), many=True).data
 
-    async def group_send(self, message):
-        await self.channel_layer.group_send(self.room_group_name, message)
-
     async def connect(self):
         self.id = self.scope['url_route']['kwargs']['id']
         self.room_group_name = f'project_{self.id}'
@@ -54,7 +68,8 @@ class ProjectConsumer(CustomAsyncWebsocketConsumer):
         if not await super().connect():
             return
 
-        add_user_to_group(self.room_group_name, self.user.id)
+        is_leader = await self.touch_presence()
+        self.presence_task = asyncio.create_task(self.presence_heartbeat())
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
@@ -63,12 +78,12 @@ class ProjectConsumer(CustomAsyncWebsocketConsumer):
         # Uncomment this to enforce client pinging every so often
         # self.setup_ping_enforcement()
 
-        self.setup_autosave()
+        await self.setup_autosave(is_leader)
 
-        await self.group_send({
+        await self.group_send_frame(self.room_group_name, 'user_connect', {
             'type': 'user_connect',
-            'user': PublicUserSerializer(self.user).data
-        })
+            'data': PublicUserSerializer(self.user).data,
+        }, user_id=self.user.id)
 
         users = await self.get_serialized_users()
 
@@ -83,15 +98,15 @@ class ProjectConsumer(CustomAsyncWebsocketConsumer):
         if not hasattr(self, 'room_group_name'):
             return
 
-        await self.clean_autosave()
+        self.clean_autosave()
 
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-        remove_user_from_group(self.room_group_name, self.user.id)
+        await self.clean_presence()
 
-        await self.group_send({
+        await self.group_send_frame(self.room_group_name, 'user_disconnect', {
             'type': 'user_disconnect',
-            'user_id': self.user.id,
+            'data': self.user.id,
         })
 
     async def receive(self, text_data):
@@ -101,31 +116,31 @@ class ProjectConsumer(CustomAsyncWebsocketConsumer):
             return
 
         if message['type'][:6] == 'block_':
-            await self.group_send({
-                'type': 'handle_block_event',
-                'user_id': self.user.id,
-                'data': message,
-            })
+            # Sent to the room in batches shared by every connection to it in this process
+            add_block_event(self.room_group_name, self.channel_layer, self.user.id, message)
 
     async def user_connect(self, event):
-        if self.user.id == event['user']['id']:
+        if self.user.id == event['user_id']:
             return
 
-        await self.send_json({
-            'type': 'user_connect',
-            'data': event['user'],
-        })
+        await self.forward_frame(event)
 
     async def user_disconnect(self, event):
-        self.setup_autosave()
+        # The lease is released on disconnect, so the next claim takes over autosave right away
+        await self.setup_autosave()
 
-        await self.send_json({
-            'type': 'user_disconnect',
-            'data': event['user_id'],
-        })
+        await self.forward_frame(event)
 
-    async def handle_block_event(self, event):
-        if self.user.id == event['user_id']:
+    async def handle_block_batch(self, event):
+        # The batch is serialized once by the sender; only users whose own events it holds need a filtered copy
+        if self.user.id not in event['user_ids']:
+            await self.forward_frame(event)
             return
 
-        await self.send_json(event['data'])
\ No newline at end of file
+        data = [block_event['data'] for block_event in event['events'] if block_event['user_id'] != self.user.id]
+
+        if data:
+            await self.send_json({
+                'type': 'block_batch',
+                'data': data,
+            })
\ No newline at end of file
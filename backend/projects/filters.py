@@ -30,6 +30,7 @@ class ProjectFilter(PrefixedFilterSet):
         'id',
         'created_at',
         'updated_at',
+        'fork_count',
         ('owner__username', 'owner'),
         *search_fields,
     ]
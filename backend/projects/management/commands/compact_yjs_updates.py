@@ -0,0 +1,57 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from projects.models import Project
+
+DEFAULT_MIN_UPDATES = 20
+
+class Command(BaseCommand):
+    help = "Merge incremental Yjs updates back into Project.yjs_blob."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-updates",
+            type=int,
+            default=DEFAULT_MIN_UPDATES,
+            help="Only compact projects with at least this many pending updates.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=0,
+            help="Repeat every N seconds instead of running once.",
+        )
+
+    def handle(self, *args, **options):
+        min_updates = max(1, options["min_updates"])
+        interval = options["interval"]
+
+        while True:
+            try:
+                self.compact(min_updates)
+
+                if interval <= 0:
+                    break
+
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                break
+
+    def compact(self, min_updates: int) -> None:
+        projects = (
+            Project.objects.annotate(update_count=Count("yjs_updates"))
+            .filter(update_count__gte=min_updates)
+            .only("id")
+        )
+
+        compacted_projects = 0
+        compacted_updates = 0
+
+        for project in projects.iterator():
+            count = project.compact_yjs_updates()
+
+            if count:
+                compacted_projects += 1
+                compacted_updates += count
+
+        self.stdout.write(f"Compacted {compacted_updates} update(s) across {compacted_projects} project(s).")
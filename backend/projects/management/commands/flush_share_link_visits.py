@@ -0,0 +1,101 @@
+import time
+from collections import deque
+from django.core.management.base import BaseCommand
+from utils.redis_client import get_redis_client
+from projects.models import ProjectShareLink
+
+redis_client = get_redis_client("cache")
+
+DEFAULT_BATCH_SIZE = 500
+
+class Command(BaseCommand):
+    help = "Move share-link visit counts recorded in Redis into ProjectShareLink.total_visits/unique_visits."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="Number of share links to take from the dirty set at a time.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=0,
+            help="Repeat every N seconds instead of running once.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options["batch_size"])
+        interval = options["interval"]
+
+        while True:
+            try:
+                self.flush(batch_size)
+            except KeyboardInterrupt:
+                break
+            except Exception as exc:
+                if interval <= 0:
+                    raise
+                # Keep repeating through e.g. a Redis outage; the next run retries
+                self.stderr.write(f"Failed to flush share link visits: {exc}")
+
+            if interval <= 0:
+                break
+
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                break
+
+    def flush(self, batch_size: int) -> None:
+        flushed_links = 0
+        flushed_visits = 0
+        failed_ids = []
+        share_link_ids = deque()
+
+        try:
+            while raw_ids := redis_client.spop(ProjectShareLink.VISITS_DIRTY_KEY, batch_size):
+                share_link_ids = deque(int(raw_id) for raw_id in raw_ids)
+
+                while share_link_ids:
+                    share_link_id = share_link_ids[0]
+
+                    try:
+                        flushed_visits += self.flush_share_link(share_link_id)
+                        flushed_links += 1
+                    except Exception as exc:
+                        self.stderr.write(f"Failed to flush visits of share link {share_link_id}: {exc}")
+                        failed_ids.append(share_link_id)
+
+                    share_link_ids.popleft()
+        finally:
+            # Failed links are marked dirty again only now so this flush does not pop
+            # them again; links popped but not reached (on interrupt) go back as well
+            if unflushed_ids := [*failed_ids, *share_link_ids]:
+                redis_client.sadd(ProjectShareLink.VISITS_DIRTY_KEY, *unflushed_ids)
+
+        self.stdout.write(f"Flushed {flushed_visits} visit(s) across {flushed_links} share link(s).")
+
+        if failed_ids:
+            self.stderr.write(f"Failed to flush {len(failed_ids)} share link(s), left for the next flush.")
+
+    def flush_share_link(self, share_link_id: int) -> int:
+        visits_key = f"{ProjectShareLink.VISITS_KEY_PREFIX}:{share_link_id}"
+
+        # GETDEL hands the pending total to exactly one flusher; visits arriving
+        # afterwards start a new pending total and mark the link dirty again
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.getdel(visits_key)
+        pipe.pfcount(f"{ProjectShareLink.VISITORS_KEY_PREFIX}:{share_link_id}")
+        visits, unique_visitors = pipe.execute()
+        visits = int(visits or 0)
+
+        try:
+            ProjectShareLink.apply_visit_counts(share_link_id, visits, unique_visitors)
+        except Exception:
+            # Give the total back; flush() marks the link dirty again for the next flush
+            redis_client.incrby(visits_key, visits)
+            raise
+
+        return visits
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from projects.models import Project, Snapshot
+
+DEFAULT_BATCH_SIZE = 100
+
+class Command(BaseCommand):
+    help = "Rewrite stored Yjs blobs with the current CompressedBinaryField format."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="Number of rows to load per database round trip.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options["batch_size"])
+
+        for model in [Project, Snapshot]:
+            count = self.recompress(model, batch_size)
+            self.stdout.write(f"Recompressed {count} {model._meta.verbose_name_plural}.")
+
+    def recompress(self, model, batch_size: int) -> int:
+        count = 0
+        pks = model.objects.exclude(yjs_blob=None).values_list("id", flat=True)
+
+        for pk in pks.iterator(chunk_size=batch_size):
+            # The blob is re-read under a row lock so a compaction committing meanwhile is
+            # not overwritten with the stale blob.
+            with transaction.atomic():
+                blob = model.objects.select_for_update().filter(pk=pk).values_list("yjs_blob", flat=True).first()
+
+                if blob is None:
+                    continue
+
+                # Reading decoded the old format; writing re-encodes with the current one.
+                # A queryset update keeps updated_at and the save signals out of it.
+                model.objects.filter(pk=pk).update(yjs_blob=blob)
+
+            count += 1
+
+        return count
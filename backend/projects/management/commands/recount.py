@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from organizations.models import Organization, organization_count_expressions
+from projects.models import Project, project_count_expressions
+
+class Command(BaseCommand):
+    help = "Repair drift in the denormalized Project and Organization counter columns."
+
+    def handle(self, *args, **options):
+        for model, expressions in [
+            (Project, project_count_expressions()),
+            (Organization, organization_count_expressions()),
+        ]:
+            for field, expression in expressions.items():
+                # Only rows that drifted are rewritten; a queryset update skips save() and its signals
+                count = model.objects.exclude(**{field: expression}).update(**{field: expression})
+                self.stdout.write(f"Fixed {field} on {count} {model._meta.verbose_name_plural}.")
@@ -1,53 +1,525 @@
 import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
 from django.core.management.base import BaseCommand
-from utils.redis_client import redis_client, safe_publish
-from projects.models import Project
+from django.db import InterfaceError, OperationalError, connections, transaction
+from django.utils import timezone
+from utils.redis_client import get_redis_client
+from utils.yjs import YJS_AVAILABLE, diff_update, get_state_vector, merge_state_vectors
+from projects.models import Project, ProjectYjsUpdate
+
+redis_client = get_redis_client("queue")
 
 PROJECT_SAVED_CHANNEL = "yjs:project_saved"
+UPDATES_QUEUE_KEY = "yjs:updates_queue"
 UPDATES_PENDING_SET_KEY = "yjs:updates_pending"
+BUFFER_KEY_PREFIX = "yjs:buffer"
+INFLIGHT_KEY_PREFIX = "yjs:inflight"
+LEASE_KEY_PREFIX = "yjs:lease"
+PROCESSING_KEY_PREFIX = "yjs:processing"
+HEARTBEAT_KEY_PREFIX = "yjs:worker"
+DEAD_LETTER_KEY_PREFIX = "yjs:dead"
+PERSIST_FAILURES_KEY = "yjs:persist_failures"
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_RECONCILE_INTERVAL = 60
+QUEUE_POP_TIMEOUT = 3
+
+# A lease must outlive the slowest persist of a batch; it expires on its own
+# if the owning worker dies so the project is never blocked forever.
+LEASE_TTL_MS = 60_000
+
+# A worker whose heartbeat has expired is considered dead and its processing
+# list is handed back to the queue by the reconciler.
+HEARTBEAT_TTL_SECONDS = 30
+
+# How long to back off when every popped id is leased by another worker, so
+# re-queued ids don't spin between workers while the owner is still saving.
+CONTENDED_BACKOFF_SECONDS = 0.1
+
+# A project whose document fails to persist this many times in a row is
+# dead-lettered so it stops being retried (and holding back its batches).
+MAX_PERSIST_ATTEMPTS = 3
+
+# Errors that say nothing about the document itself; a batch failing with one
+# of these is re-queued as a whole without counting against its projects.
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+# Only delete a lease if it is still ours (it may have expired and been re-taken).
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Move the buffer aside to its in-flight key and clear the pending-set entry in
+# one step. Any store that lands after this re-queues the project, and the
+# in-flight copy survives a crash until it is acknowledged or recovered.
+# KEYS: buffer, inflight, pending set. ARGV: project id.
+CLAIM_BUFFER_SCRIPT = """
+local data = redis.call('hgetall', KEYS[1])
+if #data > 0 then
+    redis.call('rename', KEYS[1], KEYS[2])
+end
+redis.call('srem', KEYS[3], ARGV[1])
+return data
+"""
+
+# Hand an unacknowledged project back to the queue. An in-flight copy is only
+# restored when no newer buffer has been stored since (buffers are full states).
+# KEYS: processing list, inflight, buffer, pending set, queue. ARGV: project id.
+RESTORE_PROJECT_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 1 then
+    if redis.call('exists', KEYS[3]) == 0 then
+        redis.call('rename', KEYS[2], KEYS[3])
+    else
+        redis.call('del', KEYS[2])
+    end
+end
+redis.call('lrem', KEYS[1], 0, ARGV[1])
+if redis.call('exists', KEYS[3]) == 1 then
+    redis.call('sadd', KEYS[4], ARGV[1])
+    if not redis.call('lpos', KEYS[5], ARGV[1]) then
+        redis.call('rpush', KEYS[5], ARGV[1])
+    end
+else
+    redis.call('srem', KEYS[4], ARGV[1])
+end
+"""
+
+# Set an undeliverable project aside: keep its in-flight state for inspection,
+# and drop it from the processing list and the failure counts.
+# KEYS: inflight, dead letter, processing list, failures hash. ARGV: project id.
+DEAD_LETTER_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('rename', KEYS[1], KEYS[2])
+end
+redis.call('lrem', KEYS[3], 0, ARGV[1])
+redis.call('hdel', KEYS[4], ARGV[1])
+"""
+
+def get_buffer_key(project_id: str) -> str:
+    return f"{BUFFER_KEY_PREFIX}:{project_id}"
+
+def get_inflight_key(project_id: str) -> str:
+    return f"{INFLIGHT_KEY_PREFIX}:{project_id}"
+
+def get_lease_key(project_id: str) -> str:
+    return f"{LEASE_KEY_PREFIX}:{project_id}"
+
+def get_processing_key(worker_id: str) -> str:
+    return f"{PROCESSING_KEY_PREFIX}:{worker_id}"
+
+def get_heartbeat_key(worker_id: str) -> str:
+    return f"{HEARTBEAT_KEY_PREFIX}:{worker_id}"
+
+def get_dead_letter_key(project_id: str) -> str:
+    return f"{DEAD_LETTER_KEY_PREFIX}:{project_id}"
 
 class Command(BaseCommand):
+    help = "Persist Yjs documents buffered in Redis by the Hocuspocus server."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="Maximum number of queued projects to persist per cycle.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes to run in parallel.",
+        )
+        parser.add_argument(
+            "--reconcile-interval",
+            type=int,
+            default=DEFAULT_RECONCILE_INTERVAL,
+            help="Seconds between scans for projects orphaned by dead workers.",
+        )
+
     def handle(self, *args, **options):
-        self.stdout.write("Yjs-Django Sync Worker started...")
+        batch_size = max(1, options["batch_size"])
+        workers = max(1, options["workers"])
+        self.reconcile_interval = max(1, options["reconcile_interval"])
+
+        self.register_scripts()
+
+        self.stdout.write(f"Yjs-Django Sync Worker started ({workers} worker(s), batch size {batch_size})...")
+
+        # Recover anything left behind by workers that died before this start.
+        self.reconcile()
+
+        if workers == 1:
+            self.run_worker(batch_size)
+        else:
+            self.run_pool(workers, batch_size)
 
-        while True:
+    def register_scripts(self) -> None:
+        self.release_lease = redis_client.register_script(RELEASE_LEASE_SCRIPT)
+        self.claim_buffer = redis_client.register_script(CLAIM_BUFFER_SCRIPT)
+        self.restore_project = redis_client.register_script(RESTORE_PROJECT_SCRIPT)
+        self.dead_letter = redis_client.register_script(DEAD_LETTER_SCRIPT)
+
+    def run_pool(self, workers: int, batch_size: int) -> None:
+        """
+        Fork one process per worker and forward SIGTERM/SIGINT to them so each
+        finishes its current batch before exiting.
+        """
+        # Forked children must not share the parent's database connections.
+        connections.close_all()
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=self.run_worker, args=(batch_size,)) for _ in range(workers)]
+
+        for process in processes:
+            process.start()
+
+        def forward_signal(signum, _frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, forward_signal)
+        signal.signal(signal.SIGINT, forward_signal)
+
+        for process in processes:
+            process.join()
+
+    def run_worker(self, batch_size: int) -> None:
+        self.worker_token = uuid.uuid4().hex
+        # The token makes the id unique per run, so a restarted worker that
+        # reuses a pid never adopts the processing list of its predecessor
+        # while that one's heartbeat has not expired yet.
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{self.worker_token[:8]}"
+        self.processing_key = get_processing_key(self.worker_id)
+        self.stopping = False
+        last_reconciled_at = time.monotonic()
+
+        def request_stop(signum, _frame):
+            # Finish (drain) the batch in progress, then exit the loop.
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        while not self.stopping:
+            self.heartbeat()
+
+            if time.monotonic() - last_reconciled_at >= self.reconcile_interval:
+                self.reconcile()
+                last_reconciled_at = time.monotonic()
+
+            project_ids = self.drain_queue(batch_size)
+
+            if not project_ids:
+                continue
+
+            claimed_ids = self.claim_leases(project_ids)
+
+            if not claimed_ids:
+                time.sleep(CONTENDED_BACKOFF_SECONDS)
+                continue
+
+            # Leases are released only once every claimed id has been
+            # acknowledged or restored, so no other worker can pick an id up
+            # while it is still in flight here.
             try:
-                result = redis_client.blpop("yjs:updates_queue", timeout=3)
-
-                if not result:
-                    continue
-
-                id = result[1].decode()
-                data = redis_client.hgetall(f"yjs:buffer:{id}")
-
-                if data:
-                    saved_ok = False
-                    try:
-                        project = Project.objects.get(id=id)
-                        project.yjs_blob = data[b"blob"]
-
-                        project_name = data[b"name"] if b"name" in data else None
-                        if project_name:
-                            decoded_name = project_name.decode("utf-8")
-                            project.name = decoded_name
-
-                        # Mark this save as originating from Yjs so the signals
-                        # layer can skip broadcasting it back to Hocuspocus.
-                        project._skip_hocuspocus_notify = True
-                        project.save()
-                        saved_ok = True
-                    except Project.DoesNotExist:
-                        pass
-
-                    # Always clear buffer after handling to avoid stale replays; publish "saved" only on success.
-                    redis_client.delete(f"yjs:buffer:{id}")
-
-                    # Allow future queueing for this project id.
-                    redis_client.srem(UPDATES_PENDING_SET_KEY, id)
-                    if saved_ok:
-                        safe_publish(
-                            PROJECT_SAVED_CHANNEL,
-                            json.dumps({"project_id": int(id)}),
-                        )
-            except KeyboardInterrupt:
-                break
+                buffers = self.claim_buffers(claimed_ids)
+                saved_ids, failures = self.persist(buffers)
+            except Exception as exc:
+                self.stderr.write(f"Failed to persist projects {claimed_ids}, re-queueing: {exc}")
+                self.restore_projects(self.processing_key, claimed_ids)
+                self.release_leases(claimed_ids)
+                continue
+
+            if failures:
+                self.handle_failures(failures)
+
+            self.acknowledge([project_id for project_id in claimed_ids if project_id not in failures])
+            self.release_leases(claimed_ids)
+            self.publish_saved(saved_ids)
+
+        redis_client.delete(get_heartbeat_key(self.worker_id))
+        self.stdout.write("Yjs-Django Sync Worker stopped.")
+
+    def heartbeat(self) -> None:
+        redis_client.set(get_heartbeat_key(self.worker_id), self.worker_token, ex=HEARTBEAT_TTL_SECONDS)
+
+    def drain_queue(self, batch_size: int) -> list[str]:
+        """
+        Block until at least one project id is queued, then move up to
+        batch_size - 1 more without blocking. Ids are moved (not popped) into
+        this worker's processing list so they survive a crash until
+        acknowledged. Duplicates are collapsed.
+        """
+        first_id = redis_client.blmove(UPDATES_QUEUE_KEY, self.processing_key, QUEUE_POP_TIMEOUT, "LEFT", "LEFT")
+
+        if not first_id:
+            return []
+
+        raw_ids = [first_id]
+        if batch_size > 1:
+            pipe = redis_client.pipeline(transaction=False)
+            for _ in range(batch_size - 1):
+                pipe.lmove(UPDATES_QUEUE_KEY, self.processing_key, "LEFT", "LEFT")
+            raw_ids.extend(raw_id for raw_id in pipe.execute() if raw_id)
+
+        return list(dict.fromkeys(raw_id.decode() for raw_id in raw_ids))
+
+    def claim_leases(self, project_ids: list[str]) -> list[str]:
+        """
+        Take ownership of each project for the duration of this batch. Ids
+        leased by another worker are moved back to the queue so they are
+        persisted after the current owner finishes, never concurrently.
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in project_ids:
+            pipe.set(get_lease_key(project_id), self.worker_token, nx=True, px=LEASE_TTL_MS)
+
+        claimed_ids = []
+        contended_ids = []
+        for project_id, acquired in zip(project_ids, pipe.execute()):
+            (claimed_ids if acquired else contended_ids).append(project_id)
+
+        if contended_ids:
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.rpush(UPDATES_QUEUE_KEY, *contended_ids)
+            for project_id in contended_ids:
+                pipe.lrem(self.processing_key, 0, project_id)
+            pipe.execute()
+
+        return claimed_ids
+
+    def release_leases(self, project_ids: list[str]) -> None:
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in project_ids:
+            self.release_lease(keys=[get_lease_key(project_id)], args=[self.worker_token], client=pipe)
+        pipe.execute()
+
+    def claim_buffers(self, project_ids: list[str]) -> dict[str, dict[bytes, bytes]]:
+        """
+        Move every buffered document for the given ids to its in-flight key
+        and clear their pending-set entries. Ids without a buffer are left out
+        of the result.
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in project_ids:
+            self.claim_buffer(
+                keys=[get_buffer_key(project_id), get_inflight_key(project_id), UPDATES_PENDING_SET_KEY],
+                args=[project_id],
+                client=pipe,
+            )
+
+        buffers = {}
+        for project_id, flat in zip(project_ids, pipe.execute()):
+            if flat:
+                buffers[project_id] = dict(zip(flat[0::2], flat[1::2]))
+
+        return buffers
+
+    def persist(self, buffers: dict[str, dict[bytes, bytes]]) -> tuple[list[str], dict[str, Exception]]:
+        """
+        Persist the batch in one transaction. If that fails, persist each
+        project in its own savepoint instead, so one document that cannot be
+        saved does not hold back the rest. Returns the saved ids and the
+        errors of the projects that failed on their own. Transient database
+        errors are raised so the whole batch is re-queued.
+        """
+        try:
+            return self.persist_buffers(buffers), {}
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as exc:
+            self.stderr.write(f"Failed to persist batch of {len(buffers)} project(s), retrying one by one: {exc}")
+
+        saved_ids = []
+        failures = {}
+
+        with transaction.atomic():
+            for project_id, data in buffers.items():
+                try:
+                    # Nested in the outer transaction, persist_buffers' atomic block is a savepoint
+                    saved_ids.extend(self.persist_buffers({project_id: data}))
+                except TRANSIENT_ERRORS:
+                    raise
+                except Exception as exc:
+                    failures[project_id] = exc
+
+        return saved_ids, failures
+
+    def handle_failures(self, failures: dict[str, Exception]) -> None:
+        """
+        Count a failed attempt for each project. Projects that have failed
+        MAX_PERSIST_ATTEMPTS times are dead-lettered (their state is kept under
+        get_dead_letter_key()); the others are re-queued.
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in failures:
+            pipe.hincrby(PERSIST_FAILURES_KEY, project_id, 1)
+        attempts = dict(zip(failures, pipe.execute()))
+
+        retry_ids = [project_id for project_id in failures if attempts[project_id] < MAX_PERSIST_ATTEMPTS]
+        dead_ids = [project_id for project_id in failures if attempts[project_id] >= MAX_PERSIST_ATTEMPTS]
+
+        for project_id in retry_ids:
+            self.stderr.write(f"Failed to persist project {project_id} (attempt {attempts[project_id]}), re-queueing: {failures[project_id]}")
+
+        if retry_ids:
+            self.restore_projects(self.processing_key, retry_ids)
+
+        if not dead_ids:
+            return
+
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in dead_ids:
+            self.stderr.write(
+                f"Giving up on project {project_id} after {attempts[project_id]} attempts, "
+                f"state kept in {get_dead_letter_key(project_id)}: {failures[project_id]}"
+            )
+            self.dead_letter(
+                keys=[get_inflight_key(project_id), get_dead_letter_key(project_id), self.processing_key, PERSIST_FAILURES_KEY],
+                args=[project_id],
+                client=pipe,
+            )
+        pipe.execute()
+
+    def persist_buffers(self, buffers: dict[str, dict[bytes, bytes]]) -> list[str]:
+        """
+        Write all buffered documents to their projects in a single transaction
+        and return the ids that were saved. Each document is appended as an
+        incremental ProjectYjsUpdate holding only what is not persisted yet
+        (compact_yjs_updates folds them back into yjs_blob); without Yjs
+        tooling the full state overwrites yjs_blob instead. bulk_update()
+        bypasses the model signals, which is what we want: these changes
+        originate from Yjs and must not be broadcast back to Hocuspocus.
+        """
+        pks = {int(project_id): project_id for project_id in buffers if project_id.isdigit()}
+        if not pks:
+            return []
+
+        now = timezone.now()
+        updates = []
+
+        with transaction.atomic():
+            projects = (
+                Project.objects.select_for_update()
+                .only("id", "name", "yjs_seq", "yjs_state_vector")
+                .in_bulk(list(pks))
+            )
+
+            for pk, project in projects.items():
+                data = buffers[pks[pk]]
+                state = data[b"blob"]
+
+                if YJS_AVAILABLE:
+                    project.yjs_seq += 1
+                    updates.append(ProjectYjsUpdate(
+                        project=project,
+                        seq=project.yjs_seq,
+                        update=diff_update(state, project.yjs_state_vector),
+                    ))
+                    project.yjs_state_vector = merge_state_vectors(project.yjs_state_vector, get_state_vector(state))
+                else:
+                    project.yjs_blob = state
+
+                project_name = data.get(b"name")
+                if project_name:
+                    project.name = project_name.decode("utf-8")
+
+                # bulk_update() skips auto_now, so keep updated_at in step manually.
+                project.updated_at = now
+
+            state_fields = ["yjs_seq", "yjs_state_vector"] if YJS_AVAILABLE else ["yjs_blob"]
+
+            ProjectYjsUpdate.objects.bulk_create(updates)
+            Project.objects.bulk_update(projects.values(), [*state_fields, "name", "updated_at"])
+
+        return [pks[pk] for pk in projects]
+
+    def acknowledge(self, project_ids: list[str]) -> None:
+        """
+        Drop the in-flight copies, processing-list entries and failure counts
+        of a persisted batch in one round trip.
+        """
+        if not project_ids:
+            return
+
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in project_ids:
+            pipe.delete(get_inflight_key(project_id))
+            pipe.lrem(self.processing_key, 0, project_id)
+        pipe.hdel(PERSIST_FAILURES_KEY, *project_ids)
+        pipe.execute()
+
+    def publish_saved(self, saved_ids: list[str]) -> None:
+        if not saved_ids:
+            return
+
+        # Hocuspocus listens on the pubsub client, which may not be the queue's Redis
+        pipe = get_redis_client("pubsub").pipeline(transaction=False)
+        for project_id in saved_ids:
+            pipe.publish(PROJECT_SAVED_CHANNEL, json.dumps({"project_id": int(project_id)}))
+
+        try:
+            pipe.execute()
+        except Exception as exc:
+            self.stderr.write(f"Failed to publish saved projects {saved_ids}: {exc}")
+
+    def restore_projects(self, processing_key: str, project_ids: list[str]) -> None:
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in project_ids:
+            self.restore_project(
+                keys=[
+                    processing_key,
+                    get_inflight_key(project_id),
+                    get_buffer_key(project_id),
+                    UPDATES_PENDING_SET_KEY,
+                    UPDATES_QUEUE_KEY,
+                ],
+                args=[project_id],
+                client=pipe,
+            )
+        pipe.execute()
+
+    def reconcile(self) -> None:
+        """
+        Re-queue work that no live worker owns: the processing lists of workers
+        whose heartbeat expired, and pending ids that are in no list at all
+        (e.g. left behind by a crash between popping and clearing the set).
+        """
+        queued_ids = set()
+
+        for processing_key in redis_client.scan_iter(match=f"{PROCESSING_KEY_PREFIX}:*"):
+            processing_key = processing_key.decode()
+            worker_id = processing_key[len(PROCESSING_KEY_PREFIX) + 1:]
+            project_ids = [raw_id.decode() for raw_id in redis_client.lrange(processing_key, 0, -1)]
+
+            if redis_client.exists(get_heartbeat_key(worker_id)):
+                queued_ids.update(project_ids)
+                continue
+
+            if project_ids:
+                self.stdout.write(f"Recovering {len(project_ids)} project(s) from dead worker {worker_id}.")
+                self.restore_projects(processing_key, list(dict.fromkeys(project_ids)))
+
+            redis_client.delete(processing_key)
+
+        queued_ids.update(raw_id.decode() for raw_id in redis_client.lrange(UPDATES_QUEUE_KEY, 0, -1))
+
+        orphaned_ids = [
+            raw_id.decode()
+            for raw_id in redis_client.smembers(UPDATES_PENDING_SET_KEY)
+            if raw_id.decode() not in queued_ids
+        ]
+
+        if orphaned_ids:
+            self.stdout.write(f"Re-queueing {len(orphaned_ids)} orphaned pending project(s).")
+            # No processing list holds these ids; the empty key makes LREM a no-op.
+            self.restore_projects(get_processing_key("orphaned"), orphaned_ids)
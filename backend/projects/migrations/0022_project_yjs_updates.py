@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0021_project_default_share_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='yjs_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='yjs_state_vector',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ProjectYjsUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('update', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='yjs_updates', to='projects.project')),
+            ],
+            options={
+                'ordering': ['seq'],
+                'unique_together': {('project', 'seq')},
+            },
+        ),
+    ]
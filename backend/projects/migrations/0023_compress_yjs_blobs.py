@@ -0,0 +1,44 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:09
+
+import utils.fields
+from django.db import migrations
+
+STATE_MODELS = ['Project', 'ProjectShareLink']
+
+
+def compress_existing_blobs(apps, schema_editor):
+    # Runs while yjs_blob is still a plain BinaryField, so raw bytes are read and written as-is
+    for model_name in STATE_MODELS:
+        Model = apps.get_model('projects', model_name)
+
+        for pk, blob in Model.objects.exclude(yjs_blob=None).values_list('id', 'yjs_blob').iterator(chunk_size=100):
+            Model.objects.filter(pk=pk).update(yjs_blob=utils.fields.compress_bytes(bytes(blob)))
+
+
+def decompress_existing_blobs(apps, schema_editor):
+    for model_name in STATE_MODELS:
+        Model = apps.get_model('projects', model_name)
+
+        for pk, blob in Model.objects.exclude(yjs_blob=None).values_list('id', 'yjs_blob').iterator(chunk_size=100):
+            Model.objects.filter(pk=pk).update(yjs_blob=utils.fields.decompress_bytes(bytes(blob)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0022_project_yjs_updates'),
+    ]
+
+    operations = [
+        migrations.RunPython(compress_existing_blobs, decompress_existing_blobs),
+        migrations.AlterField(
+            model_name='project',
+            name='yjs_blob',
+            field=utils.fields.CompressedBinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='projectsharelink',
+            name='yjs_blob',
+            field=utils.fields.CompressedBinaryField(blank=True, null=True),
+        ),
+    ]
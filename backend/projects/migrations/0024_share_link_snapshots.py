@@ -0,0 +1,55 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:10
+
+import django.db.models.deletion
+import hashlib
+import utils.fields
+from django.db import migrations, models
+
+
+def move_blobs_to_snapshots(apps, schema_editor):
+    ProjectShareLink = apps.get_model('projects', 'ProjectShareLink')
+    Snapshot = apps.get_model('projects', 'Snapshot')
+
+    for share_link in ProjectShareLink.objects.exclude(yjs_blob=None).only('id', 'yjs_blob').iterator(chunk_size=100):
+        state = bytes(share_link.yjs_blob)
+        snapshot, _created = Snapshot.objects.get_or_create(
+            hash=hashlib.sha256(state).hexdigest(),
+            defaults={'yjs_blob': state},
+        )
+        ProjectShareLink.objects.filter(pk=share_link.pk).update(snapshot=snapshot)
+
+
+def move_snapshots_to_blobs(apps, schema_editor):
+    ProjectShareLink = apps.get_model('projects', 'ProjectShareLink')
+
+    for share_link in ProjectShareLink.objects.exclude(snapshot=None).select_related('snapshot').iterator(chunk_size=100):
+        ProjectShareLink.objects.filter(pk=share_link.pk).update(yjs_blob=share_link.snapshot.yjs_blob)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0023_compress_yjs_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Snapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('yjs_blob', utils.fields.CompressedBinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='projectsharelink',
+            name='snapshot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='share_links', to='projects.snapshot'),
+        ),
+        migrations.RunPython(move_blobs_to_snapshots, move_snapshots_to_blobs),
+        migrations.RemoveField(
+            model_name='projectsharelink',
+            name='yjs_blob',
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:31
+
+from django.db import migrations, models
+from django.db.models import OuterRef
+from utils.aggregates import SubqueryCount
+
+
+def backfill_counters(apps, schema_editor):
+    Project = apps.get_model('projects', 'Project')
+    Asset = apps.get_model('projects', 'Asset')
+
+    Project.objects.update(
+        fork_count=SubqueryCount(Project.forked_by.through.objects.filter(project=OuterRef('pk'))),
+        asset_count=SubqueryCount(Asset.objects.filter(project=OuterRef('pk'))),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0024_share_link_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='asset_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='fork_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
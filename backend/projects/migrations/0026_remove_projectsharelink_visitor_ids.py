@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:33
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0025_project_counters'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='projectsharelink',
+            name='visitor_ids',
+        ),
+    ]
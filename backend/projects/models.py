@@ -1,10 +1,23 @@
-from django.db.models import Model, ImageField, ForeignKey, CASCADE, DateTimeField, CharField, TextField, SET_NULL, ManyToManyField, BinaryField, IntegerField
+from django.db import transaction
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models import Model, QuerySet, F, Case, When, Value, OuterRef, Subquery, ImageField, ForeignKey, CASCADE, PROTECT, DateTimeField, CharField, TextField, SET_NULL, ManyToManyField, BinaryField, IntegerField, PositiveIntegerField
+from django.utils import timezone
 from accounts.models import User
 from organizations.models import Organization
-from utils.permissions import create_permissions_allowed_hierarchy
+from utils.fields import CompressedBinaryField
+from utils import permission_cache
+from utils.aggregates import SubqueryCount
+from utils.mixins import CounterFieldsMixin, FieldTrackerMixin
+from utils.redis_client import get_redis_client
+from utils.yjs import YJS_AVAILABLE, diff_update, get_state_vector, merge_state_vectors, merge_updates
+import hashlib
+import logging
 import random
 import string
 
+logger = logging.getLogger(__name__)
+redis_client = get_redis_client('cache')
+
 def project_thumbnail_path(_instance, filename):
     characters = string.ascii_letters + string.digits
     random_string = ''.join(random.choices(characters, k=20))
@@ -21,14 +34,94 @@ class ProjectGroup(Model):
     updated_at = DateTimeField(auto_now=True)
     name = CharField(max_length=200)
 
-class Project(Model):
+def permission_choice_rank():
+    '''
+    Expression mapping a row's permission choice to its rank in Project.PERMISSION_RANKS
+    '''
+    return Case(
+        *[When(permission=permission, then=Value(rank)) for permission, rank in Project.PERMISSION_RANKS.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+def project_permission_rank(user : User, project_field : str = 'pk', owner_field : str = 'owner'):
+    '''
+    Expression computing the user's effective permission on a project as a rank
+    (see Project.PERMISSION_RANKS), so it can be annotated onto any queryset that
+    references projects. 0 means no permission.
+    '''
+    if user is None or not user.is_authenticated:
+        return Value(0, output_field=IntegerField())
+
+    rank = permission_choice_rank()
+    collaborator_rank = ProjectCollaborator.objects.filter(
+        project=OuterRef(project_field),
+        collaborator=user,
+    ).annotate(rank=rank).values('rank')[:1]
+    organization_rank = OrganizationProject.objects.filter(
+        project=OuterRef(project_field),
+        organization__members=user,
+    ).annotate(rank=rank).order_by('-rank').values('rank')[:1]
+
+    return Case(
+        When(**{owner_field: user}, then=Value(Project.OWNER_RANK)),
+        default=Greatest(
+            Coalesce(Subquery(collaborator_rank), Value(0)),
+            Coalesce(Subquery(organization_rank), Value(0)),
+        ),
+        output_field=IntegerField(),
+    )
+
+def project_count_expressions() -> dict:
+    '''
+    The true values of Project's counter columns as correlated subqueries, used to
+    repair drift (see the recount command)
+    '''
+    return {
+        'fork_count': SubqueryCount(Project.forked_by.through.objects.filter(project=OuterRef('pk'))),
+        'asset_count': SubqueryCount(Asset.objects.filter(project=OuterRef('pk'))),
+    }
+
+class ProjectQuerySet(QuerySet):
+    def without_state(self):
+        '''
+        Skip loading the (potentially megabytes large) Yjs state columns.
+        Accessing them later still works but costs an extra query per row.
+        '''
+        return self.defer(*Project.DEFERRED_FIELDS)
+
+    def with_permission(self, user : User):
+        '''
+        Annotate the user's effective permission on every project in the same query,
+        which get_permission() and has_permission() then use instead of querying
+        '''
+        return self.annotate(
+            permission_rank=project_permission_rank(user),
+            permission_user_id=Value(user.pk if user is not None else None, output_field=IntegerField()),
+        )
+
+class Project(FieldTrackerMixin, CounterFieldsMixin, Model):
     PERMISSION_CHOICES = [
         ('view', 'Can view'),
         ('code', 'Can modify code'),
         ('invite', 'Can invite and code'),
         ('admin', 'Can change project details'),
     ]
+    # Higher ranks include every permission below them; the owner outranks all choices
+    PERMISSION_RANKS = {choice: rank for rank, (choice, _) in enumerate(PERMISSION_CHOICES, start=1)}
+    OWNER_RANK = len(PERMISSION_CHOICES) + 1
     PROJECT_STATE_FIELDS = ['yjs_blob']
+    # Columns left out of every query that does not need the document state
+    DEFERRED_FIELDS = [*PROJECT_STATE_FIELDS, 'yjs_state_vector']
+    # Only written under a row lock by append_yjs_state/compact_yjs_updates (and the sync
+    # worker), never by a regular save() that could write back a stale copy
+    LOCKED_STATE_FIELDS = [*DEFERRED_FIELDS, 'yjs_seq']
+    # Fields whose changes the Project signals react to (see FieldTrackerMixin)
+    TRACKED_FIELDS = ['name', 'thumbnail', 'yjs_blob', 'default_share_link']
+    # Denormalized counts, only ever changed with F() expressions (see CounterFieldsMixin)
+    COUNTER_FIELDS = ['fork_count', 'asset_count']
+    # Namespace of the rendered detail responses in utils/response_cache.py
+    RESPONSE_CACHE_NAMESPACE = 'project:detail'
 
     owner = ForeignKey(User, related_name='projects', on_delete=CASCADE)
     group = ForeignKey(ProjectGroup, related_name='projects', null=True, blank=True, on_delete=SET_NULL)
@@ -41,7 +134,13 @@ class Project(Model):
     published_at = DateTimeField(null=True, blank=True)
     forked_by = ManyToManyField(User, related_name='forked_projects', blank=True)
     thumbnail = ImageField(upload_to=project_thumbnail_path, blank=True, null=True)
-    yjs_blob = BinaryField(null=True, blank=True)
+    yjs_blob = CompressedBinaryField(null=True, blank=True)
+    # State vector covering yjs_blob plus all appended updates, and the sequence
+    # number of the last appended ProjectYjsUpdate.
+    yjs_state_vector = BinaryField(null=True, blank=True)
+    yjs_seq = PositiveIntegerField(default=0)
+    fork_count = PositiveIntegerField(default=0, db_index=True)
+    asset_count = PositiveIntegerField(default=0)
     default_share_link = ForeignKey(
         'ProjectShareLink',
         related_name='default_for_projects',
@@ -50,22 +149,49 @@ class Project(Model):
         on_delete=SET_NULL,
     )
 
+    objects = ProjectQuerySet.as_manager()
+
     def has_permission(self, user, required_permission, published_gives_permission=True):
-        if user == self.owner:
+        if user.pk is not None and user.pk == self.owner_id:
+            return True
+        if published_gives_permission and self.published_at is not None:
             return True
 
-        permissions_allowed = create_permissions_allowed_hierarchy(self.PERMISSION_CHOICES)
+        return self.get_permission_rank(user) >= self.PERMISSION_RANKS.get(required_permission, self.OWNER_RANK)
+
+    def get_permission_rank(self, user : User) -> int:
+        '''
+        The user's effective permission rank, memoized on the instance. Comes from
+        the with_permission() annotation when the project was loaded with one, and
+        from the shared permission cache otherwise.
+        '''
+        ranks = self.__dict__.setdefault('_permission_ranks', {})
+
+        if user.pk not in ranks:
+            if getattr(self, 'permission_user_id', None) == user.pk and hasattr(self, 'permission_rank'):
+                ranks[user.pk] = self.permission_rank
+            elif user.pk is None:
+                ranks[user.pk] = 0
+            elif user.pk == self.owner_id:
+                ranks[user.pk] = self.OWNER_RANK
+            else:
+                # Ownership is checked above, so cached ranks only cover collaborator and organization access
+                ranks[user.pk] = permission_cache.get_or_compute(
+                    permission_cache.project_permission_key(self.pk, user.pk),
+                    lambda: Project.objects.filter(pk=self.pk).annotate(
+                        permission_rank=project_permission_rank(user),
+                    ).values_list('permission_rank', flat=True).first() or 0,
+                )
+
+        return ranks[user.pk]
+
+    def set_permission_rank(self, user : User, rank : int) -> None:
+        self.__dict__.setdefault('_permission_ranks', {})[user.pk] = rank
+
+    def clear_permission_cache(self) -> None:
+        self.__dict__.pop('_permission_ranks', None)
+        self.__dict__.pop('permission_rank', None)
 
-        return (published_gives_permission and self.published_at is not None) or ProjectCollaborator.objects.filter(
-            project=self,
-            collaborator=user,
-            permission__in=permissions_allowed.get(required_permission, [])
-        ).exists() or Organization.objects.filter(
-            projects=self,
-            organization_projects__permission__in=permissions_allowed.get(required_permission, []),
-            members=user
-        ).exists()
-    
     def has_member(self, user : User, include_owner=True) -> bool:
         if include_owner and user == self.owner:
             return True
@@ -83,23 +209,126 @@ class Project(Model):
             invitee=user,
         ).delete()
 
+        self.clear_permission_cache()
+
     def get_permission(self, user: User) -> str | None:
-        if user == self.owner:
+        return self.permission_for_rank(self.get_permission_rank(user))
+
+    def get_permissions(self, user_ids) -> dict[int, str | None]:
+        '''
+        Effective permissions of several users resolved in one query, rather than one
+        permission cache lookup per user. The ranks are memoized like get_permission_rank
+        '''
+        user_ids = list(user_ids)
+        ranks = dict(User.objects.filter(pk__in=user_ids).annotate(
+            permission_rank=Case(
+                When(pk=self.owner_id, then=Value(self.OWNER_RANK)),
+                default=Greatest(
+                    Coalesce(Subquery(ProjectCollaborator.objects.filter(
+                        project=self.pk,
+                        collaborator=OuterRef('pk'),
+                    ).annotate(rank=permission_choice_rank()).values('rank')[:1]), Value(0)),
+                    Coalesce(Subquery(OrganizationProject.objects.filter(
+                        project=self.pk,
+                        organization__members=OuterRef('pk'),
+                    ).annotate(rank=permission_choice_rank()).order_by('-rank').values('rank')[:1]), Value(0)),
+                ),
+                output_field=IntegerField(),
+            ),
+        ).values_list('pk', 'permission_rank'))
+
+        self.__dict__.setdefault('_permission_ranks', {}).update(ranks)
+        return {user_id: self.permission_for_rank(ranks.get(user_id, 0)) for user_id in user_ids}
+
+    @classmethod
+    def permission_for_rank(cls, rank : int) -> str | None:
+        if rank == cls.OWNER_RANK:
             return 'owner'
 
-        permissions_allowed = create_permissions_allowed_hierarchy(self.PERMISSION_CHOICES)
-
-        try:
-            permissions_list = [ProjectCollaborator.objects.get(project=self, collaborator=user).permission]
-        except ProjectCollaborator.DoesNotExist:
-            permissions_list = []
-
-        permissions_list.extend(OrganizationProject.objects.filter(project=self, organization__members=user).values_list('permission', flat=True))
-
-        if len(permissions_list) == 0:
-            return None
+        return next((permission for permission, permission_rank in cls.PERMISSION_RANKS.items() if permission_rank == rank), None)
+
+    def get_save_excluded_fields(self) -> list[str]:
+        return [*super().get_save_excluded_fields(), *self.LOCKED_STATE_FIELDS]
+
+    def get_yjs_state(self) -> bytes | None:
+        '''
+        Full document state: the compacted yjs_blob merged with every
+        incremental update appended since the last compaction.
+
+        The updates are read before yjs_blob, which is re-read rather than
+        taken from this instance: a compaction committing in between has
+        already merged the updates it deleted into the blob read afterwards
+        '''
+        updates = list(self.yjs_updates.values_list('update', flat=True))
+        yjs_blob = Project.objects.filter(pk=self.pk).values_list('yjs_blob', flat=True).first()
+        return merge_updates(yjs_blob, *updates)
+
+    def append_yjs_state(self, state : bytes) -> bytes:
+        '''
+        Store a full document state as an incremental update holding only the
+        part that is not persisted yet, and return that update. Without Yjs
+        tooling the state replaces yjs_blob and is returned as is
+        '''
+        if not YJS_AVAILABLE:
+            Project.objects.filter(pk=self.pk).update(yjs_blob=state, updated_at=timezone.now())
+            self.yjs_blob = state
+            self.snapshot_tracked_fields(['yjs_blob'])
+            return state
+
+        with transaction.atomic():
+            current = Project.objects.select_for_update().only('yjs_seq', 'yjs_state_vector').get(pk=self.pk)
+
+            update = diff_update(state, current.yjs_state_vector)
+            seq = current.yjs_seq + 1
+            state_vector = merge_state_vectors(current.yjs_state_vector, get_state_vector(state))
+
+            ProjectYjsUpdate.objects.create(project=self, seq=seq, update=update)
+            Project.objects.filter(pk=self.pk).update(yjs_seq=seq, yjs_state_vector=state_vector, updated_at=timezone.now())
+
+        self.yjs_seq = seq
+        self.yjs_state_vector = state_vector
+
+        return update
+
+    def compact_yjs_updates(self) -> int:
+        '''
+        Merge all appended updates back into yjs_blob and delete them.
+        Returns the number of updates that were compacted
+        '''
+        with transaction.atomic():
+            project = Project.objects.select_for_update().only('yjs_blob').get(pk=self.pk)
+            updates = list(project.yjs_updates.values_list('seq', 'update'))
+
+            if not updates:
+                return 0
+
+            merged = merge_updates(project.yjs_blob, *(update for _seq, update in updates))
+
+            # Queryset update so the unchanged document is not broadcast by the save signals
+            Project.objects.filter(pk=self.pk).update(yjs_blob=merged)
+            project.yjs_updates.filter(seq__lte=updates[-1][0]).delete()
+
+        self.yjs_blob = merged
+        self.snapshot_tracked_fields(['yjs_blob'])
+
+        return len(updates)
+
+def select_related_project_without_state(queryset, field='project'):
+    '''
+    Join the related project (for permission checks on nested objects) without
+    pulling its Yjs state along.
+    '''
+    return queryset.select_related(field).defer(*(f'{field}__{name}' for name in Project.DEFERRED_FIELDS))
+
+class ProjectYjsUpdate(Model):
+    project = ForeignKey(Project, related_name='yjs_updates', on_delete=CASCADE)
+    seq = PositiveIntegerField()
+    update = BinaryField()
+    created_at = DateTimeField(auto_now_add=True)
 
-        return min(permissions_list, key=lambda x: len(permissions_allowed.get(x, [])))
+    class Meta:
+        unique_together = ('project', 'seq')
+        ordering = ['seq']
 
 class ProjectCollaborator(Model):
     project = ForeignKey(Project, related_name='project_collaborators', on_delete=CASCADE)
@@ -166,16 +395,118 @@ class Asset(Model):
         return self.project.has_permission(user, required_permission)
 
 
+class Snapshot(Model):
+    '''
+    Content-addressed Yjs document state. Share links pointing at identical
+    state share one row; it is deleted once no share link references it
+    '''
+    hash = CharField(max_length=64, unique=True)
+    yjs_blob = CompressedBinaryField()
+    created_at = DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def hash_state(state : bytes) -> str:
+        return hashlib.sha256(state).hexdigest()
+
+    @classmethod
+    def for_state(cls, state : bytes) -> 'Snapshot':
+        '''
+        Snapshot holding state, created if needed. The row stays locked until the
+        surrounding transaction ends, so call this in the transaction that saves the
+        share link referencing it; release() cannot delete the snapshot in between
+        '''
+        with transaction.atomic():
+            # Defer the blob so reusing an existing snapshot never reads it back. A snapshot
+            # deleted by release() while waiting for the lock is not found and created again
+            snapshot, _created = cls.objects.select_for_update().defer('yjs_blob').get_or_create(
+                hash=cls.hash_state(state),
+                defaults={'yjs_blob': state},
+            )
+        return snapshot
+
+    @classmethod
+    def release(cls, snapshot_id : int | None) -> None:
+        '''
+        Delete the snapshot once no share link references it. The reference check runs
+        under the row lock for_state() takes, so it sees every committed reuse
+        '''
+        if snapshot_id is None:
+            return
+
+        with transaction.atomic():
+            if cls.objects.select_for_update().filter(pk=snapshot_id).exists():
+                cls.objects.filter(pk=snapshot_id, share_links__isnull=True).delete()
+
 class ProjectShareLink(Model):
     project = ForeignKey(Project, related_name='share_links', on_delete=CASCADE)
     name = CharField(max_length=200)
     token = CharField(max_length=64, unique=True)
-    yjs_blob = BinaryField(null=True, blank=True)
+    snapshot = ForeignKey(Snapshot, related_name='share_links', null=True, blank=True, on_delete=PROTECT)
     created_at = DateTimeField(auto_now_add=True)
     updated_at = DateTimeField(auto_now=True)
+    # Visits are counted in Redis by record_visit() and flushed here by the flush_share_link_visits command
     total_visits = IntegerField(default=0)
     unique_visits = IntegerField(default=0)
-    visitor_ids = TextField(blank=True, default="")
+
+    VISITS_KEY_PREFIX = 'share:visits'
+    VISITORS_KEY_PREFIX = 'share:visitors'
+    VISITS_DIRTY_KEY = 'share:visits:dirty'
+
+    @property
+    def yjs_blob(self) -> bytes | None:
+        return self.snapshot.yjs_blob if self.snapshot_id else None
+
+    def set_state(self, state : bytes | None) -> None:
+        '''
+        Point the share link at the snapshot of state and save it. Identical state
+        resolves to the same snapshot, so this is usually just a pointer write
+        '''
+        with transaction.atomic():
+            snapshot_id = Snapshot.for_state(bytes(state)).pk if state is not None else None
+
+            if snapshot_id != self.snapshot_id:
+                # The signals layer garbage-collects the replaced snapshot after save
+                self._released_snapshot_id = self.snapshot_id
+                self.snapshot_id = snapshot_id
+
+            self.save(update_fields=['snapshot', 'updated_at'] if self.pk is not None else None)
 
     def has_permission(self, user: User, required_permission) -> bool:
-        return self.project.has_permission(user, required_permission)
\ No newline at end of file
+        return self.project.has_permission(user, required_permission)
+
+    def record_visit(self, visitor_id : str | None = None) -> None:
+        '''
+        Count a visit without writing to the database: INCR a pending total and PFADD the
+        visitor to a HyperLogLog. total_visits and unique_visits on this instance are
+        updated to include the pending counts. Falls back to an atomic database increment
+        (without unique tracking) when Redis is unreachable.
+        '''
+        visitors_key = f'{self.VISITORS_KEY_PREFIX}:{self.pk}'
+
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.incr(f'{self.VISITS_KEY_PREFIX}:{self.pk}')
+            pipe.sadd(self.VISITS_DIRTY_KEY, self.pk)
+            if visitor_id:
+                pipe.pfadd(visitors_key, visitor_id)
+            pipe.pfcount(visitors_key)
+            results = pipe.execute()
+        except Exception as exc:
+            logger.warning('Redis visit counting failed for share link %s: %s', self.pk, exc)
+            ProjectShareLink.objects.filter(pk=self.pk).update(total_visits=F('total_visits') + 1)
+            self.total_visits += 1
+            return
+
+        self.total_visits += results[0]
+        self.unique_visits = max(self.unique_visits, results[-1])
+
+    @classmethod
+    def apply_visit_counts(cls, pk : int, visits : int, unique_visitors : int) -> None:
+        '''
+        Add flushed visits to the stored total. The HyperLogLog count only grows, and
+        counts recorded before it existed are kept as a floor.
+        '''
+        cls.objects.filter(pk=pk).update(
+            total_visits=F('total_visits') + visits,
+            unique_visits=Greatest(F('unique_visits'), Value(unique_visitors)),
+        )
@@ -5,6 +5,7 @@ from utils.image_processing import process_uploaded_image
 from .models import ProjectGroup, Project, ProjectCollaborator, OrganizationProject, ProjectInvitation, Asset, ProjectShareLink
 from accounts.models import User
 from organizations.serializers import PublicOrganizationSerializer
+from utils.permissions import get_permission_object
 import base64
 
 # confirm provided string is a base64-encoded file
@@ -21,7 +22,7 @@ def is_base64(s : str) -> bool:
 
 class ProjectGroupSerializer(ModelSerializer):
     owner = PublicUserSerializer(read_only=True)
-    projects = PrimaryKeyRelatedField(many=True, queryset=Project.objects.all())
+    projects = PrimaryKeyRelatedField(many=True, queryset=Project.objects.without_state())
 
     class Meta:
         model = ProjectGroup
@@ -56,8 +57,6 @@ class ProjectShareLinkInlineSerializer(ModelSerializer):
 class ProjectSerializer(ModelSerializer):
     owner = PublicUserSerializer(read_only=True)
     is_published = BooleanField(write_only=True, required=False)
-    fork_count = SerializerMethodField()
-    asset_count = SerializerMethodField()
     permission = SerializerMethodField()
     default_share_link = ProjectShareLinkInlineSerializer(read_only=True)
     default_share_link_id = PrimaryKeyRelatedField(
@@ -73,26 +72,39 @@ class ProjectSerializer(ModelSerializer):
         fields = ['id', 'owner', 'created_at', 'updated_at', 'name', 'description', 'published_at',
                     'is_published', 'fork_count', 'asset_count', 'thumbnail', 'permission', 'yjs_blob',
                     'default_share_link', 'default_share_link_id']
-        read_only_fields = ['created_at', 'updated_at', 'published_at']
-
-    def get_fork_count(self, instance):
-        return instance.forked_by.count()
-    
-    def get_asset_count(self, instance : Project) -> int:
-        return Asset.objects.filter(project=instance).count()
+        read_only_fields = ['created_at', 'updated_at', 'published_at', 'fork_count', 'asset_count']
 
     def get_permission(self, instance):
         return instance.get_permission(self.context['request'].user)
 
-    def to_representation(self, instance):
-        data = super().to_representation(instance)
-
+    def include_state(self) -> bool:
         view = self.context.get('view')
         action = view.action if view else None
 
-        if action == 'list':
+        request = self.context.get('request')
+        include_state = request is None or request.query_params.get('include_state', 'true').lower() != 'false'
+
+        # State is never listed, nested or echoed back by updates, and can be skipped on detail by
+        # clients that load it from the binary state endpoint
+        return action not in ('list', 'partial_update') and self.parent is None and include_state
+
+    def get_fields(self):
+        fields = super().get_fields()
+
+        # Drop the fields up front so a deferred yjs_blob is never read
+        if not self.include_state():
             for field in Project.PROJECT_STATE_FIELDS:
-                data.pop(field, None)
+                fields.pop(field, None)
+
+        return fields
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+
+        if 'yjs_blob' in data:
+            # Include incremental updates that have not been compacted into yjs_blob yet
+            state = instance.get_yjs_state()
+            data['yjs_blob'] = base64.b64encode(state).decode('ascii') if state is not None else None
 
         return data
 
@@ -122,23 +134,21 @@ class ProjectSerializer(ModelSerializer):
             # If the incoming value is a string, treat it as base64
             if isinstance(yjs_blob, str):
                 try:
-                    instance.yjs_blob = base64.b64decode(yjs_blob)
+                    yjs_blob = base64.b64decode(yjs_blob)
                 except Exception:
                     raise ValidationError({"yjs_blob": "Invalid base64-encoded yjs_blob."})
-            else:
-                # Allow passing raw bytes (e.g. from non-JSON clients)
-                instance.yjs_blob = yjs_blob
 
-        instance = super().update(instance, validated_data)
+            # Append only the unsaved part of the document (the state columns are never
+            # written by save()); the signals layer forwards this update to Hocuspocus.
+            instance._yjs_update = instance.append_yjs_state(bytes(yjs_blob))
 
+        # Set published_at before saving so the whole update is a single save
         if is_published and instance.published_at is None:
             instance.published_at = timezone.now()
-            instance.save(update_fields=['published_at'])
         elif not is_published and instance.published_at is not None:
             instance.published_at = None
-            instance.save(update_fields=['published_at'])
 
-        return instance
+        return super().update(instance, validated_data)
 
     def validate(self, attrs):
         group = attrs.get('group')
@@ -175,7 +185,8 @@ class ProjectCollaboratorSerializer(ModelSerializer):
             if 'request' in self.context:
                 try:
                     user = self.context['request'].user
-                    project = Project.objects.get(id=self.context['view'].kwargs.get('project_pk'))
+                    # Already loaded by the permission check, and shared by every item of a bulk create
+                    project = get_permission_object(self.context['request'], Project, self.context['view'].kwargs.get('project_pk'))
 
                     if not project.has_permission(user, attrs['permission']):
                         raise ValidationError({'permission': 'Cannot give a collaborator a higher permission class to the project than yourself.'})
@@ -186,7 +197,7 @@ class ProjectCollaboratorSerializer(ModelSerializer):
 
 class OrganizationProjectSerializer(ModelSerializer):
     project = ProjectSerializer(read_only=True)
-    project_id = PrimaryKeyRelatedField(queryset=Project.objects.all(), write_only=True, source='project')
+    project_id = PrimaryKeyRelatedField(queryset=Project.objects.without_state(), write_only=True, source='project')
 
     class Meta:
         model = OrganizationProject
@@ -197,7 +208,7 @@ class OrganizationProjectSerializer(ModelSerializer):
             if 'view' in self.context and hasattr(self.context['view'], 'kwargs'):
                 if 'request' in self.context:
                     user = self.context['request'].user
-                    project = Project.objects.get(id=self.context['view'].kwargs.get('pk'))
+                    project = Project.objects.without_state().get(id=self.context['view'].kwargs.get('pk'))
 
                     if not project.has_permission(user, attrs['permission']):
                         raise ValidationError({'permission': 'Cannot give an organization a higher permission class to the project than yourself.'})
@@ -210,6 +221,13 @@ class OrganizationProjectSerializer(ModelSerializer):
         validated_data.pop('project_id', None)
         return super().update(instance, validated_data)
 
+    def to_representation(self, instance):
+        # Hand the annotated permission to the nested project so it does not query per row
+        if hasattr(instance, 'project_permission_rank') and 'request' in self.context:
+            instance.project.set_permission_rank(self.context['request'].user, instance.project_permission_rank)
+
+        return super().to_representation(instance)
+
 class ProjectOrganizationSerializer(ModelSerializer):
     organization = PublicOrganizationSerializer(read_only=True)
 
@@ -231,9 +249,13 @@ class ProjectInvitationSerializer(ModelSerializer):
     def validate(self, attrs : dict[str, any]) -> dict[str, any]:
         try:
             if 'view' in self.context and hasattr(self.context['view'], 'kwargs'):
-                project = Project.objects.get(id=self.context['view'].kwargs.get('project_pk'))
+                project_pk = self.context['view'].kwargs.get('project_pk')
+                if 'request' in self.context:
+                    project = get_permission_object(self.context['request'], Project, project_pk)
+                else:
+                    project = Project.objects.without_state().get(id=project_pk)
 
-                if project.has_member(attrs['invitee']):
+                if attrs['invitee'].pk in self.get_member_ids(project):
                     raise ValidationError('Cannot invite an already-existing member to the project.')
 
                 if 'request' in self.context:
@@ -246,6 +268,13 @@ class ProjectInvitationSerializer(ModelSerializer):
 
         return attrs
 
+    def get_member_ids(self, project : Project) -> set[int]:
+        # Loaded once and shared through the context by every item of a bulk create
+        if '_member_ids' not in self.context:
+            self.context['_member_ids'] = {project.owner_id, *project.collaborators.values_list('pk', flat=True)}
+
+        return self.context['_member_ids']
+
 
 class ProjectShareLinkSerializer(ModelSerializer):
     project = PrimaryKeyRelatedField(read_only=True)
@@ -272,6 +301,14 @@ class ProjectShareLinkSerializer(ModelSerializer):
         return base64.b64encode(obj.yjs_blob).decode('ascii')
 
 
+class ProjectShareLinkWithoutStateSerializer(ProjectShareLinkSerializer):
+    # Removing the declared field keeps the snapshot from being loaded at all
+    yjs_blob = None
+
+    class Meta(ProjectShareLinkSerializer.Meta):
+        fields = [field for field in ProjectShareLinkSerializer.Meta.fields if field != 'yjs_blob']
+
+
 class AssetSerializer(ModelSerializer):
     asset_file = ImageField(write_only=True, allow_null=True, required=False)
 
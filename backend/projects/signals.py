@@ -1,11 +1,23 @@
-import base64
 import json
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db import transaction
+from django.db.models.signals import m2m_changed, pre_save, pre_delete, post_save, post_delete
 from django.dispatch import receiver
-from utils.redis_client import safe_hkeys, safe_publish
-from accounts.models import User
-from .models import OrganizationProject, Project, ProjectCollaborator, ProjectShareLink
-from .serializers import ProjectCollaboratorSerializer, ProjectOrganizationSerializer, ProjectShareLinkSerializer
+from utils import permission_cache, response_cache
+from utils.redis_client import get_commit_hook, pack_binary_message, publish_on_commit, safe_hkeys
+from organizations.models import Organization, OrganizationMember
+from .models import Asset, OrganizationProject, Project, ProjectCollaborator, ProjectShareLink, Snapshot, project_count_expressions
+from .serializers import ProjectCollaboratorSerializer, ProjectOrganizationSerializer, ProjectShareLinkWithoutStateSerializer
+
+### Change tracking
+
+@receiver(pre_save, sender=Project)
+def track_project_changes(sender, instance: Project, update_fields=None, **kwargs) -> None:
+    """
+    Work out which tracked fields this save changes, once, before the other
+    receivers run. They read instance._dirty_fields and the previous values
+    instead of querying the row again.
+    """
+    instance._dirty_fields = instance.get_dirty_fields(update_fields)
 
 ### Thumbnail deletion signals
 
@@ -14,21 +26,15 @@ def delete_old_thumbnail_on_project_change(sender, instance: Project, **kwargs)
     """
     Delete the old thumbnail file from storage when a new one is uploaded.
     """
-    if not instance.pk:
-        # New project, no previous thumbnail to delete
-        return
-
-    try:
-        old_project = sender.objects.get(pk=instance.pk)
-    except sender.DoesNotExist:
+    if "thumbnail" not in instance._dirty_fields:
         return
 
-    old_thumbnail = old_project.thumbnail
-    new_thumbnail = instance.thumbnail
+    old_thumbnail_name = instance.get_previous_values()["thumbnail"]
 
     # If thumbnail changed and old file exists, delete the old file
-    if old_thumbnail and old_thumbnail != new_thumbnail:
-        old_thumbnail.delete(save=False)
+    # Through storage: FieldFile.delete() would also clear the instance's new thumbnail
+    if old_thumbnail_name:
+        sender._meta.get_field("thumbnail").storage.delete(old_thumbnail_name)
 
 @receiver(post_delete, sender=Project)
 def delete_thumbnail_on_project_delete(sender, instance: Project, **kwargs) -> None:
@@ -39,6 +45,103 @@ def delete_thumbnail_on_project_delete(sender, instance: Project, **kwargs) -> N
     if thumbnail:
         thumbnail.delete(save=False)
 
+def invalidate_project_detail(project_ids) -> None:
+    response_cache.invalidate(Project.RESPONSE_CACHE_NAMESPACE, project_ids)
+
+### Denormalized counters
+
+@receiver(m2m_changed, sender=Project.forked_by.through)
+def update_fork_count(sender, instance, action: str, reverse: bool, pk_set: set | None, **kwargs) -> None:
+    """
+    Keep Project.fork_count in step with forked_by. For post_add, pk_set only holds
+    rows that were actually inserted. Clearing is rare, so it is recounted instead.
+    """
+    if action in ("post_add", "post_remove") and pk_set:
+        sign = 1 if action == "post_add" else -1
+
+        if reverse:
+            # user.forked_projects.add(...): pk_set holds project ids, each gaining one fork
+            Project.increment_counters(pk_set, fork_count=sign)
+            invalidate_project_detail(pk_set)
+        else:
+            Project.increment_counters([instance.pk], fork_count=sign * len(pk_set))
+            invalidate_project_detail([instance.pk])
+    elif action == "pre_clear":
+        instance._cleared_fork_project_ids = (
+            list(instance.forked_projects.values_list("pk", flat=True)) if reverse else [instance.pk]
+        )
+    elif action == "post_clear":
+        project_ids = getattr(instance, "_cleared_fork_project_ids", [])
+        Project.objects.filter(pk__in=project_ids).update(fork_count=project_count_expressions()["fork_count"])
+        invalidate_project_detail(project_ids)
+
+@receiver(post_save, sender=Asset)
+def increment_asset_count(sender, instance: Asset, created: bool, **kwargs) -> None:
+    if created and instance.project_id is not None:
+        Project.increment_counters([instance.project_id], asset_count=1)
+        invalidate_project_detail([instance.project_id])
+
+@receiver(post_delete, sender=Asset)
+def decrement_asset_count(sender, instance: Asset, **kwargs) -> None:
+    if instance.project_id is not None:
+        Project.increment_counters([instance.project_id], asset_count=-1)
+        invalidate_project_detail([instance.project_id])
+
+@receiver(post_save, sender=OrganizationProject)
+def increment_organization_projects_count(sender, instance: OrganizationProject, created: bool, **kwargs) -> None:
+    if created:
+        Organization.increment_counters([instance.organization_id], projects_count=1)
+
+@receiver(post_delete, sender=OrganizationProject)
+def decrement_organization_projects_count(sender, instance: OrganizationProject, **kwargs) -> None:
+    Organization.increment_counters([instance.organization_id], projects_count=-1)
+
+### Permission cache invalidation
+# Registered before the Yjs receivers below, which read the fresh permissions
+
+@receiver(post_save, sender=ProjectCollaborator)
+@receiver(post_delete, sender=ProjectCollaborator)
+def invalidate_collaborator_permission(sender, instance: ProjectCollaborator, **kwargs) -> None:
+    permission_cache.invalidate([
+        permission_cache.project_permission_key(instance.project_id, instance.collaborator_id),
+    ])
+
+@receiver(post_save, sender=OrganizationProject)
+@receiver(post_delete, sender=OrganizationProject)
+def invalidate_organization_project_permissions(sender, instance: OrganizationProject, **kwargs) -> None:
+    """
+    Sharing a project with an organization changes the permission of every member.
+    """
+    member_ids = OrganizationMember.objects.filter(organization_id=instance.organization_id).values_list("member_id", flat=True)
+    permission_cache.invalidate(
+        permission_cache.project_permission_key(instance.project_id, member_id) for member_id in member_ids
+    )
+
+@receiver(post_save, sender=OrganizationMember)
+@receiver(post_delete, sender=OrganizationMember)
+def invalidate_organization_member_project_permissions(sender, instance: OrganizationMember, **kwargs) -> None:
+    """
+    Joining or leaving an organization changes the member's permission on every project shared with it.
+    """
+    project_ids = OrganizationProject.objects.filter(organization_id=instance.organization_id).values_list("project_id", flat=True)
+    permission_cache.invalidate(
+        permission_cache.project_permission_key(project_id, instance.member_id) for project_id in project_ids
+    )
+
+@receiver(pre_delete, sender=Organization)
+def invalidate_deleted_organization_project_permissions(sender, instance: Organization, **kwargs) -> None:
+    """
+    The cascade may delete members before shared projects (or the other way round),
+    so resolve every affected pair while both still exist.
+    """
+    member_ids = list(OrganizationMember.objects.filter(organization=instance).values_list("member_id", flat=True))
+    project_ids = OrganizationProject.objects.filter(organization=instance).values_list("project_id", flat=True)
+    permission_cache.invalidate(
+        permission_cache.project_permission_key(project_id, member_id)
+        for project_id in project_ids
+        for member_id in member_ids
+    )
+
 ### Yjs project update signals
 
 CLIENT_MAP_PREFIX = "yjs:clients"
@@ -57,75 +160,56 @@ def get_project_connected_users(project_id: int) -> list[int]:
     user_id_bytes = safe_hkeys(key)
     return [int(uid.decode("utf-8")) for uid in user_id_bytes]
 
-@receiver(pre_save, sender=Project)
-def store_previous_project_name(sender, instance: Project, **kwargs) -> None:
-    """
-    Cache the previous project name / yjs_blob / default_share_link on the instance
-    so we can compare in post_save.
-    """
-    # New instances don't have a previous name
-    if not instance.pk:
-        return
-
-    # If another part of the code explicitly wants to skip notifications, respect that
-    if getattr(instance, "_skip_hocuspocus_notify", False):
-        return
-
-    try:
-        previous = Project.objects.get(pk=instance.pk)
-        instance._old_name = previous.name
-        instance._old_yjs_blob = previous.yjs_blob
-        instance._old_default_share_link_id = getattr(previous, "default_share_link_id", None)
-    except Project.DoesNotExist:
-        instance._old_name = None
-        instance._old_yjs_blob = None
-        instance._old_default_share_link_id = None
-
 @receiver(post_save, sender=Project)
 def publish_project_change(sender, instance: Project, created: bool, **kwargs) -> None:
     """
     When a project's name changes (and the change doesn't originate from Yjs),
     publish an update so the Hocuspocus server can update the in-memory Yjs doc.
+    Also drops the project's cached detail responses.
     """
 
-    old_name = getattr(instance, "_old_name", None)
-    old_yjs_blob = getattr(instance, "_old_yjs_blob", None)
-    old_default_share_link_id = getattr(instance, "_old_default_share_link_id", None)
+    if not created:
+        # Any saved change can show up in the detail response, not only the ones published below
+        invalidate_project_detail([instance.pk])
+
+    dirty_fields = getattr(instance, "_dirty_fields", set())
+    yjs_update = getattr(instance, "_yjs_update", None)
     skip_hocuspocus_notify = getattr(instance, "_skip_hocuspocus_notify", False)
 
     # Skip new projects – only propagate updates to existing docs
     # Allow callers (like the Yjs sync worker) to bypass notifications entirely
-    # If we couldn't determine the previous state, don't publish
     # No actual relevant change (name, yjs_blob, or default_share_link)
     if (
         created
         or skip_hocuspocus_notify
         or (
-            old_name == instance.name
-            and old_yjs_blob == instance.yjs_blob
-            and old_default_share_link_id == getattr(instance, "default_share_link_id", None)
+            not dirty_fields & {"name", "yjs_blob", "default_share_link"}
+            and yjs_update is None
         )
     ):
         return
 
-    encoded_blob: str | None
-    if instance.yjs_blob is not None and old_yjs_blob != instance.yjs_blob:
-        # Encode binary blob as base64 so it can be transported via JSON/Redis
-        encoded_blob = base64.b64encode(instance.yjs_blob).decode("ascii")
+    yjs_payload: bytes | None
+    if yjs_update is not None:
+        # An appended incremental update applies to the live doc just like a full state
+        yjs_payload = yjs_update
+        instance._yjs_update = None
+    elif "yjs_blob" in dirty_fields and instance.yjs_blob is not None:
+        yjs_payload = bytes(instance.yjs_blob)
     else:
-        encoded_blob = None
+        yjs_payload = None
 
-    payload = {
+    header = {
         "project_id": instance.pk,
         "name": instance.name,
-        "yjs_blob": encoded_blob,
     }
 
     # Only include default_share_link_id when it changed
-    if old_default_share_link_id != getattr(instance, "default_share_link_id", None):
-        payload["default_share_link_id"] = getattr(instance, "default_share_link_id", None)
+    if "default_share_link" in dirty_fields:
+        header["default_share_link_id"] = getattr(instance, "default_share_link_id", None)
 
-    safe_publish(PROJECT_UPDATE_CHANNEL, json.dumps(payload))
+    # The Yjs state is sent as raw bytes after the JSON header instead of base64
+    publish_on_commit(PROJECT_UPDATE_CHANNEL, pack_binary_message(header, yjs_payload))
 
 def publish_project_collaborator_permission(
     instance: ProjectCollaborator,
@@ -134,9 +218,11 @@ def publish_project_collaborator_permission(
     event: str,
     project_collaborator: dict | None = None,
 ) -> None:
+    # The collaborator's permission just changed, so drop anything memoized on the project
+    instance.project.clear_permission_cache()
     effective_permission = instance.project.get_permission(instance.collaborator)
 
-    safe_publish(
+    publish_on_commit(
         PROJECT_COLLABORATOR_UPDATE_CHANNEL,
         json.dumps(
             {
@@ -169,6 +255,73 @@ def publish_project_collaborator_delete(sender, instance: ProjectCollaborator, *
         event="collaborator_removed",
     )
 
+def publish_project_collaborators_added(project: Project, collaborators: list[ProjectCollaborator]) -> None:
+    """
+    Collaborators added together with bulk_create send no post_save signals. Do
+    what the receivers above would have done, with a single coalesced message
+    instead of one per collaborator.
+    """
+    if not collaborators:
+        return
+
+    collaborator_ids = [collaborator.collaborator_id for collaborator in collaborators]
+    permission_cache.invalidate(
+        permission_cache.project_permission_key(project.pk, collaborator_id) for collaborator_id in collaborator_ids
+    )
+    project.clear_permission_cache()
+
+    publish_on_commit(
+        PROJECT_COLLABORATOR_UPDATE_CHANNEL,
+        json.dumps(
+            {
+                "project_id": project.pk,
+                "event": "collaborator_added",
+                "collaborators": project.get_permissions(collaborator_ids),
+                "project_collaborators": ProjectCollaboratorSerializer(collaborators, many=True).data,
+            }
+        ),
+    )
+
+class OrganizationProjectBroadcast:
+    """
+    OrganizationProject changes to one project, published together as a single
+    message.
+    """
+
+    def __init__(self, project: Project):
+        self.project = project
+        self.changes: list[dict] = []
+
+    def publish(self) -> None:
+        # All connected users and their effective permissions are loaded in one query
+        self.project.clear_permission_cache()
+        collaborators = self.project.get_permissions(get_project_connected_users(self.project.pk))
+
+        publish_on_commit(
+            PROJECT_COLLABORATOR_UPDATE_CHANNEL,
+            json.dumps(
+                {
+                    "project_id": self.project.pk,
+                    "organization_changes": self.changes,
+                    "collaborators": collaborators,
+                }
+            ),
+        )
+
+class PendingOrganizationBroadcasts:
+    """
+    on_commit hook holding a broadcast per project whose organizations changed
+    under the same savepoints of a transaction (see get_commit_hook), so the
+    changes are dropped with them if they roll back.
+    """
+
+    def __init__(self):
+        self.broadcasts: dict[int, OrganizationProjectBroadcast] = {}
+
+    def __call__(self) -> None:
+        for broadcast in self.broadcasts.values():
+            broadcast.publish()
+
 def publish_organization_project_permission(
     instance: OrganizationProject,
     source: str,
@@ -176,23 +329,32 @@ def publish_organization_project_permission(
     event: str,
     project_organization: dict | None = None,
 ) -> None:
-    safe_publish(
-        PROJECT_COLLABORATOR_UPDATE_CHANNEL,
-        json.dumps(
-            {
-                "project_id": instance.project_id,
-                "event": event,
-                "project_organization_id": instance.pk,
-                "organization_id": instance.organization_id,
-                "permission": instance.permission,
-                "project_organization": project_organization,
-                "collaborators": {
-                    id: instance.project.get_permission(User.objects.get(pk=id))
-                    for id in get_project_connected_users(instance.project_id)
-                }
-            }
-        ),
-    )
+    """
+    Queue the change on the project's broadcast for the current transaction,
+    which is published once it commits. Outside a transaction it is published
+    right away.
+    """
+    change = {
+        "event": event,
+        "project_organization_id": instance.pk,
+        "organization_id": instance.organization_id,
+        "permission": instance.permission,
+        "project_organization": project_organization,
+    }
+
+    if not transaction.get_connection().in_atomic_block:
+        broadcast = OrganizationProjectBroadcast(instance.project)
+        broadcast.changes.append(change)
+        broadcast.publish()
+        return
+
+    broadcasts = get_commit_hook(PendingOrganizationBroadcasts).broadcasts
+    broadcast = broadcasts.get(instance.project_id)
+
+    if broadcast is None:
+        broadcast = broadcasts[instance.project_id] = OrganizationProjectBroadcast(instance.project)
+
+    broadcast.changes.append(change)
 
 @receiver(post_save, sender=OrganizationProject)
 def publish_organization_project_change(sender, instance: OrganizationProject, created: bool, **kwargs) -> None:
@@ -212,6 +374,14 @@ def publish_organization_project_delete(sender, instance: OrganizationProject, *
     )
 
 
+def serialize_share_link_without_state(instance: ProjectShareLink) -> dict:
+    """
+    Share-link payload for pub/sub. The snapshot is left out; clients that need
+    it fetch the binary /api/share/{token}/state/ endpoint instead.
+    """
+    return dict(ProjectShareLinkWithoutStateSerializer(instance).data)
+
+
 def publish_project_share_link_change(
     instance: ProjectShareLink,
     source: str,
@@ -221,13 +391,16 @@ def publish_project_share_link_change(
     """
     Publish share-link changes (create/update/delete) for a project.
     """
-    safe_publish(
+    # The project detail embeds its default share link
+    invalidate_project_detail([instance.project_id])
+
+    publish_on_commit(
         PROJECT_SHARE_LINK_UPDATE_CHANNEL,
         json.dumps(
             {
                 "project_id": instance.project_id,
                 "event": event,
-                "share_link": ProjectShareLinkSerializer(instance).data if event != "share_link_deleted" else {
+                "share_link": serialize_share_link_without_state(instance) if event != "share_link_deleted" else {
                     "id": instance.pk,
                     "project": instance.project_id,
                 },
@@ -252,3 +425,24 @@ def publish_project_share_link_delete(sender, instance: ProjectShareLink, **kwar
         "post_delete",
         event="share_link_deleted",
     )
+
+
+### Share link snapshot garbage collection
+
+@receiver(post_save, sender=ProjectShareLink)
+def release_replaced_share_link_snapshot(sender, instance: ProjectShareLink, **kwargs) -> None:
+    """
+    Delete the snapshot a share link pointed at before it was refreshed,
+    unless another share link still references it.
+    """
+    released_snapshot_id = getattr(instance, "_released_snapshot_id", None)
+    instance._released_snapshot_id = None
+    Snapshot.release(released_snapshot_id)
+
+
+@receiver(post_delete, sender=ProjectShareLink)
+def release_deleted_share_link_snapshot(sender, instance: ProjectShareLink, **kwargs) -> None:
+    """
+    Delete a deleted share link's snapshot once no share link references it.
+    """
+    Snapshot.release(instance.snapshot_id)
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework_nested.routers import DefaultRouter, NestedDefaultRouter
-from .views import ProjectGroupViewSet, ProjectViewSet, ProjectCollaboratorViewSet, ProjectInvitationViewSet, ProjectOrganizationViewSet, OrganizationProjectViewSet, AssetViewSet, ProjectShareLinkViewSet, public_share_link_detail
+from .views import ProjectGroupViewSet, ProjectViewSet, ProjectCollaboratorViewSet, ProjectInvitationViewSet, ProjectOrganizationViewSet, OrganizationProjectViewSet, AssetViewSet, ProjectShareLinkViewSet, public_share_link_detail, public_share_link_state
 
 
 router = DefaultRouter()
@@ -36,4 +36,5 @@ urlpatterns = [
     ),
     # Public game share endpoint
     path('share/<str:token>/', public_share_link_detail, name='project-share-link-public'),
+    path('share/<str:token>/state/', public_share_link_state, name='project-share-link-public-state'),
 ]
\ No newline at end of file
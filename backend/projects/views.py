@@ -1,27 +1,44 @@
 from rest_framework.viewsets import ModelViewSet
-from .models import ProjectGroup, Project, ProjectCollaborator, OrganizationProject, ProjectInvitation, Asset, ProjectShareLink
+from .models import ProjectGroup, Project, ProjectCollaborator, OrganizationProject, ProjectInvitation, Asset, ProjectShareLink, Snapshot, project_permission_rank, select_related_project_without_state
+from .signals import publish_project_collaborators_added
 from .serializers import ProjectGroupSerializer, ProjectSerializer, ProjectInvitationSerializer, ProjectCollaboratorSerializer, OrganizationProjectSerializer, ProjectOrganizationSerializer, AssetSerializer, ProjectShareLinkSerializer
 from django_filters.rest_framework import DjangoFilterBackend
 from .filters import ProjectFilter, ProjectShareLinkFilter, apply_project_access_filters, ProjectCollaboratorFilter, ProjectInvitationFilter, OrganizationProjectFilter, ProjectOrganizationFilter, AssetFilter
-from utils.permissions import create_user_permission_class, AnyOf
+from utils import response_cache
+from utils.mixins import BulkCreateMixin
+from utils.permissions import create_user_permission_class, get_permission_object, AnyOf
 from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.request import Request
-from rest_framework.status import HTTP_200_OK, HTTP_404_NOT_FOUND
+from rest_framework.status import HTTP_200_OK, HTTP_204_NO_CONTENT, HTTP_404_NOT_FOUND
 from django.shortcuts import get_object_or_404
 from organizations.models import Organization
 from django.db.models import Q
 from accounts.models import User
 from accounts.serializers import PublicUserSerializer
 from rest_framework.permissions import AllowAny
-from django.http import JsonResponse
+from django.http import HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from base64 import b64encode
 from django.db import IntegrityError, transaction
+import json
 import secrets
 import string
 
 
+def yjs_state_response(state: bytes | None) -> HttpResponse:
+    """
+    Serve a Yjs document state as raw bytes, without base64 or JSON wrapping.
+    """
+    if state is None:
+        return HttpResponse(status=HTTP_204_NO_CONTENT)
+    return HttpResponse(state, content_type='application/octet-stream')
+
+
 class ProjectGroupViewSet(ModelViewSet):
     queryset = ProjectGroup.objects.all()
     serializer_class = ProjectGroupSerializer
@@ -61,8 +78,22 @@ class ProjectViewSet(ModelViewSet):
 
     http_method_names = ['get', 'post', 'patch', 'delete']
 
+    # Actions that read the Yjs state columns off the instance; everything else leaves them in the
+    # database (updates append the state they receive through append_yjs_state without reading it,
+    # and get_yjs_state reads the state itself)
+    STATE_ACTIONS = ['retrieve', 'fork']
+
     def get_queryset(self):
-        return apply_project_access_filters(super().get_queryset(), self.request.user).order_by("id")
+        queryset = apply_project_access_filters(super().get_queryset(), self.request.user).order_by("id")
+
+        # Lists resolve every row's permission in the same query; single objects go through the permission cache
+        if self.action == 'list':
+            queryset = queryset.with_permission(self.request.user).select_related('owner', 'default_share_link')
+
+        if self.action not in self.STATE_ACTIONS or self.request.query_params.get('include_state', '').lower() == 'false':
+            queryset = queryset.without_state()
+
+        return queryset
 
     def get_permissions(self):
         if self.action in ['list', 'create']:
@@ -80,6 +111,25 @@ class ProjectViewSet(ModelViewSet):
             )()
         ])
 
+    def retrieve(self, request, *args, **kwargs):
+        # The permission check already loaded the project without its state, which is
+        # enough to find a cached rendering; the state is only read on a miss
+        project = get_permission_object(request, Project, kwargs.get('pk'))
+        key = response_cache.response_key(
+            Project.RESPONSE_CACHE_NAMESPACE,
+            project.pk,
+            project.updated_at.timestamp(),
+            project.get_permission_rank(request.user),
+            request.query_params.get('include_state', 'true').lower() != 'false',
+        )
+
+        data = response_cache.get(key)
+        if data is None:
+            data = super().retrieve(request, *args, **kwargs).data
+            response_cache.set(key, dict(data))
+
+        return Response(data)
+
     def perform_create(self, serializer):
         serializer.validated_data.pop('is_published', False)
         serializer.save(owner=self.request.user)
@@ -98,11 +148,17 @@ class ProjectViewSet(ModelViewSet):
     @action(detail=True, methods=['post'])
     def fork(self, request, pk=None):
         project = self.get_object()
+        yjs_state = project.get_yjs_state()
 
+        # Counted by the forked_by m2m_changed signal
         project.forked_by.add(request.user)
-        project.save()
 
+        # The fork starts from the merged state without an update log of its own
         project.id = None
+        project.yjs_blob = yjs_state
+        project.yjs_seq = 0
+        project.fork_count = 0
+        project.asset_count = 0
         project.owner = request.user
         project.group = None
         project.name += ' - Fork'
@@ -111,6 +167,11 @@ class ProjectViewSet(ModelViewSet):
 
         return Response({"status": "forked"}, status=HTTP_200_OK)
 
+    @action(detail=True, methods=['get'])
+    def state(self, request, pk=None):
+        project = self.get_object()
+        return yjs_state_response(project.get_yjs_state())
+
     @action(detail=True, methods=['get'], url_path='check-user-permission')
     def check_user_permission(self, request, pk=None):
         project = self.get_object()
@@ -119,7 +180,7 @@ class ProjectViewSet(ModelViewSet):
             "permission": project.get_permission(request.user),
         }, status=HTTP_200_OK)
 
-class ProjectCollaboratorViewSet(ModelViewSet):
+class ProjectCollaboratorViewSet(BulkCreateMixin, ModelViewSet):
     queryset = ProjectCollaborator.objects.all()
     serializer_class = ProjectCollaboratorSerializer
     filter_backends = [DjangoFilterBackend]
@@ -129,7 +190,7 @@ class ProjectCollaboratorViewSet(ModelViewSet):
 
     def get_object(self):
         try:
-            return ProjectCollaborator.objects.get(project=self.kwargs.get('project_pk'), collaborator=self.kwargs.get('pk'))
+            return select_related_project_without_state(ProjectCollaborator.objects).get(project=self.kwargs.get('project_pk'), collaborator=self.kwargs.get('pk'))
         except ProjectCollaborator.DoesNotExist:
             raise NotFound('No project/collaborator pair matches the given IDs.')
 
@@ -147,7 +208,7 @@ class ProjectCollaboratorViewSet(ModelViewSet):
     def get_permissions(self):
         return super().get_permissions() + [
             create_user_permission_class(
-                'admin' if self.action == 'destroy' else 'invite' if self.action in ['create', 'partial_update'] else 'view',
+                'admin' if self.action == 'destroy' else 'invite' if self.action in ['create', 'bulk', 'partial_update'] else 'view',
                 user_override_fields=['collaborator'] if self.action == 'destroy' and str(self.request.user.id) == self.kwargs.get('pk') else [],
                 primary_pk_class=Project,
                 lookup='project_pk',
@@ -155,9 +216,18 @@ class ProjectCollaboratorViewSet(ModelViewSet):
         ]
 
     def perform_create(self, serializer):
-        project = get_object_or_404(Project, pk=self.kwargs.get('project_pk'))
+        project = get_object_or_404(Project.objects.without_state(), pk=self.kwargs.get('project_pk'))
         serializer.save(project=project)
 
+    def get_bulk_create_kwargs(self) -> dict:
+        return {'project': get_permission_object(self.request, Project, self.kwargs.get('project_pk'))}
+
+    def perform_bulk_create(self, serializer):
+        collaborators = super().perform_bulk_create(serializer)
+        # Stands in for the post_save receivers, with one message for the whole batch
+        publish_project_collaborators_added(get_permission_object(self.request, Project, self.kwargs.get('project_pk')), collaborators)
+        return collaborators
+
 class OrganizationProjectViewSet(ModelViewSet):
     queryset = OrganizationProject.objects.all()
     serializer_class = OrganizationProjectSerializer
@@ -168,7 +238,7 @@ class OrganizationProjectViewSet(ModelViewSet):
 
     def get_object(self):
         try:
-            return OrganizationProject.objects.get(organization__id=self.kwargs.get('organization_pk'), project__id=self.kwargs.get('pk'))
+            return select_related_project_without_state(OrganizationProject.objects).get(organization__id=self.kwargs.get('organization_pk'), project__id=self.kwargs.get('pk'))
         except OrganizationProject.DoesNotExist:
             raise NotFound('No organization/project pair matches the given IDs.')
 
@@ -179,7 +249,14 @@ class OrganizationProjectViewSet(ModelViewSet):
             Q(organization__members=self.request.user)
         ).distinct()
 
-        return apply_project_access_filters(queryset, self.request.user, 'project__')
+        # The nested project is always serialized without its state, and with the user's permission resolved in the same query
+        return apply_project_access_filters(
+            select_related_project_without_state(queryset).select_related('project__owner', 'project__default_share_link').annotate(
+                project_permission_rank=project_permission_rank(self.request.user, 'project', 'project__owner'),
+            ),
+            self.request.user,
+            'project__',
+        )
 
     def get_permissions(self):
         organization = get_object_or_404(Organization, pk=self.kwargs.get('organization_pk'))
@@ -195,7 +272,7 @@ class OrganizationProjectViewSet(ModelViewSet):
         # Only allow organization contributors and project admins to add projects to the organization
         if self.action == 'create':
             try:
-                project = Project.objects.get(id=self.request.data.get('project_id'))
+                project = Project.objects.without_state().get(id=self.request.data.get('project_id'))
             except Project.DoesNotExist:
                 raise NotFound('No project matches the given ID.')
 
@@ -254,7 +331,7 @@ class ProjectOrganizationViewSet(ModelViewSet):
     
 
 
-class ProjectInvitationViewSet(ModelViewSet):
+class ProjectInvitationViewSet(BulkCreateMixin, ModelViewSet):
     queryset = ProjectInvitation.objects.all()
     serializer_class = ProjectInvitationSerializer
     filter_backends = [DjangoFilterBackend]
@@ -271,7 +348,7 @@ class ProjectInvitationViewSet(ModelViewSet):
 
         return super().get_permissions() + [
             create_user_permission_class(
-                'invite' if self.action == 'create' else 'manage',
+                'invite' if self.action in ['create', 'bulk'] else 'manage',
                 user_override_fields=['inviter', 'invitee'],
                 primary_pk_class=Project,
                 lookup='project_pk',
@@ -281,16 +358,19 @@ class ProjectInvitationViewSet(ModelViewSet):
         ]
 
     def get_queryset(self):
-        return super().get_queryset().filter(project=self.kwargs.get('project_pk'))
+        return select_related_project_without_state(super().get_queryset()).filter(project=self.kwargs.get('project_pk'))
 
     def perform_create(self, serializer : ProjectInvitationSerializer) -> None:
-        project : Project = get_object_or_404(Project, pk=self.kwargs.get('project_pk'))
+        project : Project = get_object_or_404(Project.objects.without_state(), pk=self.kwargs.get('project_pk'))
 
         serializer.save(project=project, inviter=self.request.user)
 
+    def get_bulk_create_kwargs(self) -> dict:
+        return {'project': get_permission_object(self.request, Project, self.kwargs.get('project_pk')), 'inviter': self.request.user}
+
     @action(detail=True, methods=['post'])
     def accept(self, request : Request, project_pk : str|None = None, pk=None) :
-        project = get_object_or_404(Project, pk=project_pk)
+        project = get_object_or_404(Project.objects.without_state(), pk=project_pk)
         invitation = self.get_object()
 
         if invitation.invitee != request.user:
@@ -339,7 +419,7 @@ class AssetViewSet(ModelViewSet):
         ]
 
     def get_queryset(self):
-        return super().get_queryset().filter(Q(project_id=self.kwargs.get('project_pk')))
+        return select_related_project_without_state(super().get_queryset()).filter(Q(project_id=self.kwargs.get('project_pk')))
 
 
 class ProjectShareLinkViewSet(ModelViewSet):
@@ -356,9 +436,13 @@ class ProjectShareLinkViewSet(ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete']
 
     def get_queryset(self):
-        return (
-            super().get_queryset().filter(project_id=self.kwargs.get('project_pk')).distinct()
-        )
+        queryset = super().get_queryset().filter(project_id=self.kwargs.get('project_pk')).select_related('snapshot').distinct()
+
+        # Refreshing reads the project's state; other actions only check permissions against it
+        if self.action != 'refresh':
+            queryset = select_related_project_without_state(queryset)
+
+        return queryset
 
     def get_permissions(self):
         # Viewing share links requires view permission; mutating requires admin
@@ -372,7 +456,8 @@ class ProjectShareLinkViewSet(ModelViewSet):
 
     def perform_create(self, serializer):
         project = get_object_or_404(Project, pk=self.kwargs.get('project_pk'))
-        if not project.yjs_blob:
+        yjs_state = project.get_yjs_state()
+        if not yjs_state:
             raise ValidationError({
                 'yjs_blob': 'Save your project first before creating a share link.',
             })
@@ -387,7 +472,7 @@ class ProjectShareLinkViewSet(ModelViewSet):
                 continue
             try:
                 with transaction.atomic():
-                    serializer.save(project=project, token=token, yjs_blob=project.yjs_blob)
+                    serializer.save(project=project, token=token, snapshot=Snapshot.for_state(yjs_state))
                 return
             except IntegrityError:
                 # Another request may have created the same token concurrently.
@@ -398,52 +483,113 @@ class ProjectShareLinkViewSet(ModelViewSet):
     @action(detail=True, methods=['post'])
     def refresh(self, request, project_pk=None, pk=None):
         share_link = self.get_object()
-        project = share_link.project
-        if not project.yjs_blob:
+        yjs_state = share_link.project.get_yjs_state()
+        if not yjs_state:
             raise ValidationError({
                 'yjs_blob': 'Save your project first before refreshing the share link.',
             })
-        share_link.yjs_blob = project.yjs_blob
-        share_link.save(update_fields=['yjs_blob'])
+        share_link.set_state(yjs_state)
         return Response(
             self.get_serializer(share_link).data,
             status=HTTP_200_OK,
         )
 
+def share_link_validators(share_link: ProjectShareLink) -> tuple[str, int]:
+    """
+    Return the (ETag, Last-Modified timestamp) pair for a share link. The ETag is
+    weak because the visit counts in the body change on every request while the
+    name and snapshot, which is what the validator tracks, do not.
+    """
+    snapshot_hash = share_link.snapshot.hash if share_link.snapshot_id else 'empty'
+    version = int(share_link.updated_at.timestamp() * 1000)
+    return f'W/"{snapshot_hash}-{version}"', int(share_link.updated_at.timestamp())
+
+
+def share_link_response(request: Request, response: HttpResponse, etag: str, last_modified: int) -> HttpResponse:
+    """
+    Attach the caching headers for public share endpoints and turn the response
+    into a 304 when the client's If-None-Match / If-Modified-Since still match.
+    """
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=settings.SHARE_LINK_CACHE_MAX_AGE,
+        s_maxage=settings.SHARE_LINK_CACHE_MAX_AGE,
+        stale_while_revalidate=settings.SHARE_LINK_CACHE_STALE_WHILE_REVALIDATE,
+    )
+    return get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+
+
+def share_link_static_body(share_link: ProjectShareLink, etag: str) -> bytes:
+    """
+    Return the JSON-encoded, visit-independent part of the public share payload.
+    Base64-encoding a snapshot is the expensive part of the request, so the
+    encoded object is cached under the ETag, which changes with the snapshot.
+    """
+    cache_key = f'share:body:{share_link.pk}:{etag}'
+    body = cache.get(cache_key)
+    if body is None:
+        payload = {'name': share_link.name, 'token': share_link.token}
+        if share_link.snapshot_id:
+            payload['yjs_blob'] = b64encode(share_link.yjs_blob).decode('ascii')
+        body = json.dumps(payload).encode()
+        cache.set(cache_key, body, settings.SHARE_LINK_BODY_CACHE_TIMEOUT)
+    return body
+
+
+def public_share_links():
+    # The snapshot blob is only read when the encoded body is not cached yet
+    return ProjectShareLink.objects.select_related('snapshot').defer('snapshot__yjs_blob')
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def public_share_link_detail(request: Request, token: str):
     """
     Public endpoint to fetch a game's snapshot by share token.
     Also tracks total and (best-effort) unique visits using a client-provided visitor_id.
+    Supports conditional requests; visits are counted even when answering 304.
     """
     try:
-        share_link = ProjectShareLink.objects.get(token=token)
+        share_link = public_share_links().get(token=token)
     except ProjectShareLink.DoesNotExist:
         return Response({'detail': 'Not found.'}, status=HTTP_404_NOT_FOUND)
 
-    visitor_id = request.query_params.get('visitor_id')
+    # Best-effort unique visitor tracking based on a client-provided, stable visitor_id.
+    # Counted in Redis; the request does not write to the database.
+    share_link.record_visit(request.query_params.get('visitor_id'))
 
-    # Always increment total_visits
-    share_link.total_visits = (share_link.total_visits or 0) + 1
+    etag, last_modified = share_link_validators(share_link)
+    if not_modified := get_conditional_response(request, etag=etag, last_modified=last_modified):
+        return share_link_response(request, not_modified, etag, last_modified)
 
-    # Best-effort unique visitor tracking based on a client-provided, stable visitor_id.
-    if visitor_id:
-        existing_ids_raw = share_link.visitor_ids or ""
-        existing_ids = set(filter(None, existing_ids_raw.split(",")))
-        if visitor_id not in existing_ids:
-            existing_ids.add(visitor_id)
-            share_link.unique_visits = len(existing_ids)
-            share_link.visitor_ids = ",".join(sorted(existing_ids))[:65535]
-
-    share_link.save(update_fields=['total_visits', 'unique_visits', 'visitor_ids'])
-
-    payload = {
-        'name': share_link.name,
-        'token': share_link.token,
-        'total_visits': share_link.total_visits,
-        'unique_visits': share_link.unique_visits,
-    }
-    if share_link.yjs_blob is not None:
-        payload['yjs_blob'] = b64encode(share_link.yjs_blob).decode('ascii')
-    return JsonResponse(payload)
+    # Splice the per-request counts in front of the cached object instead of re-encoding it
+    counts = f'{{"total_visits": {share_link.total_visits}, "unique_visits": {share_link.unique_visits}, '
+    body = counts.encode() + share_link_static_body(share_link, etag)[1:]
+    return share_link_response(request, HttpResponse(body, content_type='application/json'), etag, last_modified)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def public_share_link_state(request: Request, token: str):
+    """
+    Public endpoint serving a share link's snapshot as application/octet-stream.
+    Visits are only counted by public_share_link_detail.
+    """
+    try:
+        share_link = public_share_links().get(token=token)
+    except ProjectShareLink.DoesNotExist:
+        return Response({'detail': 'Not found.'}, status=HTTP_404_NOT_FOUND)
+
+    if not share_link.snapshot_id:
+        return yjs_state_response(None)
+
+    # Snapshots are content-addressed, so their hash is a strong validator for the bytes
+    etag = f'"{share_link.snapshot.hash}"'
+    last_modified = int(share_link.updated_at.timestamp())
+    if not_modified := get_conditional_response(request, etag=etag, last_modified=last_modified):
+        return share_link_response(request, not_modified, etag, last_modified)
+
+    return share_link_response(request, yjs_state_response(share_link.yjs_blob), etag, last_modified)
@@ -1,11 +1,24 @@
 import uuid
 
+import fakeredis
 import jwt
 import pytest
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework.test import APIClient
 
 from accounts.models import User
+from projects import autosave, models as project_models
+from projects.management.commands import flush_share_link_visits, sync_yjs
+from utils import group_users
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Cached permissions are keyed by primary keys, which the test database reuses
+    cache.clear()
+    yield
+    cache.clear()
 
 
 @pytest.fixture
@@ -57,3 +70,18 @@ def auth_client(api_client: APIClient, user_factory, auth_header_factory):
     api_client.credentials(**auth_header_factory(user))
     return api_client, user
 
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    # One in-memory Redis behind every module-level client, with the Lua scripts registered on it
+    client = fakeredis.FakeRedis()
+
+    for module in (project_models, flush_share_link_visits, sync_yjs, autosave, group_users):
+        monkeypatch.setattr(module, "redis_client", client)
+
+    monkeypatch.setattr(sync_yjs, "get_redis_client", lambda purpose="default": client)
+    monkeypatch.setattr(autosave, "_queue_if_buffered", client.register_script(autosave.QUEUE_IF_BUFFERED_SCRIPT))
+    monkeypatch.setattr(group_users, "_claim_leader", client.register_script(group_users.CLAIM_LEADER_SCRIPT))
+    monkeypatch.setattr(group_users, "_release_leader", client.register_script(group_users.RELEASE_LEADER_SCRIPT))
+    return client
@@ -1,6 +1,7 @@
 import pytest
 
 from organizations.models import Organization, OrganizationMember
+from projects.models import OrganizationProject, Project
 
 
 @pytest.mark.django_db
@@ -115,3 +116,36 @@ def test_organization_filter_user_has_permission(api_client, user_factory, auth_
     assert org_manage.id in ids  # manage satisfies invite in hierarchy
     assert org_view.id not in ids
 
+
+
+@pytest.mark.django_db
+def test_organization_list_counts_match_detail(api_client, user_factory, auth_header_factory):
+    owner = user_factory(username="count_org_owner")
+    member = user_factory(username="count_org_member")
+    org = Organization.objects.create(owner=owner, slug="count-org", name="CountOrg")
+    org.add_member(member)
+    OrganizationProject.objects.create(organization=org, project=Project.objects.create(owner=owner, name="P"), permission="view")
+
+    api_client.credentials(**auth_header_factory(owner))
+    listed = next(o for o in api_client.get("/api/organizations/").data["results"] if o["id"] == org.id)
+    detail = api_client.get(f"/api/organizations/{org.id}/").data
+    assert listed["members_count"] == detail["members_count"] == 2
+    assert listed["projects_count"] == detail["projects_count"] == 1
+
+
+@pytest.mark.django_db
+def test_bulk_organization_invitations(api_client, user_factory, auth_header_factory):
+    owner = user_factory(username="bulk_org_owner")
+    banned = user_factory(username="bulk_org_banned")
+    invitees = [user_factory(username=f"bulk_org_invitee_{i}") for i in range(2)]
+    org = Organization.objects.create(owner=owner, slug="bulk-org", name="BulkOrg")
+    org.ban_user(banned, owner, reason="spam")
+
+    api_client.credentials(**auth_header_factory(owner))
+    url = f"/api/organizations/{org.id}/invitations/bulk/"
+    resp = api_client.post(url, [{"invitee_id": banned.id, "permission": "view"}], format="json")
+    assert resp.status_code == 400
+
+    resp = api_client.post(url, [{"invitee_id": u.id, "permission": "view"} for u in invitees], format="json")
+    assert resp.status_code == 201
+    assert org.invitations.count() == 2
@@ -1,10 +1,23 @@
 import base64
+import io
+import json
+import os
 
+import fakeredis
 import pytest
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from pycrdt import Doc, Text
 
-from organizations.models import Organization
-from projects.models import Project, ProjectCollaborator, ProjectGroup, OrganizationProject
+from organizations.models import Organization, OrganizationMember
+from projects import signals
+from projects.models import Project, ProjectCollaborator, ProjectGroup, ProjectShareLink, OrganizationProject, Snapshot
+from projects.management.commands.flush_share_link_visits import Command as FlushShareLinkVisitsCommand
+from projects.signals import serialize_share_link_without_state
+from utils.redis_client import pack_binary_message
 
 
 @pytest.mark.django_db
@@ -237,12 +250,554 @@ def test_project_list_omits_state_fields(api_client, user_factory, auth_header_f
 def test_public_share_link_endpoint_returns_base64_blob(api_client, user_factory):
     owner = user_factory(username="share_owner")
     project = Project.objects.create(owner=owner, name="P", yjs_blob=b"blob")
-    from projects.models import ProjectShareLink
 
-    share = ProjectShareLink.objects.create(project=project, name="S", token="tok", yjs_blob=b"blob")
+    share = ProjectShareLink.objects.create(project=project, name="S", token="tok", snapshot=Snapshot.for_state(b"blob"))
 
     resp = api_client.get(f"/api/share/{share.token}/", {"visitor_id": "v1"})
     assert resp.status_code == 200
     assert resp.json()["token"] == share.token
     assert resp.json()["yjs_blob"] == base64.b64encode(b"blob").decode("ascii")
 
+
+@pytest.mark.django_db
+def test_public_share_link_conditional_get(api_client, user_factory):
+    owner = user_factory(username="etag_owner")
+    project = Project.objects.create(owner=owner, name="P", yjs_blob=b"blob")
+    share = ProjectShareLink.objects.create(project=project, name="S", token="etag", snapshot=Snapshot.for_state(b"blob"))
+
+    resp = api_client.get(f"/api/share/{share.token}/")
+    assert resp.status_code == 200
+    assert "public" in resp["Cache-Control"] and resp["Last-Modified"]
+    etag = resp["ETag"]
+    assert resp.json()["yjs_blob"] == base64.b64encode(b"blob").decode("ascii")
+
+    resp = api_client.get(f"/api/share/{share.token}/", HTTP_IF_NONE_MATCH=etag)
+    assert resp.status_code == 304
+    assert resp["ETag"] == etag and not resp.content
+
+    # The snapshot bytes are validated by their content hash
+    resp = api_client.get(f"/api/share/{share.token}/state/")
+    assert resp.status_code == 200 and resp.content == b"blob"
+    resp = api_client.get(f"/api/share/{share.token}/state/", HTTP_IF_NONE_MATCH=resp["ETag"])
+    assert resp.status_code == 304
+
+    # Renaming the link changes the validator, so clients get the new body
+    share.name = "Renamed"
+    share.save()
+    resp = api_client.get(f"/api/share/{share.token}/", HTTP_IF_NONE_MATCH=etag)
+    assert resp.status_code == 200
+    assert resp.json()["name"] == "Renamed"
+
+
+
+@pytest.mark.django_db
+def test_share_links_share_deduplicated_snapshots(api_client, user_factory, auth_header_factory):
+    owner = user_factory(username="snapshot_owner")
+    project = Project.objects.create(owner=owner, name="P", yjs_blob=b"state-1")
+
+    api_client.credentials(**auth_header_factory(owner))
+    first = api_client.post(f"/api/projects/{project.id}/share-links/", {"name": "A"}, format="json")
+    second = api_client.post(f"/api/projects/{project.id}/share-links/", {"name": "B"}, format="json")
+    assert first.status_code == 201 and second.status_code == 201
+    assert Snapshot.objects.count() == 1
+
+    # Refreshing onto new state moves the link to a new snapshot; the old one is still referenced
+    Project.objects.filter(id=project.id).update(yjs_blob=b"state-2")
+    resp = api_client.post(f"/api/projects/{project.id}/share-links/{first.data['id']}/refresh/")
+    assert resp.status_code == 200
+    assert resp.data["yjs_blob"] == base64.b64encode(b"state-2").decode("ascii")
+    assert Snapshot.objects.count() == 2
+
+    # Deleting the last link that references a snapshot garbage-collects it
+    ProjectShareLink.objects.get(id=second.data["id"]).delete()
+    assert list(Snapshot.objects.values_list("hash", flat=True)) == [Snapshot.hash_state(b"state-2")]
+
+
+@pytest.mark.django_db
+def test_set_state_saves_and_referenced_snapshots_are_not_released(user_factory):
+    project = Project.objects.create(owner=user_factory(username="set_state_owner"), name="P")
+    share = ProjectShareLink(project=project, name="S", token="set-state")
+    share.set_state(b"blob")
+
+    assert ProjectShareLink.objects.get(pk=share.pk).snapshot_id == share.snapshot_id
+
+    Snapshot.release(share.snapshot_id)
+    assert Snapshot.objects.filter(pk=share.snapshot_id).exists()
+
+    snapshot_id = share.snapshot_id
+    share.set_state(None)
+    assert ProjectShareLink.objects.get(pk=share.pk).snapshot_id is None
+    assert not Snapshot.objects.filter(pk=snapshot_id).exists()
+
+
+@pytest.mark.django_db
+def test_state_endpoints_return_raw_bytes(api_client, user_factory, auth_header_factory):
+    owner = user_factory(username="state_owner")
+    project = Project.objects.create(owner=owner, name="P", yjs_blob=b"\x00\x01raw-state")
+
+    api_client.credentials(**auth_header_factory(owner))
+    resp = api_client.get(f"/api/projects/{project.id}/state/")
+    assert resp.status_code == 200
+    assert resp["Content-Type"] == "application/octet-stream"
+    assert resp.content == b"\x00\x01raw-state"
+
+    resp = api_client.get(f"/api/projects/{project.id}/?include_state=false")
+    assert resp.status_code == 200
+    assert "yjs_blob" not in resp.data
+
+    share = api_client.post(f"/api/projects/{project.id}/share-links/", {"name": "S"}, format="json")
+    api_client.credentials()
+    resp = api_client.get(f"/api/share/{share.data['token']}/state/")
+    assert resp.status_code == 200
+    assert resp.content == b"\x00\x01raw-state"
+
+
+def test_pack_binary_message_frames_header_and_payload():
+    message = pack_binary_message({"project_id": 1}, b"\xff\x00")
+    header_length = int.from_bytes(message[:4], "big")
+    assert message[4:4 + header_length] == b'{"project_id": 1}'
+    assert message[4 + header_length:] == b"\xff\x00"
+
+
+@pytest.mark.django_db
+def test_project_list_does_not_load_yjs_state(api_client, user_factory, auth_header_factory):
+    user = user_factory(username="deferred_user")
+    Project.objects.create(owner=user, name="P", yjs_blob=b"state" * 1000)
+
+    api_client.credentials(**auth_header_factory(user))
+    with CaptureQueriesContext(connection) as ctx:
+        resp = api_client.get("/api/projects/")
+    assert resp.status_code == 200
+    assert not any("yjs_blob" in query["sql"] for query in ctx.captured_queries)
+
+
+@pytest.mark.django_db
+def test_with_permission_resolves_highest_permission_in_one_query(user_factory, django_assert_num_queries):
+    owner = user_factory(username="rank_owner")
+    member = user_factory(username="rank_member")
+    org = Organization.objects.create(owner=owner, slug="rank-org", name="RankOrg")
+    org.add_member(member)
+
+    collaborated = Project.objects.create(owner=owner, name="Collaborated")
+    ProjectCollaborator.objects.create(project=collaborated, collaborator=member, permission="view")
+    OrganizationProject.objects.create(organization=org, project=collaborated, permission="invite")
+    unrelated = Project.objects.create(owner=owner, name="Unrelated")
+    owned = Project.objects.create(owner=member, name="Owned")
+
+    with django_assert_num_queries(1):
+        projects = {p.id: p for p in Project.objects.with_permission(member)}
+        assert projects[collaborated.id].get_permission(member) == "invite"
+        assert projects[collaborated.id].has_permission(member, "code")
+        assert not projects[collaborated.id].has_permission(member, "admin")
+        assert projects[unrelated.id].get_permission(member) is None
+        assert projects[owned.id].get_permission(member) == "owner"
+
+    # Without the annotation the permission is computed (and memoized) with one query
+    project = Project.objects.get(id=collaborated.id)
+    with django_assert_num_queries(1):
+        assert project.get_permission(member) == "invite"
+        assert project.has_permission(member, "invite")
+
+
+@pytest.mark.django_db
+def test_project_list_query_count_does_not_grow_with_rows(api_client, user_factory, auth_header_factory):
+    user = user_factory(username="count_user")
+    forker = user_factory(username="count_forker")
+    api_client.credentials(**auth_header_factory(user))
+
+    def list_projects():
+        with CaptureQueriesContext(connection) as ctx:
+            resp = api_client.get("/api/projects/")
+        assert resp.status_code == 200
+        return resp, len(ctx.captured_queries)
+
+    Project.objects.create(owner=user, name="P0")
+    _, baseline = list_projects()
+
+    for i in range(1, 5):
+        project = Project.objects.create(owner=user, name=f"P{i}")
+        project.forked_by.add(forker)
+
+    resp, queries = list_projects()
+    assert queries == baseline
+    assert {p["fork_count"] for p in resp.data["results"]} == {0, 1}
+
+
+@pytest.mark.django_db
+def test_counters_follow_forks_and_memberships_and_recount_repairs_drift(
+    api_client, user_factory, auth_header_factory
+):
+    owner = user_factory(username="counter_owner")
+    forker = user_factory(username="counter_forker")
+    project = Project.objects.create(owner=owner, name="P", published_at=timezone.now())
+    org = Organization.objects.create(owner=owner, slug="counter-org", name="CounterOrg")
+    org.add_member(forker)
+    OrganizationProject.objects.create(organization=org, project=project, permission="view")
+
+    stale = Project.objects.get(pk=project.pk)
+    api_client.credentials(**auth_header_factory(forker))
+    assert api_client.post(f"/api/projects/{project.id}/fork/").status_code == 200
+
+    # Saving a copy loaded before the fork must not overwrite the counter
+    stale.name = "Renamed"
+    stale.save()
+    project.refresh_from_db()
+    org.refresh_from_db()
+    assert project.fork_count == 1
+    assert (org.members_count, org.projects_count) == (1, 1)
+    assert Project.objects.get(owner=forker).fork_count == 0
+
+    OrganizationMember.objects.filter(organization=org, member=forker).delete()
+    org.refresh_from_db()
+    assert org.members_count == 0
+
+    Project.objects.filter(pk=project.pk).update(fork_count=7)
+    call_command("recount", stdout=open(os.devnull, "w"))
+    project.refresh_from_db()
+    assert project.fork_count == 1
+
+
+@pytest.mark.django_db
+def test_share_link_visit_counts_apply_without_losing_unique_floor(user_factory):
+    owner = user_factory(username="visits_owner")
+    project = Project.objects.create(owner=owner, name="P", yjs_blob=b"blob")
+    share = ProjectShareLink.objects.create(project=project, name="S", token="visits", total_visits=3, unique_visits=5)
+
+    ProjectShareLink.apply_visit_counts(share.pk, visits=4, unique_visitors=2)
+    share.refresh_from_db()
+    assert (share.total_visits, share.unique_visits) == (7, 5)
+
+    ProjectShareLink.apply_visit_counts(share.pk, visits=1, unique_visitors=9)
+    share.refresh_from_db()
+    assert (share.total_visits, share.unique_visits) == (8, 9)
+
+
+@pytest.mark.django_db
+def test_share_link_visits_are_counted_in_redis_and_flushed(user_factory, fake_redis, django_assert_num_queries):
+    project = Project.objects.create(owner=user_factory(username="record_visits_owner"), name="P")
+    share = ProjectShareLink.objects.create(project=project, name="S", token="record", total_visits=10, unique_visits=1)
+
+    with django_assert_num_queries(0):
+        for visitor_id in ["a", "b", "a"]:
+            share.record_visit(visitor_id)
+
+    # Each request's instance shows the stored counts plus the pending ones
+    stored = ProjectShareLink.objects.get(pk=share.pk)
+    assert (stored.total_visits, stored.unique_visits) == (10, 1)
+    stored.record_visit(None)
+    assert (stored.total_visits, stored.unique_visits) == (14, 2)
+    assert fake_redis.smembers(ProjectShareLink.VISITS_DIRTY_KEY) == {str(share.pk).encode()}
+
+    FlushShareLinkVisitsCommand().flush(batch_size=10)
+
+    stored.refresh_from_db()
+    assert (stored.total_visits, stored.unique_visits) == (14, 2)
+    assert not fake_redis.exists(f"{ProjectShareLink.VISITS_KEY_PREFIX}:{share.pk}", ProjectShareLink.VISITS_DIRTY_KEY)
+
+    # Nothing pending: a second flush changes nothing
+    FlushShareLinkVisitsCommand().flush(batch_size=10)
+    stored.refresh_from_db()
+    assert stored.total_visits == 14
+
+
+@pytest.mark.django_db
+def test_share_link_visits_fall_back_to_the_database_without_redis(user_factory, monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr("projects.models.redis_client", fakeredis.FakeRedis(server=server))
+    project = Project.objects.create(owner=user_factory(username="fallback_visits_owner"), name="P")
+    share = ProjectShareLink.objects.create(project=project, name="S", token="fallback", total_visits=2)
+
+    share.record_visit("a")
+
+    assert share.total_visits == 3
+    share.refresh_from_db()
+    assert (share.total_visits, share.unique_visits) == (3, 0)
+
+
+@pytest.mark.django_db
+def test_share_link_visit_flush_gives_counts_back_on_failure(user_factory, fake_redis, monkeypatch):
+    project = Project.objects.create(owner=user_factory(username="failed_flush_owner"), name="P")
+    share = ProjectShareLink.objects.create(project=project, name="S", token="failed")
+    other = ProjectShareLink.objects.create(project=project, name="O", token="flushed")
+    share.record_visit("a")
+    share.record_visit("b")
+    other.record_visit("c")
+    apply_visit_counts = ProjectShareLink.apply_visit_counts
+
+    def fail(pk, *args, **kwargs):
+        if pk == share.pk:
+            raise RuntimeError("database unavailable")
+        return apply_visit_counts(pk, *args, **kwargs)
+
+    # One failing link neither stops the flush nor strands the other popped links
+    with monkeypatch.context() as patch:
+        patch.setattr(ProjectShareLink, "apply_visit_counts", fail)
+        FlushShareLinkVisitsCommand().flush(batch_size=10)
+
+    assert fake_redis.get(f"{ProjectShareLink.VISITS_KEY_PREFIX}:{share.pk}") == b"2"
+    assert fake_redis.smembers(ProjectShareLink.VISITS_DIRTY_KEY) == {str(share.pk).encode()}
+    other.refresh_from_db()
+    assert other.total_visits == 1
+
+    FlushShareLinkVisitsCommand().flush(batch_size=10)
+
+    share.refresh_from_db()
+    assert (share.total_visits, share.unique_visits) == (2, 2)
+
+
+def test_share_link_visit_flush_interval_survives_errors(fake_redis, monkeypatch):
+    def fail(self, batch_size):
+        raise RuntimeError("redis unavailable")
+
+    def interrupt(seconds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(FlushShareLinkVisitsCommand, "flush", fail)
+    monkeypatch.setattr("projects.management.commands.flush_share_link_visits.time.sleep", interrupt)
+    stderr = io.StringIO()
+
+    call_command("flush_share_link_visits", interval=5, stderr=stderr)
+
+    assert "redis unavailable" in stderr.getvalue()
+
+
+@pytest.mark.django_db
+def test_project_detail_response_cache(api_client, user_factory, auth_header_factory):
+    owner = user_factory(username="detail_owner")
+    viewer = user_factory(username="detail_viewer")
+    project = Project.objects.create(owner=owner, name="P", yjs_blob=b"state")
+    ProjectCollaborator.objects.create(project=project, collaborator=viewer, permission="view")
+
+    api_client.credentials(**auth_header_factory(owner))
+    first = api_client.get(f"/api/projects/{project.id}/")
+    assert first.status_code == 200
+
+    # A repeated load is served from the cache without reading the state
+    with CaptureQueriesContext(connection) as ctx:
+        again = api_client.get(f"/api/projects/{project.id}/")
+    assert again.data == first.data
+    assert not any("yjs_blob" in query["sql"] for query in ctx.captured_queries)
+
+    # Renderings are per permission tier
+    api_client.credentials(**auth_header_factory(viewer))
+    assert api_client.get(f"/api/projects/{project.id}/").data["permission"] == "view"
+
+    # Counter updates do not touch updated_at, so they invalidate through the signals
+    project.forked_by.add(viewer)
+    api_client.credentials(**auth_header_factory(owner))
+    assert api_client.get(f"/api/projects/{project.id}/").data["fork_count"] == 1
+
+    project.refresh_from_db()
+    project.name = "Renamed"
+    project.save()
+    assert api_client.get(f"/api/projects/{project.id}/").data["name"] == "Renamed"
+
+
+@pytest.mark.django_db
+def test_bulk_add_collaborators(api_client, user_factory, auth_header_factory, monkeypatch):
+    owner = user_factory(username="bulk_owner")
+    inviter = user_factory(username="bulk_inviter")
+    students = [user_factory(username=f"bulk_student_{i}") for i in range(3)]
+    project = Project.objects.create(owner=owner, name="P")
+    ProjectCollaborator.objects.create(project=project, collaborator=inviter, permission="invite")
+
+    published = []
+    monkeypatch.setattr(signals, "publish_on_commit", lambda channel, message: published.append((channel, message)))
+
+    api_client.credentials(**auth_header_factory(inviter))
+    url = f"/api/projects/{project.id}/collaborators/bulk/"
+    resp = api_client.post(url, [{"collaborator_id": s.id, "permission": "code"} for s in students], format="json")
+    assert resp.status_code == 201
+    assert {c["collaborator"]["id"] for c in resp.data} == {s.id for s in students}
+    assert project.project_collaborators.count() == 4
+
+    # One coalesced message for the whole batch
+    assert len(published) == 1
+    message = json.loads(published[0][1])
+    assert message["event"] == "collaborator_added"
+    assert message["collaborators"] == {str(s.id): "code" for s in students}
+    assert len(message["project_collaborators"]) == 3
+
+    # Items are validated against the requester's permission, and conflicts reject the whole batch
+    extra = user_factory(username="bulk_extra")
+    resp = api_client.post(url, [{"collaborator_id": extra.id, "permission": "admin"}], format="json")
+    assert resp.status_code == 400
+    resp = api_client.post(url, [{"collaborator_id": extra.id, "permission": "view"}, {"collaborator_id": students[0].id, "permission": "view"}], format="json")
+    assert resp.status_code == 400
+    assert not project.project_collaborators.filter(collaborator=extra).exists()
+
+
+@pytest.mark.django_db
+def test_bulk_project_invitations_reject_existing_members(api_client, user_factory, auth_header_factory):
+    owner = user_factory(username="bulk_inv_owner")
+    member = user_factory(username="bulk_inv_member")
+    invitees = [user_factory(username=f"bulk_invitee_{i}") for i in range(2)]
+    project = Project.objects.create(owner=owner, name="P")
+    ProjectCollaborator.objects.create(project=project, collaborator=member, permission="view")
+
+    api_client.credentials(**auth_header_factory(owner))
+    url = f"/api/projects/{project.id}/invitations/bulk/"
+    resp = api_client.post(url, [{"invitee_id": member.id, "permission": "view"}], format="json")
+    assert resp.status_code == 400
+
+    resp = api_client.post(url, [{"invitee_id": u.id, "permission": "code"} for u in invitees], format="json")
+    assert resp.status_code == 201
+    assert all(invitation["inviter"]["id"] == owner.id for invitation in resp.data)
+    assert project.invitations.count() == 2
+
+
+@pytest.mark.django_db
+def test_get_permissions_resolves_many_users_at_once(user_factory, django_assert_num_queries):
+    owner = user_factory(username="perms_owner")
+    collaborator = user_factory(username="perms_collaborator")
+    member = user_factory(username="perms_member")
+    stranger = user_factory(username="perms_stranger")
+    org = Organization.objects.create(owner=owner, slug="perms-org", name="PermsOrg")
+    org.add_member(member)
+
+    project = Project.objects.create(owner=owner, name="P")
+    ProjectCollaborator.objects.create(project=project, collaborator=collaborator, permission="code")
+    OrganizationProject.objects.create(organization=org, project=project, permission="admin")
+
+    with django_assert_num_queries(1):
+        permissions = project.get_permissions([owner.id, collaborator.id, member.id, stranger.id])
+        assert project.get_permission(member) == "admin"
+
+    assert permissions == {owner.id: "owner", collaborator.id: "code", member.id: "admin", stranger.id: None}
+
+
+@pytest.mark.django_db
+def test_organization_project_changes_are_broadcast_once_per_transaction(
+    user_factory, monkeypatch, django_capture_on_commit_callbacks, django_assert_max_num_queries
+):
+    owner = user_factory(username="broadcast_owner")
+    members = [user_factory(username=f"broadcast_member_{i}") for i in range(5)]
+    first = Organization.objects.create(owner=owner, slug="broadcast-a", name="A")
+    second = Organization.objects.create(owner=owner, slug="broadcast-b", name="B")
+    for member in members:
+        first.add_member(member)
+    project = Project.objects.create(owner=owner, name="P")
+
+    published = []
+    monkeypatch.setattr(signals, "publish_on_commit", lambda channel, message: published.append(json.loads(message)))
+    monkeypatch.setattr(signals, "get_project_connected_users", lambda project_id: [owner.id, *(m.id for m in members)])
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        with transaction.atomic():
+            OrganizationProject.objects.create(organization=first, project=project, permission="code")
+            OrganizationProject.objects.create(organization=second, project=project, permission="view")
+    assert not published
+
+    # Permissions for every connected user come from a single query, however many are connected
+    with django_assert_max_num_queries(1):
+        for callback in callbacks:
+            callback()
+
+    assert len(published) == 1
+    message = published[0]
+    assert [change["organization_id"] for change in message["organization_changes"]] == [first.id, second.id]
+    assert message["collaborators"][str(owner.id)] == "owner"
+    assert all(message["collaborators"][str(m.id)] == "code" for m in members)
+
+
+@pytest.mark.django_db
+def test_organization_project_changes_in_rolled_back_savepoints_are_not_broadcast(
+    user_factory, monkeypatch, django_capture_on_commit_callbacks
+):
+    owner = user_factory(username="savepoint_broadcast_owner")
+    first = Organization.objects.create(owner=owner, slug="savepoint-a", name="A")
+    second = Organization.objects.create(owner=owner, slug="savepoint-b", name="B")
+    project = Project.objects.create(owner=owner, name="P")
+
+    published = []
+    monkeypatch.setattr(signals, "publish_on_commit", lambda channel, message: published.append(json.loads(message)))
+    monkeypatch.setattr(signals, "get_project_connected_users", lambda project_id: [owner.id])
+
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            OrganizationProject.objects.create(organization=first, project=project, permission="code")
+            try:
+                with transaction.atomic():
+                    OrganizationProject.objects.create(organization=second, project=project, permission="view")
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+    assert len(published) == 1
+    assert [change["organization_id"] for change in published[0]["organization_changes"]] == [first.id]
+
+    # A transaction that rolls back leaves nothing behind for the next one
+    published.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        try:
+            with transaction.atomic():
+                OrganizationProject.objects.filter(project=project).update(permission="view")
+                OrganizationProject.objects.get(project=project).delete()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        with transaction.atomic():
+            OrganizationProject.objects.create(organization=second, project=project, permission="admin")
+
+    assert [[change["organization_id"] for change in message["organization_changes"]] for message in published] == [[second.id]]
+
+
+@pytest.mark.django_db
+def test_share_link_events_do_not_load_the_snapshot(user_factory, django_assert_num_queries):
+    project = Project.objects.create(owner=user_factory(username="share_event_owner"), name="P")
+    share = ProjectShareLink.objects.create(project=project, name="S", token="event", snapshot=Snapshot.for_state(b"blob"))
+    share = ProjectShareLink.objects.get(pk=share.pk)
+
+    with django_assert_num_queries(0):
+        data = serialize_share_link_without_state(share)
+
+    assert data["token"] == "event" and data["project"] == project.id
+    assert "yjs_blob" not in data
+
+
+@pytest.mark.django_db
+def test_partial_update_does_not_load_or_rewrite_yjs_state(api_client, user_factory, auth_header_factory):
+    owner = user_factory(username="patch_state_owner")
+    project = Project.objects.create(owner=owner, name="P", yjs_blob=b"state" * 1000)
+
+    api_client.credentials(**auth_header_factory(owner))
+    with CaptureQueriesContext(connection) as ctx:
+        resp = api_client.patch(f"/api/projects/{project.id}/", {"name": "Renamed"}, format="json")
+    assert resp.status_code == 200
+    assert resp.json()["name"] == "Renamed" and "yjs_blob" not in resp.json()
+    assert not any("yjs_blob" in query["sql"] or "yjs_state_vector" in query["sql"] for query in ctx.captured_queries)
+
+    project.refresh_from_db()
+    assert bytes(project.yjs_blob) == b"state" * 1000
+
+    # A state sent with the update is still appended to the project
+    other = Project.objects.create(owner=owner, name="Q")
+    doc = Doc()
+    doc.get("t", type=Text).insert(0, "saved")
+    resp = api_client.patch(
+        f"/api/projects/{other.id}/", {"yjs_blob": base64.b64encode(doc.get_update()).decode("ascii")}, format="json"
+    )
+    assert resp.status_code == 200
+
+    saved = Doc()
+    saved.apply_update(Project.objects.get(pk=other.pk).get_yjs_state())
+    assert str(saved.get("t", type=Text)) == "saved"
+
+
+@pytest.mark.django_db
+def test_replacing_a_thumbnail_keeps_the_new_file_and_deletes_the_old(user_factory, settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+    project = Project.objects.create(owner=user_factory(username="thumbnail_owner"), name="P")
+    project.thumbnail.save("old.png", ContentFile(b"old"))
+    old_name = project.thumbnail.name
+
+    project = Project.objects.get(pk=project.pk)
+    project.thumbnail = ContentFile(b"new", name="new.png")
+    project.save()
+
+    project.refresh_from_db()
+    assert project.thumbnail.name and project.thumbnail.name != old_name
+    assert project.thumbnail.storage.exists(project.thumbnail.name)
+    assert not project.thumbnail.storage.exists(old_name)
@@ -0,0 +1,341 @@
+import os
+import signal
+import socket
+
+import pytest
+from pycrdt import Doc, Text
+
+from projects.management.commands.sync_yjs import (
+    MAX_PERSIST_ATTEMPTS,
+    PERSIST_FAILURES_KEY,
+    UPDATES_PENDING_SET_KEY,
+    UPDATES_QUEUE_KEY,
+    Command,
+    get_buffer_key,
+    get_dead_letter_key,
+    get_heartbeat_key,
+    get_inflight_key,
+    get_lease_key,
+    get_processing_key,
+)
+from projects.models import Project
+
+
+def _doc_state(text: str) -> bytes:
+    doc = Doc()
+    doc.get("t", type=Text).insert(0, text)
+    return doc.get_update()
+
+
+def _decode_text(state: bytes) -> str:
+    doc = Doc()
+    doc.apply_update(state)
+    return str(doc.get("t", type=Text))
+
+
+def _worker(worker_id: str, token: str) -> Command:
+    command = Command()
+    command.register_scripts()
+    command.worker_id = worker_id
+    command.worker_token = token
+    command.processing_key = get_processing_key(worker_id)
+    return command
+
+
+@pytest.mark.django_db
+def test_persist_buffers_appends_updates_and_renames(user_factory):
+    owner = user_factory(username="sync_owner")
+    p1 = Project.objects.create(owner=owner, name="One")
+    p2 = Project.objects.create(owner=owner, name="Two")
+    previous_updated_at = p1.updated_at
+
+    saved_ids = Command().persist_buffers({
+        str(p1.id): {b"blob": _doc_state("first"), b"name": b"Renamed"},
+        str(p2.id): {b"blob": _doc_state("second")},
+        "999999": {b"blob": b"missing"},
+        "undefined": {b"blob": b"invalid"},
+    })
+
+    assert sorted(saved_ids) == sorted([str(p1.id), str(p2.id)])
+
+    p1.refresh_from_db()
+    p2.refresh_from_db()
+    assert p1.yjs_blob is None
+    assert p1.yjs_seq == 1
+    assert _decode_text(p1.get_yjs_state()) == "first"
+    assert p1.name == "Renamed"
+    assert p1.updated_at > previous_updated_at
+    assert _decode_text(p2.get_yjs_state()) == "second"
+    assert p2.name == "Two"
+
+
+@pytest.mark.django_db
+def test_appended_updates_only_hold_new_changes_and_compact(user_factory):
+    owner = user_factory(username="sync_compact_owner")
+    project = Project.objects.create(owner=owner, name="P")
+
+    doc = Doc()
+    text = doc.get("t", type=Text)
+    text += "hello" * 100
+    project.append_yjs_state(doc.get_update())
+    text += " world"
+    full_state = doc.get_update()
+    delta = project.append_yjs_state(full_state)
+
+    assert len(delta) < len(full_state)
+    assert project.yjs_updates.count() == 2
+    assert _decode_text(project.get_yjs_state()) == "hello" * 100 + " world"
+
+    assert project.compact_yjs_updates() == 2
+
+    project.refresh_from_db()
+    assert project.yjs_updates.count() == 0
+    assert _decode_text(bytes(project.yjs_blob)) == "hello" * 100 + " world"
+    assert _decode_text(project.get_yjs_state()) == "hello" * 100 + " world"
+
+
+@pytest.mark.django_db
+def test_state_read_from_a_stale_instance_survives_a_compaction(user_factory):
+    owner = user_factory(username="sync_stale_owner")
+    project = Project.objects.create(owner=owner, name="P")
+    stale = Project.objects.get(pk=project.pk)
+
+    project.append_yjs_state(_doc_state("compacted"))
+    project.compact_yjs_updates()
+
+    assert stale.yjs_blob is None
+    assert _decode_text(stale.get_yjs_state()) == "compacted"
+
+
+def test_contended_ids_go_back_to_the_queue_and_leave_the_processing_list(fake_redis):
+    owner = _worker("a", "token-a")
+    other = _worker("b", "token-b")
+    fake_redis.rpush(UPDATES_QUEUE_KEY, "1")
+    assert owner.drain_queue(10) == ["1"]
+    assert owner.claim_leases(["1"]) == ["1"]
+
+    fake_redis.rpush(UPDATES_QUEUE_KEY, "1", "2", "2")
+    assert other.drain_queue(10) == ["1", "2"]
+
+    assert other.claim_leases(["1", "2"]) == ["2"]
+    assert fake_redis.lrange(UPDATES_QUEUE_KEY, 0, -1) == [b"1"]
+    assert fake_redis.lrange(other.processing_key, 0, -1) == [b"2", b"2"]
+    assert fake_redis.get(get_lease_key("1")) == b"token-a"
+    assert fake_redis.get(get_lease_key("2")) == b"token-b"
+
+
+def test_leases_are_only_released_by_their_token(fake_redis):
+    worker = _worker("a", "token-a")
+    assert worker.claim_leases(["1", "2"]) == ["1", "2"]
+    # The lease on 2 expired and another worker took it over
+    fake_redis.set(get_lease_key("2"), "token-b")
+
+    worker.release_leases(["1", "2"])
+
+    assert not fake_redis.exists(get_lease_key("1"))
+    assert fake_redis.get(get_lease_key("2")) == b"token-b"
+
+
+@pytest.mark.django_db
+def test_sigterm_drains_the_current_batch_before_stopping(fake_redis, user_factory, monkeypatch):
+    project = Project.objects.create(owner=user_factory(username="sync_drain_owner"), name="P")
+    fake_redis.hset(get_buffer_key(str(project.id)), mapping={"blob": _doc_state("drained")})
+    fake_redis.sadd(UPDATES_PENDING_SET_KEY, str(project.id))
+    fake_redis.rpush(UPDATES_QUEUE_KEY, str(project.id))
+
+    command = Command()
+    command.register_scripts()
+    command.reconcile_interval = 60
+    drain_queue = command.drain_queue
+
+    def drain_and_terminate(batch_size):
+        project_ids = drain_queue(batch_size)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return project_ids
+
+    monkeypatch.setattr(command, "drain_queue", drain_and_terminate)
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    try:
+        command.run_worker(batch_size=10)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    assert _decode_text(project.get_yjs_state()) == "drained"
+    assert not fake_redis.exists(command.processing_key)
+    assert not fake_redis.exists(get_lease_key(str(project.id)))
+    assert not fake_redis.exists(get_heartbeat_key(command.worker_id))
+    assert fake_redis.llen(UPDATES_QUEUE_KEY) == 0
+
+
+@pytest.mark.django_db
+def test_leases_outlive_the_acknowledgement_and_worker_ids_are_per_run(fake_redis, user_factory, monkeypatch):
+    project = Project.objects.create(owner=user_factory(username="sync_ack_owner"), name="P")
+    fake_redis.hset(get_buffer_key(str(project.id)), mapping={"blob": _doc_state("acked")})
+    fake_redis.sadd(UPDATES_PENDING_SET_KEY, str(project.id))
+    fake_redis.rpush(UPDATES_QUEUE_KEY, str(project.id))
+
+    command = Command()
+    command.register_scripts()
+    command.reconcile_interval = 60
+    acknowledge = command.acknowledge
+    leased_during_ack = []
+
+    def acknowledge_and_terminate(project_ids):
+        leased_during_ack.extend(fake_redis.exists(get_lease_key(project_id)) for project_id in project_ids)
+        acknowledge(project_ids)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    monkeypatch.setattr(command, "acknowledge", acknowledge_and_terminate)
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    try:
+        command.run_worker(batch_size=10)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    assert leased_during_ack == [1]
+    assert not fake_redis.exists(get_lease_key(str(project.id)))
+    assert command.worker_id.startswith(f"{socket.gethostname()}:{os.getpid()}:")
+    assert command.worker_id.endswith(command.worker_token[:8])
+
+
+def _store(client, project_id: str, blob: bytes) -> None:
+    # What the Hocuspocus server does when it buffers a document
+    client.hset(get_buffer_key(project_id), mapping={"blob": blob})
+    if client.sadd(UPDATES_PENDING_SET_KEY, project_id):
+        client.rpush(UPDATES_QUEUE_KEY, project_id)
+
+
+def test_claimed_buffers_move_in_flight_until_acknowledged(fake_redis):
+    worker = _worker("a", "token-a")
+    _store(fake_redis, "1", b"state")
+    _store(fake_redis, "2", b"other")
+
+    assert worker.drain_queue(10) == ["1", "2"]
+    assert fake_redis.lrange(worker.processing_key, 0, -1) == [b"2", b"1"]
+
+    buffers = worker.claim_buffers(["1", "2", "3"])
+
+    assert buffers == {"1": {b"blob": b"state"}, "2": {b"blob": b"other"}}
+    assert not fake_redis.exists(get_buffer_key("1"))
+    assert fake_redis.hget(get_inflight_key("1"), "blob") == b"state"
+    assert fake_redis.smembers(UPDATES_PENDING_SET_KEY) == set()
+
+    worker.acknowledge(["1", "2"])
+
+    assert not fake_redis.exists(get_inflight_key("1"), get_inflight_key("2"), worker.processing_key)
+
+
+def test_restore_prefers_newer_buffers_and_queues_once(fake_redis):
+    worker = _worker("a", "token-a")
+    for project_id in ("1", "2"):
+        _store(fake_redis, project_id, b"old")
+    worker.drain_queue(10)
+    worker.claim_buffers(["1", "2"])
+    # A newer state for 2 arrives while the batch is in flight
+    _store(fake_redis, "2", b"new")
+
+    worker.restore_projects(worker.processing_key, ["1", "2"])
+
+    assert fake_redis.hget(get_buffer_key("1"), "blob") == b"old"
+    assert fake_redis.hget(get_buffer_key("2"), "blob") == b"new"
+    assert not fake_redis.exists(get_inflight_key("1"), get_inflight_key("2"), worker.processing_key)
+    assert fake_redis.smembers(UPDATES_PENDING_SET_KEY) == {b"1", b"2"}
+    assert sorted(fake_redis.lrange(UPDATES_QUEUE_KEY, 0, -1)) == [b"1", b"2"]
+
+
+def test_reconcile_recovers_dead_workers_and_orphaned_ids(fake_redis):
+    live = _worker("live", "token-live")
+    dead = _worker("dead", "token-dead")
+    live.heartbeat()
+    for project_id in ("1", "2", "3"):
+        _store(fake_redis, project_id, project_id.encode())
+    live.drain_queue(1)
+    dead.drain_queue(1)
+    dead.claim_buffers(["2"])
+    # 3 is pending but was lost from the queue
+    fake_redis.lrem(UPDATES_QUEUE_KEY, 0, "3")
+
+    _worker("reconciler", "token-reconciler").reconcile()
+
+    assert fake_redis.lrange(live.processing_key, 0, -1) == [b"1"]
+    assert not fake_redis.exists(dead.processing_key, get_inflight_key("2"))
+    assert fake_redis.hget(get_buffer_key("2"), "blob") == b"2"
+    assert sorted(fake_redis.lrange(UPDATES_QUEUE_KEY, 0, -1)) == [b"2", b"3"]
+
+
+@pytest.mark.django_db
+def test_one_bad_document_does_not_hold_back_its_batch(user_factory):
+    owner = user_factory(username="sync_isolation_owner")
+    good = Project.objects.create(owner=owner, name="Good")
+    bad = Project.objects.create(owner=owner, name="Bad")
+
+    saved_ids, failures = Command().persist({
+        str(good.id): {b"blob": _doc_state("kept")},
+        str(bad.id): {b"blob": b"not a yjs update"},
+    })
+
+    assert saved_ids == [str(good.id)]
+    assert list(failures) == [str(bad.id)]
+    assert _decode_text(good.get_yjs_state()) == "kept"
+    assert bad.get_yjs_state() is None
+
+
+def test_repeatedly_failing_projects_are_dead_lettered(fake_redis):
+    worker = _worker("a", "token-a")
+
+    for attempt in range(1, MAX_PERSIST_ATTEMPTS + 1):
+        _store(fake_redis, "1", b"bad")
+        worker.drain_queue(10)
+        worker.claim_buffers(["1"])
+        worker.handle_failures({"1": ValueError("Cannot encode state vector from update")})
+
+        if attempt < MAX_PERSIST_ATTEMPTS:
+            assert fake_redis.lrange(UPDATES_QUEUE_KEY, 0, -1) == [b"1"]
+            assert fake_redis.hget(PERSIST_FAILURES_KEY, "1") == str(attempt).encode()
+
+    assert fake_redis.hget(get_dead_letter_key("1"), "blob") == b"bad"
+    assert not fake_redis.exists(get_inflight_key("1"), get_buffer_key("1"), worker.processing_key, PERSIST_FAILURES_KEY)
+    assert fake_redis.llen(UPDATES_QUEUE_KEY) == 0
+    assert fake_redis.smembers(UPDATES_PENDING_SET_KEY) == set()
+
+
+@pytest.mark.django_db
+def test_saving_a_loaded_project_keeps_state_compacted_meanwhile(user_factory):
+    project = Project.objects.create(owner=user_factory(username="sync_stale_blob_owner"), name="P")
+    project.append_yjs_state(_doc_state("kept"))
+    loaded = Project.objects.get(pk=project.pk)
+
+    assert Project.objects.get(pk=project.pk).compact_yjs_updates() == 1
+
+    loaded.name = "Renamed"
+    loaded.save()
+
+    project.refresh_from_db()
+    assert project.name == "Renamed"
+    assert _decode_text(project.get_yjs_state()) == "kept"
+
+
+@pytest.mark.django_db
+def test_saving_a_loaded_project_keeps_sequence_appended_meanwhile(user_factory):
+    project = Project.objects.create(owner=user_factory(username="sync_stale_seq_owner"), name="P")
+    doc = Doc()
+    text = doc.get("t", type=Text)
+    text += "one"
+    project.append_yjs_state(doc.get_update())
+
+    text += " two"
+    Project.objects.get(pk=project.pk).append_yjs_state(doc.get_update())
+
+    project.name = "Renamed"
+    project.save()
+
+    text += " three"
+    project.append_yjs_state(doc.get_update())
+
+    project.refresh_from_db()
+    assert project.yjs_seq == 3
+    assert _decode_text(project.get_yjs_state()) == "one two three"
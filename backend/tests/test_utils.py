@@ -1,14 +1,28 @@
+import asyncio
+import json
+import time
 from types import SimpleNamespace
 
+import fakeredis
 import pytest
+from channels.layers import InMemoryChannelLayer
+from django.core.cache import cache
+from django.db import connection, transaction
 from rest_framework.test import APIRequestFactory
 from rest_framework.request import Request
 
 from accounts.serializers import PublicUserSerializer
 from organizations.models import Organization, OrganizationInvitation
-from projects.models import Project
+from projects import autosave
+from projects.block_events import add_block_event
+from projects.management.commands.sync_yjs import UPDATES_PENDING_SET_KEY, UPDATES_QUEUE_KEY, get_buffer_key
+from projects.models import Project, ProjectCollaborator
+from utils import consumers, flow_control, group_users, permission_cache, redis_client
+from utils.consumers import CustomAsyncWebsocketConsumer
+from utils.fields import FORMAT_RAW, FORMAT_ZLIB, compress_bytes, decompress_bytes
 from utils.pagination import DynamicMetadataPagination
 from utils.permissions import AnyOf, create_permissions_allowed_hierarchy, create_user_permission_class
+from utils.redis_client import get_redis_client
 from projects.filters import ProjectFilter
 
 
@@ -129,3 +143,381 @@ def test_dynamic_metadata_pagination_includes_selections(user_factory):
     assert user_a.id in owner_ids
     assert user_b.id in owner_ids
 
+
+
+def test_compress_bytes_round_trips_with_format_header():
+    compressible = b"block" * 200
+    packed = compress_bytes(compressible)
+    assert packed[0] == FORMAT_ZLIB
+    assert len(packed) < len(compressible)
+    assert decompress_bytes(packed) == compressible
+
+    # Values that don't shrink are stored raw behind the header
+    tiny = b"\x01"
+    assert compress_bytes(tiny) == bytes([FORMAT_RAW]) + tiny
+    assert decompress_bytes(compress_bytes(tiny)) == tiny
+
+
+@pytest.mark.django_db
+def test_compressed_binary_field_stores_compressed_and_reads_plain(user_factory):
+    owner = user_factory(username="compress_owner")
+    blob = b"yjs-state" * 500
+    project = Project.objects.create(owner=owner, name="Compressed", yjs_blob=blob)
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT yjs_blob FROM projects_project WHERE id = %s", [project.id])
+        stored = bytes(cursor.fetchone()[0])
+
+    assert len(stored) < len(blob)
+    assert Project.objects.get(id=project.id).yjs_blob == blob
+
+
+@pytest.mark.django_db
+def test_field_tracker_mixin_reports_dirty_fields_without_requerying(user_factory, django_assert_num_queries):
+    user = user_factory(username="tracker_user")
+    created = Project.objects.create(owner=user, name="Before", yjs_blob=b"state")
+    assert created.get_dirty_fields() == set()
+
+    project = Project.objects.without_state().get(pk=created.pk)
+    project.name = "After"
+    with django_assert_num_queries(0):
+        assert project.get_dirty_fields() == {"name"}
+        assert project.get_dirty_fields(update_fields=["thumbnail"]) == set()
+    project.save()
+    assert project.get_dirty_fields() == set()
+
+    # Instances not loaded from the database read the previous values in one query
+    detached = Project(pk=created.pk, owner=user, name="Detached", yjs_blob=b"state")
+    with django_assert_num_queries(1):
+        assert detached.get_dirty_fields() == {"name"}
+        assert detached.get_previous_values()["name"] == "After"
+
+
+@pytest.mark.django_db
+def test_permission_cache_serves_repeat_lookups_and_invalidates_on_change(user_factory, django_assert_num_queries):
+    owner = user_factory(username="cache_owner")
+    coder = user_factory(username="cache_coder")
+    project = Project.objects.create(owner=owner, name="P")
+    collaborator = ProjectCollaborator.objects.create(project=project, collaborator=coder, permission="code")
+    # The collaborator broadcast already resolved (and cached) the permission
+    cache.clear()
+    permission_cache.reset_stats()
+
+    assert Project.objects.get(pk=project.pk).get_permission(coder) == "code"
+    fresh = Project.objects.get(pk=project.pk)
+    with django_assert_num_queries(0):
+        assert fresh.get_permission(coder) == "code"
+    assert permission_cache.get_stats()["hits"] == 1
+    assert permission_cache.get_stats()["misses"] == 1
+
+    collaborator.permission = "admin"
+    collaborator.save()
+    assert Project.objects.get(pk=project.pk).get_permission(coder) == "admin"
+
+    org = Organization.objects.create(owner=owner, slug="cache-org", name="CacheOrg")
+    org.add_member(coder, "invite")
+    assert org.get_permission(coder) == "invite"
+    org.ban_user(coder, banned_by=owner, reason="spam")
+    assert not org.has_permission(coder, "view")
+
+
+@pytest.mark.django_db
+def test_publish_on_commit_batches_per_transaction(monkeypatch, django_capture_on_commit_callbacks):
+    batches = []
+    monkeypatch.setattr(redis_client, "publish_many", lambda messages: batches.append(list(messages)))
+
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            redis_client.publish_on_commit("a", "1")
+            redis_client.publish_on_commit("b", b"2")
+            assert not batches
+
+    assert batches == [[("a", "1"), ("b", b"2")]]
+
+    # Messages queued in a rolled-back savepoint are dropped with it
+    batches.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    redis_client.publish_on_commit("rolled_back", "x")
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            redis_client.publish_on_commit("kept", "y")
+
+    assert batches == [[("kept", "y")]]
+
+    # ...including when the batch they would have joined was started outside the savepoint
+    batches.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            redis_client.publish_on_commit("c", "kept")
+            try:
+                with transaction.atomic():
+                    redis_client.publish_on_commit("c", "rolled-back")
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            redis_client.publish_on_commit("c", "after")
+
+    assert batches == [[("c", "kept"), ("c", "after")]]
+
+    # Messages from a released savepoint are sent in order with the rest of the transaction
+    batches.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            redis_client.publish_on_commit("d", "1")
+            with transaction.atomic():
+                redis_client.publish_on_commit("d", "2")
+            redis_client.publish_on_commit("d", "3")
+
+    assert [message for batch in batches for message in batch] == [("d", "1"), ("d", "2"), ("d", "3")]
+
+    # Nothing is sent from a transaction that rolls back
+    batches.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        try:
+            with transaction.atomic():
+                redis_client.publish_on_commit("e", "x")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+    assert batches == []
+
+    # ...and the batch it started is not reused by the next one
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            redis_client.publish_on_commit("f", "1")
+
+    assert batches == [[("f", "1")]]
+
+
+def test_redis_clients_share_pools_per_resolved_configuration(settings):
+    settings.REDIS_CLIENTS = {"queue": {"URL": "redis://queue-host:6380/2", "MAX_CONNECTIONS": 7}}
+
+    assert get_redis_client("pubsub") is get_redis_client("cache")
+    queue_client = get_redis_client("queue")
+    assert queue_client is not get_redis_client("pubsub")
+
+    pool_kwargs = queue_client.connection_pool.connection_kwargs
+    assert (pool_kwargs["host"], pool_kwargs["port"], pool_kwargs["db"]) == ("queue-host", 6380, 2)
+    assert queue_client.connection_pool.max_connections == 7
+
+
+def test_autosave_scheduler_queues_open_projects_until_discarded(settings, monkeypatch):
+    settings.PROJECT_AUTOSAVE_INTERVAL = 0.01
+    settings.PROJECT_AUTOSAVE_JITTER = 0
+    batches = []
+    monkeypatch.setattr(autosave, "autosave_projects", lambda project_ids: batches.append(sorted(project_ids)))
+
+    async def scenario():
+        scheduler = autosave.AutosaveScheduler()
+        scheduler.add(1, "a")
+        scheduler.add(1, "b")
+        scheduler.add(2, "c")
+        await asyncio.sleep(0.05)
+
+        # The project stays scheduled until its last local owner is gone
+        scheduler.discard(1, "a")
+        scheduler.discard(2, "c")
+        batches.clear()
+        await asyncio.sleep(0.05)
+        assert batches and all(batch == [1] for batch in batches)
+
+        scheduler.discard(1, "b")
+        await asyncio.sleep(0.03)
+        assert scheduler.task.done()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert not scheduler.owners and not scheduler.due
+
+
+def test_autosave_asks_hocuspocus_to_store_and_queues_stranded_buffers(fake_redis, monkeypatch):
+    published = []
+    monkeypatch.setattr(autosave, "safe_publish", lambda channel, message: published.append((channel, json.loads(message))))
+    fake_redis.hset(get_buffer_key("1"), mapping={"blob": b"state"})
+
+    autosave.autosave_projects([1, 2])
+
+    assert published == [(autosave.STORE_REQUESTS_CHANNEL, {"project_ids": [1, 2]})]
+    assert fake_redis.lrange(UPDATES_QUEUE_KEY, 0, -1) == [b"1"]
+    assert fake_redis.smembers(UPDATES_PENDING_SET_KEY) == {b"1"}
+
+
+def test_block_events_are_coalesced_into_one_group_message(settings):
+    settings.BLOCK_EVENT_BATCH_WINDOW = 0.01
+
+    async def scenario():
+        layer = InMemoryChannelLayer()
+        channel = await layer.new_channel()
+        await layer.group_add("project_1", channel)
+
+        for x in range(5):
+            add_block_event("project_1", layer, 7, {"type": "block_move", "data": {"block_id": "a", "x": x}})
+        add_block_event("project_1", layer, 7, {"type": "block_create", "data": {"block_id": "b"}})
+        add_block_event("project_1", layer, 8, {"type": "block_move", "data": {"block_id": "a", "x": 99}})
+        add_block_event("project_1", layer, 7, {"type": "block_move", "data": {"block_id": "a", "x": 5}})
+
+        return await asyncio.wait_for(layer.receive(channel), timeout=1)
+
+    message = asyncio.run(scenario())
+    assert message["type"] == "handle_block_batch"
+    assert message["user_ids"] == [7, 8]
+    # Superseded moves are dropped; the latest one takes the place of the last event
+    assert [(e["user_id"], e["data"]["type"], e["data"]["data"].get("x")) for e in message["events"]] == [
+        (7, "block_create", None),
+        (8, "block_move", 99),
+        (7, "block_move", 5),
+    ]
+    assert json.loads(message["text"]) == {"type": "block_batch", "data": [e["data"] for e in message["events"]]}
+
+
+def test_group_frames_are_encoded_once_and_forwarded_verbatim(settings, monkeypatch):
+    # Uses orjson when installed, the standard library otherwise
+    settings.WEBSOCKET_JSON_BACKEND = "orjson"
+    encodes = []
+    real_encode = consumers.encode_json
+    monkeypatch.setattr(consumers, "encode_json", lambda data: encodes.append(data) or real_encode(data))
+
+    class Recipient(consumers.CustomAsyncWebsocketConsumer):
+        async def send(self, text_data=None, bytes_data=None, close=False):
+            self.sent.append(text_data)
+
+    async def scenario():
+        layer = InMemoryChannelLayer()
+        recipients = []
+        for _ in range(3):
+            recipient = Recipient()
+            recipient.sent = []
+            recipient.channel_layer = layer
+            recipient.channel_name = await layer.new_channel()
+            await layer.group_add("project_1", recipient.channel_name)
+            recipients.append(recipient)
+
+        await recipients[0].group_send_frame("project_1", "user_disconnect", {"type": "user_disconnect", "data": 7})
+
+        for recipient in recipients:
+            await recipient.forward_frame(await layer.receive(recipient.channel_name))
+        return recipients
+
+    recipients = asyncio.run(scenario())
+    assert encodes == [{"type": "user_disconnect", "data": 7}]
+    frames = [text for recipient in recipients for text in recipient.sent]
+    assert len(frames) == 3 and len(set(frames)) == 1
+    assert json.loads(frames[0]) == {"type": "user_disconnect", "data": 7}
+    assert consumers.decode_json('{"a": 1}') == {"a": 1}
+
+
+def test_websocket_rate_limit_drops_messages_over_the_bucket(settings):
+    settings.WEBSOCKET_RATE_LIMIT_RATE = 0.001
+    settings.WEBSOCKET_RATE_LIMIT_BURST = 3
+    settings.WEBSOCKET_RATE_LIMIT_POLICY = "drop"
+    flow_control.reset_stats()
+
+    class Consumer(CustomAsyncWebsocketConsumer):
+        async def send(self, text_data=None, bytes_data=None, close=False):
+            self.sent.append(json.loads(text_data))
+
+    async def scenario():
+        consumer = Consumer()
+        consumer.sent = []
+        consumer.handle_ping = lambda *args: None
+        consumer.setup_rate_limit()
+        return consumer, [await consumer.receive(json.dumps({"type": "block_move", "data": {}})) for _ in range(6)]
+
+    consumer, messages = asyncio.run(scenario())
+    assert [message is not None for message in messages] == [True, True, True, False, False, False]
+    # The client is told once, not once per dropped message
+    assert consumer.sent == [{"type": "error", "message": "Rate limit exceeded - messages are being dropped."}]
+    assert flow_control.get_stats()["messages_rate_limited"] == 3
+
+
+def test_websocket_send_queue_closes_slow_clients(settings):
+    settings.WEBSOCKET_SEND_QUEUE_SIZE = 2
+    settings.WEBSOCKET_SEND_QUEUE_POLICY = "close"
+    flow_control.reset_stats()
+
+    async def scenario():
+        consumer = CustomAsyncWebsocketConsumer()
+        sent = []
+        blocked = asyncio.Event()
+
+        async def base_send(message):
+            if message["type"] == "websocket.send":
+                # The client is not reading
+                await blocked.wait()
+            sent.append(message)
+
+        consumer.base_send = base_send
+        consumer.setup_send_queue()
+
+        for n in range(4):
+            await consumer.forward_frame({"text": str(n)})
+            await asyncio.sleep(0)
+
+        await consumer.cleanup_send_queue()
+        return sent
+
+    sent = asyncio.run(scenario())
+    # The writer holds the first frame, two more fill the queue and the fourth closes the connection
+    assert sent == [{"type": "websocket.close", "code": flow_control.SEND_QUEUE_CLOSE_CODE}]
+    assert flow_control.get_stats()["closed_send_queue_full"] == 1
+
+
+def test_group_presence_tracks_connections_per_user(fake_redis):
+    assert group_users.get_group_users("project_1") == []
+
+    group_users.add_user_to_group("project_1", 7, "channel-a")
+    group_users.add_user_to_group("project_1", 8, "channel-b")
+    # A second tab of the same user is listed once
+    group_users.add_user_to_group("project_1", 7, "channel-c")
+    assert sorted(group_users.get_group_users("project_1")) == [7, 8]
+    assert fake_redis.ttl("group_users:project_1") == group_users.PRESENCE_TTL
+
+    group_users.remove_user_from_group("project_1", 7, "channel-a")
+    assert sorted(group_users.get_group_users("project_1")) == [7, 8]
+
+    group_users.remove_user_from_group("project_1", 7, "channel-c")
+    assert group_users.get_group_users("project_1") == [8]
+
+
+def test_group_presence_prunes_connections_that_stop_heartbeating(fake_redis):
+    group_users.add_user_to_group("project_1", 7, "channel-a")
+    # A connection on a worker that died: its presence expired a second ago
+    fake_redis.zadd("group_users:project_1", {"8:channel-b": time.time() - 1})
+
+    assert group_users.get_group_users("project_1") == [7]
+    assert fake_redis.zrange("group_users:project_1", 0, -1) == [b"7:channel-a"]
+
+
+def test_group_leader_lease_is_held_by_one_connection_until_released(fake_redis):
+    assert group_users.add_user_to_group("project_1", 7, "channel-a") is True
+    assert group_users.add_user_to_group("project_1", 8, "channel-b") is False
+    assert group_users.claim_group_leader("project_1", "channel-b") is False
+    # Heartbeats renew the leader's lease
+    assert group_users.add_user_to_group("project_1", 7, "channel-a") is True
+    assert fake_redis.ttl("group_users:project_1:leader") == group_users.PRESENCE_TTL
+
+    # Leaving without the lease does not release it
+    group_users.remove_user_from_group("project_1", 8, "channel-b")
+    assert fake_redis.get("group_users:project_1:leader") == b"channel-a"
+
+    group_users.remove_user_from_group("project_1", 7, "channel-a")
+    assert not fake_redis.exists("group_users:project_1:leader")
+    assert group_users.claim_group_leader("project_1", "channel-c") is True
+    assert group_users.claim_group_leader("project_1", "channel-a") is False
+
+
+def test_group_presence_fails_open_without_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    client = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(group_users, "redis_client", client)
+    monkeypatch.setattr(group_users, "_claim_leader", client.register_script(group_users.CLAIM_LEADER_SCRIPT))
+
+    assert group_users.add_user_to_group("project_1", 7, "channel-a") is True
+    assert group_users.claim_group_leader("project_1", "channel-a") is True
+    assert group_users.get_group_users("project_1") == []
@@ -0,0 +1,14 @@
+from django.db.models import IntegerField, Subquery
+
+class SubqueryCount(Subquery):
+    '''
+    Count the rows of a correlated subquery, e.g.
+        SubqueryCount(Asset.objects.filter(project=OuterRef('pk')))
+    Unlike annotate(Count(...)) this does not join into the outer query, so it
+    stays correct next to other joins and distinct().
+    '''
+    template = '(SELECT COUNT(*) FROM (%(subquery)s) _count)'
+    output_field = IntegerField()
+
+    def __init__(self, queryset, **extra):
+        super().__init__(queryset.order_by().values('pk'), **extra)
@@ -1,9 +1,31 @@
-from utils.mixins import PingEnforcementMixin
+from utils.mixins import PingEnforcementMixin, RateLimitMixin, SendQueueMixin
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 import json
 
-class CustomAsyncWebsocketConsumer(PingEnforcementMixin, AsyncWebsocketConsumer):
+# orjson is optional: it is only used when installed and WEBSOCKET_JSON_BACKEND = 'orjson'
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_AVAILABLE = orjson is not None
+
+def use_orjson():
+    return ORJSON_AVAILABLE and getattr(settings, 'WEBSOCKET_JSON_BACKEND', 'json') == 'orjson'
+
+def encode_json(data) -> str:
+    if use_orjson():
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+def decode_json(text_data):
+    if use_orjson():
+        return orjson.loads(text_data)
+    return json.loads(text_data)
+
+class CustomAsyncWebsocketConsumer(PingEnforcementMixin, RateLimitMixin, SendQueueMixin, AsyncWebsocketConsumer):
     @database_sync_to_async
     def user_has_access(self):
         return True
@@ -15,13 +37,31 @@ class CustomAsyncWebsocketConsumer(PingEnforcementMixin, AsyncWebsocketConsumer)
             await self.close(code=401)
             return False
 
+        self.setup_rate_limit()
+        self.setup_send_queue()
+
         return True
 
     async def send_json(self, data):
-        await self.send(text_data=json.dumps(data))
+        await self.send(text_data=encode_json(data))
+
+    async def group_send_frame(self, group_name, handler_type, frame, **extra):
+        '''
+        Send a group event carrying the client frame encoded once, here, instead of
+        by every recipient. Handlers pass it on with forward_frame()
+        '''
+        await self.channel_layer.group_send(group_name, {
+            'type': handler_type,
+            'text': encode_json(frame),
+            **extra,
+        })
+
+    async def forward_frame(self, event):
+        await self.send(text_data=event['text'])
 
     async def disconnect(self, code):
         await self.cleanup_ping_enforcement()
+        await self.cleanup_send_queue()
 
     def validate_message_format(self, message):
         for key in ['type', 'data']:
@@ -34,8 +74,11 @@ class CustomAsyncWebsocketConsumer(PingEnforcementMixin, AsyncWebsocketConsumer)
         return message
 
     async def receive(self, text_data):
+        if not await self.check_rate_limit():
+            return None
+
         try:
-            message = json.loads(text_data)
+            message = decode_json(text_data)
 
             validated_message = self.validate_message_format(message)
 
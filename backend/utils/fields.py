@@ -1,3 +1,5 @@
+import zlib
+from django.db.models import BinaryField
 from rest_framework.serializers import Field, ValidationError
 
 class NullableBooleanField(Field):
@@ -11,4 +13,61 @@ class NullableBooleanField(Field):
         raise ValidationError('Invalid boolean value')
 
     def to_representation(self, value):
-        return value
\ No newline at end of file
+        return value
+
+'''
+Stored values of CompressedBinaryField start with one header byte naming their format,
+so the encoding can change later without rewriting every row at once
+'''
+FORMAT_RAW = 0
+FORMAT_ZLIB = 1
+
+def compress_bytes(value : bytes, level : int = 6) -> bytes:
+    compressed = zlib.compress(value, level)
+
+    # Small or already-dense values can grow when compressed; keep those raw
+    if len(compressed) < len(value):
+        return bytes([FORMAT_ZLIB]) + compressed
+    return bytes([FORMAT_RAW]) + value
+
+def decompress_bytes(value : bytes) -> bytes:
+    if not value:
+        raise ValueError('Compressed value is missing its format header')
+
+    header, payload = value[0], value[1:]
+
+    if header == FORMAT_RAW:
+        return payload
+    if header == FORMAT_ZLIB:
+        return zlib.decompress(payload)
+
+    raise ValueError(f'Unknown compressed value format: {header}')
+
+class CompressedBinaryField(BinaryField):
+    '''
+    BinaryField that transparently compresses values on write and decompresses them on read
+    Python code always sees plain bytes; only the database holds the compressed form
+    '''
+    def __init__(self, *args, compression_level=6, **kwargs):
+        self.compression_level = compression_level
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+
+        if self.compression_level != 6:
+            kwargs['compression_level'] = self.compression_level
+
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return decompress_bytes(bytes(value))
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+
+        if value is not None:
+            value = compress_bytes(bytes(value), self.compression_level)
+        return value
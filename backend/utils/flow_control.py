@@ -0,0 +1,82 @@
+"""
+Flow control for websocket connections (see RateLimitMixin and
+SendQueueMixin in utils/mixins.py).
+
+Incoming messages are metered per connection by a token bucket, so a client
+can burst up to WEBSOCKET_RATE_LIMIT_BURST messages but not sustain more than
+WEBSOCKET_RATE_LIMIT_RATE per second. Outgoing frames go through a bounded
+per-connection queue written by one task, so a slow client cannot make its
+consumer stall (and its channel layer inbox grow) while frames pile up.
+
+What happens to a connection over either limit is set by
+WEBSOCKET_RATE_LIMIT_POLICY and WEBSOCKET_SEND_QUEUE_POLICY: "drop" discards
+the message or frame, "close" closes the connection.
+
+Counters are kept per process and exposed through get_stats().
+"""
+
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+
+POLICY_DROP = "drop"
+POLICY_CLOSE = "close"
+
+DEFAULT_RATE_LIMIT_RATE = 30
+DEFAULT_RATE_LIMIT_BURST = 60
+DEFAULT_RATE_LIMIT_POLICY = POLICY_DROP
+DEFAULT_SEND_QUEUE_SIZE = 256
+DEFAULT_SEND_QUEUE_POLICY = POLICY_CLOSE
+
+# Policy violation, and "try again later" for clients that cannot keep up
+RATE_LIMIT_CLOSE_CODE = 1008
+SEND_QUEUE_CLOSE_CODE = 1013
+
+_stats = {
+    "messages_rate_limited": 0,
+    "frames_dropped": 0,
+    "closed_rate_limited": 0,
+    "closed_send_queue_full": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def get_setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def count(stat: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[stat] += amount
+
+
+def get_stats() -> dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def consume(self, tokens: float = 1) -> bool:
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < tokens:
+            return False
+
+        self.tokens -= tokens
+        return True
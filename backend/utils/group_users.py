@@ -1,17 +1,114 @@
-from django.core.cache import cache
+"""
+Presence of users connected to a websocket group, kept in Redis so every
+Daphne worker sees the same members.
+
+Each connection is a member of a sorted set, scored by the time its presence
+expires. Consumers refresh their score with heartbeats, so connections that
+stop heartbeating (e.g. on a worker that crashed) drop out on their own. Every
+change is a single Redis command, so concurrent connects and disconnects never
+overwrite each other.
+
+One connection per group holds a leader lease (a key with a TTL, renewed by its
+heartbeats), used to pick the single connection whose process autosaves the
+project (see projects/autosave.py).
+
+Redis errors are logged. Presence then reads as empty, and claiming the lease
+succeeds so autosave keeps working without Redis.
+"""
+
+import logging
+import time
+
+from utils.redis_client import get_redis_client
+
+
+logger = logging.getLogger(__name__)
+redis_client = get_redis_client("cache")
+
+PRESENCE_TTL = 90
+PRESENCE_HEARTBEAT_INTERVAL = 30
+
+# Take the lease if it is free, or renew it if this connection already holds it
+CLAIM_LEADER_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+if current == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+RELEASE_LEADER_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_claim_leader = redis_client.register_script(CLAIM_LEADER_SCRIPT)
+_release_leader = redis_client.register_script(RELEASE_LEADER_SCRIPT)
+
 
 def _key(group_name):
     return f"group_users:{group_name}"
 
+def _leader_key(group_name):
+    return f"group_users:{group_name}:leader"
+
+def _member(user_id, channel_name):
+    return f"{user_id}:{channel_name}"
+
+def add_user_to_group(group_name, user_id, channel_name):
+    """
+    Add or refresh a connection's presence. Returns whether the connection
+    holds the group's leader lease, which this also claims or renews.
+    """
+    key = _key(group_name)
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zadd(key, {_member(user_id, channel_name): time.time() + PRESENCE_TTL})
+        pipe.expire(key, PRESENCE_TTL)
+        _claim_leader(keys=[_leader_key(group_name)], args=[channel_name, PRESENCE_TTL], client=pipe)
+        return bool(pipe.execute()[-1])
+    except Exception as exc:
+        logger.warning("Presence update failed for %s: %s", group_name, exc)
+        return True
+
+def remove_user_from_group(group_name, user_id, channel_name):
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrem(_key(group_name), _member(user_id, channel_name))
+        _release_leader(keys=[_leader_key(group_name)], args=[channel_name], client=pipe)
+        pipe.execute()
+    except Exception as exc:
+        logger.warning("Presence removal failed for %s: %s", group_name, exc)
+
+def claim_group_leader(group_name, channel_name):
+    try:
+        return bool(_claim_leader(keys=[_leader_key(group_name)], args=[channel_name, PRESENCE_TTL]))
+    except Exception as exc:
+        logger.warning("Leader election failed for %s: %s", group_name, exc)
+        return True
+
 def get_group_users(group_name):
-    return cache.get(_key(group_name), list())
+    """
+    Ids of the users with a live connection to the group, in the order their
+    presence was last refreshed. A user connected more than once is listed once.
+    """
+    key = _key(group_name)
 
-def add_user_to_group(group_name, user_id):
-    users = get_group_users(group_name)
-    users.append(user_id)
-    cache.set(_key(group_name), users, timeout=None)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zremrangebyscore(key, "-inf", time.time())
+        pipe.zrange(key, 0, -1)
+        members = pipe.execute()[-1]
+    except Exception as exc:
+        logger.warning("Presence read failed for %s: %s", group_name, exc)
+        return []
 
-def remove_user_from_group(group_name, user_id):
-    users = get_group_users(group_name)
-    users.remove(user_id)
-    cache.set(_key(group_name), users, timeout=None)
\ No newline at end of file
+    return list(dict.fromkeys(int(member.split(b":", 1)[0]) for member in members))
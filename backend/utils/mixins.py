@@ -1,6 +1,20 @@
 import asyncio
+import logging
 from time import time
 import json
+from django.db import IntegrityError, transaction
+from django.db.models import F, Value
+from django.db.models.fields.files import FieldFile, FileField
+from django.db.models.functions import Greatest
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.status import HTTP_201_CREATED
+
+from utils import flow_control
+
+
+logger = logging.getLogger(__name__)
 
 class PingEnforcementMixin:
     ping_timeout = 30
@@ -39,4 +53,260 @@ class PingEnforcementMixin:
         self.last_ping = time()
 
         if return_ping:
-            await self.send(text_data=json.dumps({"type": "pong"}))
\ No newline at end of file
+            await self.send(text_data=json.dumps({"type": "pong"}))
+
+class RateLimitMixin:
+    '''
+    Websocket consumer mixin metering incoming messages with a token bucket
+    (see utils/flow_control.py). receive() handlers call check_rate_limit() and
+    ignore the message when it returns False.
+    '''
+    rate_limiter = None
+    rate_limited = False
+
+    def setup_rate_limit(self):
+        rate = flow_control.get_setting('WEBSOCKET_RATE_LIMIT_RATE', flow_control.DEFAULT_RATE_LIMIT_RATE)
+
+        if rate:
+            burst = flow_control.get_setting('WEBSOCKET_RATE_LIMIT_BURST', flow_control.DEFAULT_RATE_LIMIT_BURST)
+            self.rate_limiter = flow_control.TokenBucket(rate, max(burst, 1))
+
+    async def check_rate_limit(self):
+        if self.rate_limiter is None or self.rate_limiter.consume():
+            self.rate_limited = False
+            return True
+
+        flow_control.count('messages_rate_limited')
+
+        if flow_control.get_setting('WEBSOCKET_RATE_LIMIT_POLICY', flow_control.DEFAULT_RATE_LIMIT_POLICY) == flow_control.POLICY_CLOSE:
+            flow_control.count('closed_rate_limited')
+            logger.warning("Closing websocket %s: rate limit exceeded", getattr(self, 'channel_name', None))
+            await self.close(code=flow_control.RATE_LIMIT_CLOSE_CODE)
+        elif not self.rate_limited:
+            # Only the first dropped message of a run is reported, so the errors do not add to the flood
+            self.rate_limited = True
+            await self.send(text_data=json.dumps({
+                "type": "error",
+                "message": "Rate limit exceeded - messages are being dropped.",
+            }))
+
+        return False
+
+class SendQueueMixin:
+    '''
+    Websocket consumer mixin sending frames through a bounded queue written by a
+    single task (see utils/flow_control.py), so handlers never wait on a slow
+    client. Frames sent before setup_send_queue() or after cleanup_send_queue()
+    are sent directly.
+    '''
+    send_queue = None
+
+    def setup_send_queue(self):
+        size = flow_control.get_setting('WEBSOCKET_SEND_QUEUE_SIZE', flow_control.DEFAULT_SEND_QUEUE_SIZE)
+
+        if size:
+            self.send_queue = asyncio.Queue(maxsize=size)
+            self._send_task = asyncio.create_task(self._send_writer(self.send_queue))
+
+    async def cleanup_send_queue(self):
+        self.send_queue = None
+
+        if hasattr(self, "_send_task"):
+            self._send_task.cancel()
+
+            try:
+                await self._send_task
+            except asyncio.CancelledError:
+                pass
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self.send_queue is None:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+
+        try:
+            self.send_queue.put_nowait((text_data, bytes_data, close))
+            return
+        except asyncio.QueueFull:
+            pass
+
+        if flow_control.get_setting('WEBSOCKET_SEND_QUEUE_POLICY', flow_control.DEFAULT_SEND_QUEUE_POLICY) == flow_control.POLICY_CLOSE:
+            flow_control.count('closed_send_queue_full')
+            logger.warning("Closing websocket %s: send queue full", getattr(self, 'channel_name', None))
+            # Queued frames are discarded; nothing may be sent after the close
+            await self.cleanup_send_queue()
+            await self.close(code=flow_control.SEND_QUEUE_CLOSE_CODE)
+        else:
+            flow_control.count('frames_dropped')
+
+    async def _send_writer(self, queue):
+        try:
+            while True:
+                text_data, bytes_data, close = await queue.get()
+                await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        except asyncio.CancelledError:
+            pass
+
+class FieldTrackerMixin:
+    '''
+    Model mixin that remembers the values of TRACKED_FIELDS as loaded from the
+    database (or as of the last save), so pre_save/post_save receivers can ask
+    which fields changed without re-reading the row.
+
+    File fields are tracked by name. Deferred fields are not tracked until they
+    are loaded, and instances not built by from_db read all their previous
+    values in a single query the first time they are needed.
+    '''
+    TRACKED_FIELDS: list[str] = []
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.snapshot_tracked_fields()
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Runs after post_save, so receivers still see this save's changes
+        self.snapshot_tracked_fields()
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        # Also reached when a deferred field is first accessed
+        self.snapshot_tracked_fields(fields)
+
+    def _get_tracked_value(self, field_name):
+        value = getattr(self, self._meta.get_field(field_name).attname)
+        # Empty file fields are None on new instances but '' once loaded
+        return (value.name or None) if isinstance(value, FieldFile) else value
+
+    def snapshot_tracked_fields(self, fields=None) -> None:
+        deferred = self.get_deferred_fields()
+        tracked_values = getattr(self, '_tracked_values', {}) if fields is not None else {}
+
+        for field in self.TRACKED_FIELDS:
+            attname = self._meta.get_field(field).attname
+
+            if attname not in deferred and (fields is None or field in fields or attname in fields):
+                tracked_values[field] = self._get_tracked_value(field)
+
+        self._tracked_values = tracked_values
+
+    def get_previous_values(self) -> dict:
+        '''
+        Previous values of every tracked field the instance has loaded. Fields that are
+        still deferred are left out, since they cannot have been changed.
+        '''
+        if self.pk is None:
+            return {}
+
+        tracked_values = getattr(self, '_tracked_values', {})
+        deferred = self.get_deferred_fields()
+        missing = [
+            field for field in self.TRACKED_FIELDS
+            if field not in tracked_values and self._meta.get_field(field).attname not in deferred
+        ]
+
+        if missing:
+            # Built without going through from_db (e.g. Model(pk=...)); one query for all missing fields
+            attnames = [self._meta.get_field(field).attname for field in missing]
+            row = type(self)._base_manager.filter(pk=self.pk).values(*attnames).first() or {}
+            for field, attname in zip(missing, attnames):
+                value = row.get(attname)
+                tracked_values[field] = (value or None) if isinstance(self._meta.get_field(field), FileField) else value
+            self._tracked_values = tracked_values
+
+        return tracked_values
+
+    def get_dirty_fields(self, update_fields=None) -> set[str]:
+        previous_values = self.get_previous_values()
+
+        return {
+            field for field, previous in previous_values.items()
+            if (update_fields is None or field in update_fields or self._meta.get_field(field).attname in update_fields)
+            and previous != self._get_tracked_value(field)
+        }
+
+
+class CounterFieldsMixin:
+    '''
+    Model mixin for denormalized counter columns (COUNTER_FIELDS). Counters are only
+    changed in the database through increment_counters(), which uses F() expressions;
+    a regular save() of an existing row leaves them out so a stale in-memory value
+    never overwrites a concurrent increment.
+
+    Models with other columns that only dedicated code paths may write list them in
+    get_save_excluded_fields().
+    '''
+    COUNTER_FIELDS: list[str] = []
+
+    def get_save_excluded_fields(self) -> list[str]:
+        return self.COUNTER_FIELDS
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None and not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            excluded = self.get_save_excluded_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred and field.name not in excluded
+            ]
+
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def increment_counters(cls, pks, **amounts) -> None:
+        '''
+        Atomically add amounts (which may be negative) to counters of the given rows,
+        never going below zero
+        '''
+        if not pks or not amounts:
+            return
+
+        cls._base_manager.filter(pk__in=pks).update(**{
+            field: Greatest(F(field) + amount, Value(0))
+            for field, amount in amounts.items()
+        })
+
+
+class BulkCreateMixin:
+    '''
+    ViewSet mixin adding POST <list url>/bulk/, which takes a list of objects in the
+    create format. Items are validated together (serializers can memoize shared
+    lookups in the serializer context) and inserted with a single bulk_create.
+
+    bulk_create sends no post_save signals, so viewsets override
+    perform_bulk_create() to do whatever those receivers would have done, once for
+    the whole batch. get_permissions() should treat the 'bulk' action like 'create'.
+    '''
+    bulk_create_max_items = 100
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        if not isinstance(request.data, list) or not request.data:
+            raise ValidationError('Expected a non-empty list of items.')
+        if len(request.data) > self.bulk_create_max_items:
+            raise ValidationError(f'Cannot create more than {self.bulk_create_max_items} items at once.')
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            with transaction.atomic():
+                instances = self.perform_bulk_create(serializer)
+        except IntegrityError:
+            raise ValidationError('The items conflict with each other or with existing objects.')
+
+        return Response(self.get_serializer(instances, many=True).data, status=HTTP_201_CREATED)
+
+    def get_bulk_create_kwargs(self) -> dict:
+        '''
+        Fields set on every created object, like the ones perform_create passes to save()
+        '''
+        return {}
+
+    def perform_bulk_create(self, serializer) -> list:
+        model = serializer.child.Meta.model
+        extra = self.get_bulk_create_kwargs()
+
+        return model.objects.bulk_create([model(**item, **extra) for item in serializer.validated_data])
@@ -0,0 +1,92 @@
+"""
+Shared cache for per-user permissions on projects and organizations.
+
+Values live in the default Django cache (Redis in production) so every worker
+and the Hocuspocus permission checks benefit from one lookup. Entries are keyed
+by (object, user) and deleted by the post_save/post_delete receivers of the
+models they are derived from; the timeout only bounds how long a missed
+invalidation can survive.
+
+Hit/miss counters are kept per process and exposed through get_stats().
+"""
+
+import logging
+import threading
+from collections.abc import Callable, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+PERMISSION_CACHE_PREFIX = "perm"
+DEFAULT_PERMISSION_CACHE_TIMEOUT = 300
+
+_MISSING = object()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_stats_lock = threading.Lock()
+
+
+def project_permission_key(project_id: int, user_id: int) -> str:
+    return f"{PERMISSION_CACHE_PREFIX}:project:{project_id}:user:{user_id}"
+
+
+def organization_permission_key(organization_id: int, user_id: int) -> str:
+    return f"{PERMISSION_CACHE_PREFIX}:organization:{organization_id}:user:{user_id}"
+
+
+def _count(stat: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[stat] += amount
+
+
+def get_or_compute(key: str, compute: Callable[[], object]):
+    """
+    Return the cached value for key, computing and storing it on a miss. Cache
+    errors fall back to computing the value so permission checks never fail
+    because the cache is down.
+    """
+    try:
+        value = cache.get(key, _MISSING)
+    except Exception as exc:
+        logger.warning("Permission cache read failed for %s: %s", key, exc)
+        value = _MISSING
+
+    if value is not _MISSING:
+        _count("hits")
+        return value
+
+    _count("misses")
+    value = compute()
+
+    try:
+        cache.set(key, value, getattr(settings, "PERMISSION_CACHE_TIMEOUT", DEFAULT_PERMISSION_CACHE_TIMEOUT))
+    except Exception as exc:
+        logger.warning("Permission cache write failed for %s: %s", key, exc)
+
+    return value
+
+
+def invalidate(keys: Iterable[str]) -> None:
+    keys = list(keys)
+    if not keys:
+        return
+
+    _count("invalidations", len(keys))
+
+    try:
+        cache.delete_many(keys)
+    except Exception as exc:
+        logger.warning("Permission cache invalidation failed for %d key(s): %s", len(keys), exc)
+
+
+def get_stats() -> dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
@@ -13,6 +13,7 @@ permission_required: The permission that the user requires
 user_override_fields: These model fields allow the requesting user the override the permission if they match
     Ex: If user is the invitee of an organization invitation, give them permission to delete the object (i.e. reject the invitation)
 primary_pk_class: The model to run has_permission() on during has_permission() (access to the view in general)
+    The object is loaded once per request through get_permission_object()
 lookup: MUST BE PASSED WITH primary_pk_class --- the view.kwargs.get() lookup from drf nested routers
     Ex: /api/organizations/{id}/members/ - a user should only have access to the model view set in general if they have permission the organization's permission
         In this case, primary_pk_class = Organization and lookup = 'organization_pk' (defined by the drf nested router url in urls.py)
@@ -22,6 +23,30 @@ secondary_pk_kwargs: MUST BE PASSED WITH secondary_pk_class --- The fields to ge
 object_override: A specific model object to run has_permission() on in both has_permission() and has_object_permission()
     This is for extremely custom cases and theoretically no other parameters should need to be passed if this is passed
 '''
+def get_permission_object(request, model_class, pk):
+    '''
+    Load the object a permission check runs against, memoized on the request so every
+    permission class (and repeated checks) in one request share a single query.
+    Large columns listed in the model's DEFERRED_FIELDS are skipped. The permission
+    itself comes from the model (and the shared permission cache), not this query.
+    '''
+    cache = getattr(request, '_permission_objects', None)
+    if cache is None:
+        cache = request._permission_objects = {}
+
+    key = (model_class, str(pk))
+    if key not in cache:
+        queryset = getattr(model_class, 'objects').defer(*getattr(model_class, 'DEFERRED_FIELDS', []))
+
+        try:
+            cache[key] = queryset.get(id=pk)
+        except getattr(model_class, 'DoesNotExist') as exc:
+            cache[key] = exc
+
+    if isinstance(cache[key], Exception):
+        raise cache[key]
+    return cache[key]
+
 def create_user_permission_class(
         permission_required,
         user_override_fields=[],
@@ -45,7 +70,7 @@ def create_user_permission_class(
 
             if primary_pk_class is not None:
                 try:
-                    obj = getattr(primary_pk_class, 'objects').get(id=view.kwargs.get(lookup))
+                    obj = get_permission_object(request, primary_pk_class, view.kwargs.get(lookup))
                     return obj.has_permission(request.user, permission_required)
                 except getattr(primary_pk_class, 'DoesNotExist'):
                     pass
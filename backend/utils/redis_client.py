@@ -1,31 +1,138 @@
 """
-Shared Redis client for Yjs/websocket pubsub and related features.
+Shared Redis clients for Yjs/websocket pubsub and related features.
 
 Use this module from any app (projects, organizations, accounts) so connection
 settings and timeouts are centralized. Short timeouts avoid long blocks when
 Redis is unavailable (e.g. during development without Redis running).
 
+get_redis_client(purpose) returns one pooled client per logical purpose and
+process, configured by the REDIS_* settings and REDIS_CLIENTS overrides, so
+each worker reuses its connections. redis_client is the default client.
+
 Use safe_publish() and safe_hkeys() so callers don't need try/except; failures
 are logged and no exception is raised.
+
+Code that runs while writing to the database (e.g. signal receivers) should use
+publish_on_commit() instead: messages are buffered per transaction, dropped if
+it rolls back and sent with one pipelined round trip after it commits, or from
+a background thread when REDIS_PUBLISH_IN_BACKGROUND is set.
 """
 
+import json
 import logging
+import queue
+import threading
+import weakref
 
-from redis import Redis
+from redis import ConnectionPool, Redis
 from redis.backoff import ExponentialBackoff
+from redis.cluster import RedisCluster
+from redis.connection import parse_url
 from redis.retry import Retry
+from redis.sentinel import Sentinel
 
 from django.conf import settings
+from django.db import transaction
 
 
 logger = logging.getLogger(__name__)
-redis_client = Redis(
-    host="localhost",
-    port=6379,
-    db=0,
-    socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
-    retry=Retry(ExponentialBackoff(), settings.REDIS_SOCKET_RETRIES),
-)
+
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+
+# Logical clients. Each can point somewhere else through REDIS_CLIENTS; purposes
+# that resolve to the same options share one client and connection pool.
+#   pubsub: messages and presence shared with the Hocuspocus server
+#   queue:  the Yjs sync queue worked by the sync_yjs command
+#   cache:  counters buffered in Redis, like share link visits
+REDIS_PURPOSES = ("default", "pubsub", "queue", "cache")
+
+_clients: dict[tuple, Redis] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client_options(purpose: str = "default") -> dict:
+    """
+    Connection options for a logical client: the REDIS_* settings, overridden by
+    REDIS_CLIENTS[purpose] (keys without the REDIS_ prefix, e.g. {"URL": ...}).
+    """
+    options = {
+        "URL": getattr(settings, "REDIS_URL", DEFAULT_REDIS_URL),
+        "MAX_CONNECTIONS": getattr(settings, "REDIS_MAX_CONNECTIONS", None),
+        "HEALTH_CHECK_INTERVAL": getattr(settings, "REDIS_HEALTH_CHECK_INTERVAL", 0),
+        "SOCKET_CONNECT_TIMEOUT": getattr(settings, "REDIS_SOCKET_CONNECT_TIMEOUT", None),
+        "SOCKET_TIMEOUT": getattr(settings, "REDIS_SOCKET_TIMEOUT", None),
+        "SOCKET_RETRIES": getattr(settings, "REDIS_SOCKET_RETRIES", 0),
+        "SENTINELS": getattr(settings, "REDIS_SENTINELS", None),
+        "SENTINEL_SERVICE": getattr(settings, "REDIS_SENTINEL_SERVICE", None),
+        "CLUSTER": getattr(settings, "REDIS_CLUSTER", False),
+    }
+    options.update(getattr(settings, "REDIS_CLIENTS", {}).get(purpose, {}))
+    return options
+
+
+def create_redis_client(options: dict) -> Redis:
+    """
+    Build a client with its own connection pool. With SENTINELS the URL only
+    supplies the database and credentials, and the master is looked up through
+    Sentinel; with CLUSTER the URL is any node of the cluster.
+    """
+    connection_kwargs = {
+        "socket_connect_timeout": options["SOCKET_CONNECT_TIMEOUT"],
+        "socket_timeout": options["SOCKET_TIMEOUT"],
+        "health_check_interval": options["HEALTH_CHECK_INTERVAL"],
+        "retry": Retry(ExponentialBackoff(), options["SOCKET_RETRIES"]),
+    }
+
+    if options["CLUSTER"]:
+        # Cluster nodes do not take health_check_interval, and size their own pools when MAX_CONNECTIONS is unset
+        connection_kwargs.pop("health_check_interval")
+        if options["MAX_CONNECTIONS"]:
+            connection_kwargs["max_connections"] = options["MAX_CONNECTIONS"]
+        return RedisCluster.from_url(options["URL"], **connection_kwargs)
+
+    if options["SENTINELS"]:
+        url_kwargs = {key: value for key, value in parse_url(options["URL"]).items() if key in ("db", "username", "password")}
+        sentinel = Sentinel(
+            [tuple(address) for address in options["SENTINELS"]],
+            socket_connect_timeout=options["SOCKET_CONNECT_TIMEOUT"],
+            socket_timeout=options["SOCKET_TIMEOUT"],
+        )
+        return sentinel.master_for(
+            options["SENTINEL_SERVICE"],
+            max_connections=options["MAX_CONNECTIONS"],
+            **url_kwargs,
+            **connection_kwargs,
+        )
+
+    pool = ConnectionPool.from_url(options["URL"], max_connections=options["MAX_CONNECTIONS"], **connection_kwargs)
+    return Redis(connection_pool=pool)
+
+
+def get_redis_client(purpose: str = "default") -> Redis:
+    """
+    Return the process-wide client for a logical purpose (see REDIS_PURPOSES),
+    creating it on first use. Creating a client does not connect yet.
+    """
+    options = get_client_options(purpose)
+    key = tuple(sorted((name, repr(value)) for name, value in options.items()))
+
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = create_redis_client(options)
+        return _clients[key]
+
+
+redis_client = get_redis_client()
+
+
+def pack_binary_message(header: dict, payload: bytes | None = None) -> bytes:
+    """
+    Frame a JSON header and a raw binary payload (e.g. a Yjs update) into one
+    pub/sub message so the payload travels without base64: a 4-byte big-endian
+    header length, the UTF-8 JSON header, then the payload bytes.
+    """
+    encoded_header = json.dumps(header).encode("utf-8")
+    return len(encoded_header).to_bytes(4, "big") + encoded_header + (payload or b"")
 
 
 def safe_publish(channel: str, message: str | bytes) -> bool:
@@ -34,7 +141,7 @@ def safe_publish(channel: str, message: str | bytes) -> bool:
     connection/error (logged). Callers can ignore the return value.
     """
     try:
-        redis_client.publish(channel, message)
+        get_redis_client("pubsub").publish(channel, message)
         return True
     except Exception as exc:
         logger.warning("Redis publish failed for channel %s: %s", channel, exc)
@@ -47,7 +154,110 @@ def safe_hkeys(key: str) -> list[bytes]:
     (logged). Decode bytes in the caller if needed.
     """
     try:
-        return redis_client.hkeys(key)
+        return get_redis_client("pubsub").hkeys(key)
     except Exception as exc:
         logger.warning("Redis hkeys failed for key %s: %s", key, exc)
         return []
+
+
+def publish_many(messages: list[tuple[str, str | bytes]]) -> bool:
+    """
+    Publish (channel, message) pairs in order with one pipelined round trip.
+    Returns False on connection/error (logged).
+    """
+    if not messages:
+        return True
+
+    try:
+        pipe = get_redis_client("pubsub").pipeline(transaction=False)
+        for channel, message in messages:
+            pipe.publish(channel, message)
+        pipe.execute()
+        return True
+    except Exception as exc:
+        logger.warning("Redis publish failed for %d message(s): %s", len(messages), exc)
+        return False
+
+
+# Hooks scheduled by get_commit_hook() per connection and class, in order, with
+# the savepoint ids each was scheduled under. Hooks are held weakly: once Django
+# runs a hook on commit, or drops it because its savepoint or the transaction
+# rolled back, it is gone here as well.
+_commit_hooks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_commit_hooks_lock = threading.Lock()
+
+
+def get_commit_hook(hook_class: type):
+    """
+    Return the hook_class instance last scheduled with transaction.on_commit if
+    it was scheduled under the current savepoints, or schedule a new one. Work
+    queued on the hook then commits or is rolled back together with it: Django
+    drops the hooks of a savepoint that rolls back, and all of them with the
+    transaction. Only call it inside an atomic block.
+    """
+    connection = transaction.get_connection()
+    savepoint_ids = tuple(connection.savepoint_ids)
+
+    with _commit_hooks_lock:
+        scheduled = _commit_hooks.setdefault(connection, {}).setdefault(hook_class, [])
+
+    # Forget hooks that already ran or were rolled back
+    while scheduled and scheduled[-1][1]() is None:
+        scheduled.pop()
+
+    # Only the last hook is reused so work queued later never runs before earlier work
+    if scheduled and scheduled[-1][0] == savepoint_ids:
+        return scheduled[-1][1]()
+
+    hook = hook_class()
+    scheduled.append((savepoint_ids, weakref.ref(hook)))
+    transaction.on_commit(hook)
+    return hook
+
+
+class _OutboxBatch:
+    def __init__(self):
+        self.messages: list[tuple[str, str | bytes]] = []
+
+    def __call__(self) -> None:
+        _send(self.messages)
+
+
+_background_queue: queue.Queue = queue.Queue()
+_background_worker: threading.Thread | None = None
+_background_worker_lock = threading.Lock()
+
+
+def _publish_in_background() -> None:
+    while True:
+        publish_many(_background_queue.get())
+
+
+def _send(messages: list[tuple[str, str | bytes]]) -> None:
+    global _background_worker
+
+    if not getattr(settings, "REDIS_PUBLISH_IN_BACKGROUND", False):
+        publish_many(messages)
+        return
+
+    # A single worker keeps messages in commit order
+    with _background_worker_lock:
+        if _background_worker is None or not _background_worker.is_alive():
+            _background_worker = threading.Thread(target=_publish_in_background, name="redis-outbox", daemon=True)
+            _background_worker.start()
+
+    _background_queue.put(messages)
+
+
+def publish_on_commit(channel: str, message: str | bytes) -> None:
+    """
+    Queue a message until the current transaction commits. Messages queued in
+    one transaction are sent together, in a batch per run of messages queued
+    under the same savepoints; nothing is sent from a transaction or savepoint
+    that rolls back. Outside a transaction the message is sent right away.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        _send([(channel, message)])
+        return
+
+    get_commit_hook(_OutboxBatch).messages.append((channel, message))
@@ -0,0 +1,68 @@
+"""
+Versioned cache for rendered API responses.
+
+Every cached object has a version stored in the default Django cache, and the
+version is part of each response key. Bumping it orphans every rendering of the
+object at once (for every permission tier and query variant) without having to
+know which keys exist; the orphans simply expire. Callers add whatever else the
+rendering depends on (e.g. updated_at or the requester's permission tier) to
+the key, so a missed bump only survives until one of those changes or the
+timeout passes.
+
+Cache errors are logged and treated as misses.
+"""
+
+import logging
+import time
+from collections.abc import Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_PREFIX = "response"
+DEFAULT_RESPONSE_CACHE_TIMEOUT = 300
+
+
+def _version_key(namespace: str, pk: int) -> str:
+    return f"{RESPONSE_CACHE_PREFIX}:{namespace}:{pk}:version"
+
+
+def response_key(namespace: str, pk: int, *parts) -> str:
+    try:
+        version = cache.get(_version_key(namespace, pk), 0)
+    except Exception as exc:
+        logger.warning("Response cache version read failed for %s %s: %s", namespace, pk, exc)
+        version = 0
+
+    return ":".join([RESPONSE_CACHE_PREFIX, namespace, str(pk), str(version), *map(str, parts)])
+
+
+def get(key: str):
+    try:
+        return cache.get(key)
+    except Exception as exc:
+        logger.warning("Response cache read failed for %s: %s", key, exc)
+        return None
+
+
+def set(key: str, data) -> None:
+    try:
+        cache.set(key, data, getattr(settings, "RESPONSE_CACHE_TIMEOUT", DEFAULT_RESPONSE_CACHE_TIMEOUT))
+    except Exception as exc:
+        logger.warning("Response cache write failed for %s: %s", key, exc)
+
+
+def invalidate(namespace: str, pks: Iterable[int]) -> None:
+    # A fresh timestamp works as the new version without a read-modify-write per key
+    version = time.time_ns()
+    versions = {_version_key(namespace, pk): version for pk in pks if pk is not None}
+    if not versions:
+        return
+
+    try:
+        cache.set_many(versions, None)
+    except Exception as exc:
+        logger.warning("Response cache invalidation failed for %d %s object(s): %s", len(versions), namespace, exc)
@@ -0,0 +1,109 @@
+"""
+Helpers for working with encoded Yjs updates and state vectors without
+materializing a document. Used to store incremental project updates and to
+compact them back into a single state.
+
+pycrdt is optional: when it is not installed, YJS_AVAILABLE is False and
+callers fall back to storing full document states.
+"""
+from __future__ import annotations
+
+try:
+    import pycrdt
+except ImportError:
+    pycrdt = None  # type: ignore[assignment]
+
+YJS_AVAILABLE = pycrdt is not None
+
+
+def merge_updates(*updates: bytes | None) -> bytes | None:
+    """
+    Merge encoded updates (in any order) into a single update. Returns None
+    when there is nothing to merge.
+    """
+    updates = [bytes(update) for update in updates if update]
+
+    if not updates:
+        return None
+    if len(updates) == 1:
+        return updates[0]
+
+    return pycrdt.merge_updates(*updates)
+
+
+def diff_update(state: bytes, state_vector: bytes | None) -> bytes:
+    """
+    Return the part of a full document state that is not covered by the
+    given state vector (everything, if there is no state vector yet).
+    """
+    if not state_vector:
+        return bytes(state)
+
+    return pycrdt.get_update(bytes(state), bytes(state_vector))
+
+
+def get_state_vector(state: bytes) -> bytes:
+    """
+    Return the state vector of a full document state. Only meaningful for
+    complete states; an incremental update does not start at clock 0 and
+    yields an empty vector.
+    """
+    return pycrdt.get_state(bytes(state))
+
+
+def merge_state_vectors(*state_vectors: bytes | None) -> bytes:
+    """
+    Combine state vectors by taking the highest clock seen for each client.
+    """
+    clocks: dict[int, int] = {}
+
+    for state_vector in state_vectors:
+        if state_vector:
+            for client, clock in _decode_state_vector(bytes(state_vector)).items():
+                clocks[client] = max(clock, clocks.get(client, 0))
+
+    return _encode_state_vector(clocks)
+
+
+def _read_var_uint(data: bytes, pos: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+
+        if byte < 0x80:
+            return value, pos
+
+
+def _write_var_uint(value: int) -> bytes:
+    out = bytearray()
+
+    while value > 0x7F:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+
+    out.append(value)
+    return bytes(out)
+
+
+def _decode_state_vector(data: bytes) -> dict[int, int]:
+    count, pos = _read_var_uint(data, 0)
+    clocks = {}
+
+    for _ in range(count):
+        client, pos = _read_var_uint(data, pos)
+        clock, pos = _read_var_uint(data, pos)
+        clocks[client] = clock
+
+    return clocks
+
+
+def _encode_state_vector(clocks: dict[int, int]) -> bytes:
+    return _write_var_uint(len(clocks)) + b"".join(
+        _write_var_uint(client) + _write_var_uint(clock)
+        for client, clock in sorted(clocks.items(), reverse=True)
+    )
@@ -2,8 +2,10 @@ import { Server } from "@hocuspocus/server";
 import Redis from "ioredis";
 import * as Y from "yjs";
 
-const redis = new Redis();
-const redisSubscriber = new Redis();
+// Must match the backend's "pubsub" and "queue" Redis clients (REDIS_URL / REDIS_CLIENTS)
+const REDIS_URL = process.env.REDIS_URL ?? "redis://localhost:6379/0";
+const redis = new Redis(REDIS_URL);
+const redisSubscriber = new Redis(REDIS_URL);
 
 const projectMetaMapKey = "meta";
 const updatedProjectNames: Record<string, string> = {};
@@ -211,20 +213,21 @@ const server = new Server({
 
     console.log('documentName', documentName);
 
-    const res = await fetch(`http://localhost:8000/api/projects/${documentName}/`, {
-      method: "GET",
-      headers: {
-        Authorization: `Bearer ${context.token}`,
-      },
-    });
+    // Metadata comes from the JSON endpoint without state; the state itself is fetched as raw bytes
+    const headers = { Authorization: `Bearer ${context.token}` };
+    const [res, stateRes] = await Promise.all([
+      fetch(`http://localhost:8000/api/projects/${documentName}/?include_state=false`, { method: "GET", headers }),
+      fetch(`http://localhost:8000/api/projects/${documentName}/state/`, { method: "GET", headers }),
+    ]);
 
-    if (!res.ok) throw new Error("Invalid token");
+    if (!res.ok || !stateRes.ok) throw new Error("Invalid token");
 
     const data = await res.json();
+    const state = new Uint8Array(await stateRes.arrayBuffer());
 
-    if (data.yjs_blob) {
-      console.log("applying yjs blob update on initial document load");
-      Y.applyUpdate(document, Buffer.from(data.yjs_blob, 'base64'));
+    if (state.length > 0) {
+      console.log("applying yjs state on initial document load");
+      Y.applyUpdate(document, state);
     }
 
     const projectMetaMap = document.getMap<any>(projectMetaMapKey);
@@ -322,15 +325,70 @@ const PROJECT_UPDATE_CHANNELS = [
   PROJECT_SAVED_CHANNEL,
 ];
 
-redisSubscriber.subscribe(...PROJECT_UPDATE_CHANNELS, (err, count) => {
+// Django's autosave scheduler (backend/projects/autosave.py) asks for open projects to be stored
+const STORE_REQUESTS_CHANNEL = "yjs:store_requests";
+
+redisSubscriber.subscribe(...PROJECT_UPDATE_CHANNELS, STORE_REQUESTS_CHANNEL, (err, count) => {
   if (err) {
     console.error("Failed to subscribe to project update channels:", err);
     return;
   }
 });
 
-redisSubscriber.on("message", (channel, message) => {
-  console.log("[Hocuspocus][Redis] Message received:", { channel, message });
+/**
+ * Project updates are framed as a 4-byte big-endian header length, a JSON header
+ * and the raw Yjs update bytes. Every other channel carries plain JSON.
+ */
+const decodeBinaryMessage = (message: Buffer): { header: any; payload: Uint8Array | null } => {
+  const headerLength = message.readUInt32BE(0);
+  const header = JSON.parse(message.subarray(4, 4 + headerLength).toString("utf8"));
+  const payload = message.subarray(4 + headerLength);
+
+  return { header, payload: payload.length > 0 ? payload : null };
+};
+
+/**
+ * Store every requested document loaded on this server right away. Closing a
+ * direct connection runs onStoreDocument immediately, which buffers and queues
+ * the document (or skips it when nothing changed). Documents that are not
+ * loaded here are left alone rather than loaded just to be stored.
+ */
+const storeRequestedDocuments = async (message: Buffer) => {
+  let projectIds: number[];
+
+  try {
+    ({ project_ids: projectIds } = JSON.parse(message.toString("utf8")));
+  } catch (parseErr) {
+    console.error(`[Hocuspocus][Redis] Failed to decode message on ${STORE_REQUESTS_CHANNEL}:`, parseErr);
+    return;
+  }
+
+  const hocuspocus = server.hocuspocus;
+
+  for (const projectId of projectIds) {
+    const documentName = String(projectId);
+
+    if (!hocuspocus.documents.has(documentName)) {
+      continue;
+    }
+
+    try {
+      const docConnection = await hocuspocus.openDirectConnection(documentName);
+      await docConnection.disconnect();
+    } catch (storeErr) {
+      console.error(`[Hocuspocus][Redis] Failed to store document ${documentName}:`, storeErr);
+    }
+  }
+};
+
+redisSubscriber.on("messageBuffer", (channelBuffer: Buffer, message: Buffer) => {
+  const channel = channelBuffer.toString();
+  console.log("[Hocuspocus][Redis] Message received:", { channel, size: message.length });
+
+  if (channel === STORE_REQUESTS_CHANNEL) {
+    storeRequestedDocuments(message);
+    return;
+  }
 
   if (!PROJECT_UPDATE_CHANNELS.includes(channel)) {
     return;
@@ -347,7 +405,20 @@ redisSubscriber.on("message", (channel, message) => {
     return;
   }
 
-  const payload = JSON.parse(message) as any;
+  let payload: any;
+  let yjsUpdate: Uint8Array | null = null;
+
+  try {
+    if (channel === PROJECT_UPDATE_CHANNEL) {
+      ({ header: payload, payload: yjsUpdate } = decodeBinaryMessage(message));
+    } else {
+      payload = JSON.parse(message.toString("utf8"));
+    }
+  } catch (parseErr) {
+    console.error(`[Hocuspocus][Redis] Failed to decode message on ${channel}:`, parseErr);
+    return;
+  }
+
   const { project_id: projectId } = payload as {
     project_id: number;
   };
@@ -366,9 +437,8 @@ redisSubscriber.on("message", (channel, message) => {
       const docConnection = await hocuspocus.openDirectConnection(documentName);
 
       if (channel === PROJECT_UPDATE_CHANNEL) {
-        const { name, yjs_blob, default_share_link_id } = payload as {
+        const { name, default_share_link_id } = payload as {
           name?: string | null;
-          yjs_blob?: string | null;
           default_share_link_id?: number | null;
         };
 
@@ -378,16 +448,15 @@ redisSubscriber.on("message", (channel, message) => {
 
         await docConnection.transact((ydoc: Y.Doc) => {
           // Merge incoming Yjs state if provided
-          if (yjs_blob) {
+          if (yjsUpdate) {
             try {
-              const updateBuffer = Buffer.from(yjs_blob, "base64");
               console.log(
-                `[Hocuspocus][Redis] Applying Yjs blob update for document ${documentName} (size: ${updateBuffer.length} bytes).`,
+                `[Hocuspocus][Redis] Applying Yjs update for document ${documentName} (size: ${yjsUpdate.length} bytes).`,
               );
-              Y.applyUpdate(ydoc, updateBuffer);
+              Y.applyUpdate(ydoc, yjsUpdate);
             } catch (decodeErr) {
               console.error(
-                `[Hocuspocus][Redis] Failed to decode/apply yjs_blob for document ${documentName}:`,
+                `[Hocuspocus][Redis] Failed to apply Yjs update for document ${documentName}:`,
                 decodeErr,
               );
             }
@@ -422,21 +491,27 @@ redisSubscriber.on("message", (channel, message) => {
           collaborators,
           event,
           collaborator_id,
-          organization_id,
-          project_organization_id,
           permission,
           project_collaborator,
-          project_organization,
+          project_collaborators,
+          organization_changes,
         } = payload as {
           project_id: number;
           collaborators: Record<number, string | null>;
           event?: string;
           collaborator_id?: number;
-          organization_id?: number;
-          project_organization_id?: number;
           permission?: string | null;
           project_collaborator?: Record<string, any> | null;
-          project_organization?: Record<string, any> | null;
+          // Set instead of collaborator_id/project_collaborator when a batch was added at once
+          project_collaborators?: Record<string, any>[];
+          // Every OrganizationProject change to the project committed in one transaction
+          organization_changes?: {
+            event: string;
+            organization_id: number;
+            project_organization_id?: number;
+            permission?: string | null;
+            project_organization?: Record<string, any> | null;
+          }[];
         };
 
         console.log(
@@ -456,7 +531,21 @@ redisSubscriber.on("message", (channel, message) => {
             setImmediate(() => connection.close()); // Reconnect so the client runs onAuthenticate again with the new permission
           }
 
-          if (
+          if (event && project_collaborators) {
+            // Fan the coalesced message out in the per-collaborator shape clients already handle
+            project_collaborators.forEach((collaborator) => {
+              connection.sendStateless(
+                JSON.stringify({
+                  type: "project_collaborator_change",
+                  event,
+                  project_id,
+                  collaborator_id: collaborator.collaborator?.id,
+                  permission: collaborator.permission ?? null,
+                  project_collaborator: collaborator,
+                }),
+              );
+            });
+          } else if (
             event &&
             collaborator_id !== undefined &&
             collaborator_id !== null &&
@@ -472,23 +561,20 @@ redisSubscriber.on("message", (channel, message) => {
                 project_collaborator: project_collaborator ?? null,
               }),
             );
-          } else if (
-            event &&
-            organization_id !== undefined &&
-            organization_id !== null &&
-            event.startsWith("organization_")
-          ) {
-            connection.sendStateless(
-              JSON.stringify({
-                type: "project_organization_change",
-                event,
-                project_id,
-                organization_id,
-                project_organization_id,
-                permission: permission ?? null,
-                project_organization: project_organization ?? null,
-              }),
-            );
+          } else if (organization_changes) {
+            organization_changes.forEach((change) => {
+              connection.sendStateless(
+                JSON.stringify({
+                  type: "project_organization_change",
+                  event: change.event,
+                  project_id,
+                  organization_id: change.organization_id,
+                  project_organization_id: change.project_organization_id,
+                  permission: change.permission ?? null,
+                  project_organization: change.project_organization ?? null,
+                }),
+              );
+            });
           }
         });
       } else if (channel === PROJECT_SAVED_CHANNEL) {